@@ -1,135 +1,433 @@
-from collections import defaultdict
+import argparse
+from collections import defaultdict, deque
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
 import json
 import random
 import pygit2
 import os
 import pytest
+import shutil
+import time
 from datetime import datetime
 from pathlib import Path
+from typing import Dict, List, Tuple
 
-from git_utils import get_all_commits, get_modified_lines, modifies_test_and_code
-from test_utils import collect_tests
+from catalog import Catalog, RecordIndex, index_data_dir
+from git_utils import checkout_changed_paths, files_modify_test_and_code, load_or_plan_commit_pairs, looks_like_test_file, prepare_worktrees
+from myplugin.intervals import Intervals, format_intervals
+from run_log import RunLog, StageTimer, peak_rss_bytes
+from test_utils import (IsolatedRunError, TestDiscoveryCache, TestFootprints, matches_python_files, python_files_patterns,
+                        run_isolated, run_traced_pytest)
 
-def my_checkout(repo, commit):
-    # Reset index and working directory to the target commit
-    repo.reset(commit.id, pygit2.GIT_RESET_HARD)
-    # Perform the forced checkout
-    repo.checkout_tree(commit.tree, strategy=pygit2.GIT_CHECKOUT_FORCE)
-    # Update HEAD to point to the new commit
-    repo.set_head(commit.id)
+def my_checkout(repo, commit) -> float:
+    """
+    Checks out `commit` (detached HEAD), writing only the files that differ from the current HEAD.
+    Returns the time it took.
+    """
+    start = time.perf_counter()
+    paths = checkout_changed_paths(repo, commit)
+    elapsed = time.perf_counter() - start
+    print(f"Checked out {commit.id} ({len(paths)} changed paths) in {elapsed * 1000:.1f}ms")
+    return elapsed
 
-def process_repo(repo_name: str, skip_existing = True, start_at = 0):
+def get_commit_pairs(repo, repo_name: str, catalog: Catalog, skip_existing = True, start_at = 0,
+                     run_log: RunLog | None = None) -> List[Dict]:
+    """
+    Lists the planned bugfix candidate pairs (see plan_commit_pairs) still to be processed:
+    with `skip_existing`, the ones the catalog doesn't have as done or skipped.
+    The planning and the skipped pairs are reported to `run_log`.
+    """
+    start = time.perf_counter()
+    skipped = defaultdict(int)
+    plan = load_or_plan_commit_pairs(repo, Path('Repos', repo_name, "plan.json"), start_at, skipped)
+    if run_log:
+        run_log.write("plan", candidates=len(plan), skipped=skipped, duration=time.perf_counter() - start)
 
-    repo_path = Path('Repos',repo_name, "code")
-    if not os.path.exists(repo_path):
-        raise ValueError(f"Directory {repo_path} does not exist")
+    finished = catalog.finished(repo_name) if skip_existing else set()
+    pairs = []
+    for entry in plan:
+        # Note: Positive and negative examples are stored under the commit BEFORE the change
+        # So the positive example is actually relative to the FOLLWING commit.
+        if entry["parent"] in finished:
+            print(f"Data for commit {entry['parent']} already exists; skipping")
+            if run_log:
+                run_log.write("commit", parent=entry["parent"], child=entry["child"], status="skipped: already exists",
+                              duration=0.0, stages={})
+            continue
+        pairs.append(entry)
+    return pairs
 
-    repo = pygit2.Repository(repo_path)
-    main_branch = repo.branches['main']
-    # Check out the latest commit on main and reset to it
-    repo.checkout(main_branch.name)
-    main_commit = main_branch.peel()
-    my_checkout(repo, main_commit)
+class CommitPairProcessor:
+    """
+    Runs the traced test sessions of commit pairs in one working tree.
+    Each processor writes to its own result.jsonl, in `scratch_path` (by default a scratch directory in
+    `repo_state_path`), and passes the modified lines to the plugin as --trace-lines options, so several can run side by side.
+    Records are annotated with the blob id of the traced file in the checked out commit, and indexed for the catalog.
+    The results of a pair are written to data/<repo>/<parent>.tmp/ and renamed to data/<repo>/<parent>/ once
+    the pair is done, so an interrupted pair leaves nothing that looks finished.
+    When running in a linked worktree, traced file names are reported as if they were under `canonical_repo_path`.
+    Caches shared by all processors of a repository (test discovery, test footprints) live in `repo_state_path`.
+    With `select_tests`, only the tests that can reach the modified lines run, plus the modified test files.
+    Every pytest session runs in a fresh child process (see run_isolated), stopped after `timeout` seconds.
+    process() reports the duration of each stage and the tracing stats of the pair, for the run log.
+    With `objects_path`, the payloads of the records go to that object store, shared by all the pairs and repositories,
+    and the result files hold references to them (see myplugin.objects).
+    """
+    def __init__(self, repo, repo_path: Path, data_path: Path, repo_state_path: Path,
+                 scratch_path: Path | None = None, canonical_repo_path: Path | None = None, select_tests = True,
+                 timeout: float | None = 1800, objects_path: Path | None = None):
+        self.repo = repo
+        self.repo_path = repo_path.absolute()
+        self.canonical_repo_path = canonical_repo_path.absolute() if canonical_repo_path else self.repo_path
+        self.data_path = data_path
+        if scratch_path is None:
+            scratch_path = repo_state_path.joinpath("scratch")
+            scratch_path.mkdir(parents=True, exist_ok=True)
+        self.result_path = scratch_path.joinpath("result.jsonl")
 
-    data_path = Path('data', repo_name)
+        # point pytest to the repo
+        self.pytest_options = ['--continue-on-collection-errors', '--rootdir', str(repo_path)]
+        self.pytest_run_options = ['-p myplugin', '--trace-output', str(self.result_path)] + self.pytest_options
+        if objects_path is not None:
+            self.pytest_run_options += ['--trace-objects', str(objects_path.absolute())]
 
-    # point pytest to the repo
-    pytest_args = ['--continue-on-collection-errors', '--rootdir', str(repo_path), str(repo_path)]
-    pytest_args_run = ['-p myplugin'] + pytest_args
+        self.timeout = timeout
+        self.test_discovery = TestDiscoveryCache(repo_state_path.joinpath("test_discovery.json"), timeout)
+        self.select_tests = select_tests
+        self.test_footprints = TestFootprints(repo_state_path.joinpath("test_footprints.json"), timeout)
+        # per commit pair, reset by process()
+        self.timer = StageTimer()
+        self.stats = {}
+        self.examples: Dict[int, Tuple[str, RecordIndex]] = {}
 
-    commit_walker = get_all_commits(repo)
+    def _select_tests(self, commit, entry: Dict, tests_by_file: Dict[str, List[str]]) -> Tuple[List[str], List[str]]:
+        """
+        Returns the modified test files and the ids of the other tests whose footprint overlaps the modified lines.
+        """
+        # test files new in the child commit were not discovered at the parent
+        patterns = python_files_patterns(commit.tree)
+        modified_test_files = [file for file in entry["modified_files"]
+                               if tests_by_file.get(file) or (file not in tests_by_file and looks_like_test_file(file)
+                                                              and matches_python_files(file, patterns))]
+        self.test_footprints.update(commit.tree, self.repo_path, self.pytest_options, tests_by_file)
+        selected = self.test_footprints.select(entry["modified_lines"]["old"], tests_by_file, skip_files=modified_test_files)
+        print(f"Selected {len(selected)} tests reaching the modified lines, plus test files {modified_test_files}")
+        return modified_test_files, selected
 
-    # first commit
-    commit = next(commit_walker)
+    def _run_traced(self, commit, modified_lines: Dict[str, Intervals], data_path_commit: Path, example_name: str, label: int,
+                    selection: Tuple[List[str], List[str]] | None, stage: str) -> bool:
+        """
+        Runs the traced session of one commit of the pair and stages its result.
+        Returns False, without running pytest, when nothing of the selection is left to run.
+        """
+        staging_path = self._staging_path(data_path_commit)
+        # a result left by an earlier session must not pass for this one's
+        self.result_path.unlink(missing_ok=True)
+        tracked_lines = [f"--trace-lines={file}:{format_intervals(intervals)}" for file, intervals in modified_lines.items()]
 
-    print(f"Processing repo {repo_name} starting with {commit}  (at {datetime.fromtimestamp(commit.commit_time)})")
-    my_checkout(repo, commit)
+        if selection is None:
+            targets = [str(self.repo_path)]
+        else:
+            test_files, test_ids = selection
+            # test ids are relative to the rootdir, while pytest resolves arguments from the current directory
+            targets = ([str(self.repo_path.joinpath(file)) for file in test_files if self.repo_path.joinpath(file).exists()]
+                       + [f"{self.repo_path}/{test_id}" for test_id in test_ids])
+            if not targets:
+                # without paths, pytest would collect the current directory rather than the repo
+                print(f"No selected tests to run on {commit.id}")
+                return False
+        with self.timer(stage):
+            _, stats = run_isolated(run_traced_pytest, self.pytest_run_options + tracked_lines + targets, timeout=self.timeout)
+        for key in ("trace_events", "trace_hits", "trace_records"):
+            self.stats[key] += stats.get(key, 0)
+        self.stats["peak_rss"] = max(self.stats["peak_rss"], stats["peak_rss"])
 
-    test_files = set()
+        with self.timer("save_result"):
+            if self.result_path.exists():
+                index = self._annotate_result(commit.tree, data_path_commit)
+                staging_path.mkdir(parents=True, exist_ok=True)
+                self.stats["result_bytes"] += self.result_path.stat().st_size
+                self.result_path.replace(staging_path.joinpath(example_name))
+                self.examples[label] = (str(data_path_commit.joinpath(example_name)), index)
+            else:
+                print(f"No result found for {data_path_commit.name} ({example_name})!")
+        return True
 
-    # ensure test discovery is done at the start and at least every 10 commits, just in case
-    remaining_before_test_discovery = 0
-    max_test_discovery_interval = 10
+    def _annotate_result(self, tree, destination: Path) -> RecordIndex:
+        """
+        Adds the blob ids to the result file and returns the (file, line, byte offset, length, count) of its records.
+        The object store path of a file of references is made relative to `destination`, where the file goes.
+        """
+        annotated_path = self.result_path.with_name(self.result_path.name + ".tmp")
+        blobs = {}
+        index = []
+        offset = 0
+        # one record at a time: the file can be larger than memory
+        with open(self.result_path) as f, open(annotated_path, 'w') as out:
+            for line in f:
+                record = json.loads(line)
+                if "objects" in record:
+                    objects_path = self.result_path.parent.joinpath(record["objects"]).absolute()
+                    text = json.dumps({"objects": os.path.relpath(objects_path, destination.absolute())}) + '\n'
+                    out.write(text)
+                    offset += len(text)
+                    continue
+                path = Path(record["file"])
+                relative_path = record["file"]
+                if path.is_relative_to(self.repo_path):
+                    relative_path = path.relative_to(self.repo_path).as_posix()
+                    if relative_path not in blobs:
+                        # the working tree matches the commit: checkouts are forced
+                        try:
+                            blobs[relative_path] = str(tree[relative_path].id)
+                        except KeyError:
+                            blobs[relative_path] = None
+                    record["blob"] = blobs[relative_path]
+                    record["file"] = str(self.canonical_repo_path.joinpath(relative_path))
+                # ASCII, as json.dumps escapes the rest: the length in characters is the length in bytes
+                text = json.dumps(record) + '\n'
+                out.write(text)
+                index.append((relative_path, record["line"], offset, len(text), record.get("count", 1)))
+                offset += len(text)
+        annotated_path.replace(self.result_path)
+        return index
 
-    skipped_no_parent = []
+    @staticmethod
+    def _staging_path(data_path_commit: Path) -> Path:
+        return data_path_commit.with_name(data_path_commit.name + ".tmp")
 
-    for next_commit in commit_walker:
-        if commit.commit_time < start_at:
-            commit = next_commit
-            continue
+    def _publish(self, data_path_commit: Path, status: str):
+        """
+        Moves the results of a done pair in place, replacing those of an earlier run; drops them otherwise.
+        """
+        staging_path = self._staging_path(data_path_commit)
+        if status != "done" or not staging_path.exists():
+            shutil.rmtree(staging_path, ignore_errors=True)
+            self.examples = {}
+            return
+        if data_path_commit.exists():
+            shutil.rmtree(data_path_commit)
+        staging_path.replace(data_path_commit)
 
-        if not commit in next_commit.parents:
-            print(f"{commit.id} (at {datetime.fromtimestamp(commit.commit_time)}), is not the parent of {next_commit.id} (at {datetime.fromtimestamp(next_commit.commit_time)}); skipping")
-            skipped_no_parent.append((commit.id, next_commit.id))
-            commit = next_commit
-            continue
+    def process(self, entry: Dict) -> Dict:
+        """
+        Processes one planned pair and returns its run log record, with how it ended in "status":
+        "done", "skipped: <reason>" or "failed: <reason>". Any error, such as a timeout or crash of a pytest session,
+        fails only this pair.
+        The payload files written and their record indexes are in "examples", by label, for the catalog.
+        """
+        self.timer = StageTimer()
+        self.stats = {"trace_events": 0, "trace_hits": 0, "trace_records": 0, "result_bytes": 0, "peak_rss": 0}
+        self.examples = {}
+        start = time.perf_counter()
+        data_path_commit = self.data_path.joinpath(entry["parent"])
+        # left by an interrupted run
+        shutil.rmtree(self._staging_path(data_path_commit), ignore_errors=True)
+        try:
+            status = self._process(entry, data_path_commit)
+            self._publish(data_path_commit, status)
+        except Exception as e:
+            # whatever goes wrong, only this pair fails and the others go on
+            reason = str(e) if isinstance(e, IsolatedRunError) else f"{type(e).__name__}: {e}"
+            print(f"Processing commit {entry['parent']} failed: {reason}")
+            status = f"failed: {reason}"
+            self._publish(data_path_commit, status)
+        return {"parent": entry["parent"], "child": entry["child"], "status": status,
+                "duration": time.perf_counter() - start, "stages": dict(self.timer.durations), **self.stats,
+                "examples": self.examples}
 
+    def _process(self, entry: Dict, data_path_commit: Path) -> str:
+        commit = self.repo[entry["parent"]]
+        next_commit = self.repo[entry["child"]]
         print(f"Processing commit {commit.id} (at {datetime.fromtimestamp(commit.commit_time)})")
 
-        # Note: Positive and negative examples are stored under the commit BEFORE the change
-        # So the positive example is actually relative to the FOLLWING commit.  
-        data_path_commit = data_path.joinpath(f'{commit.id}')
-
-        if skip_existing and data_path_commit.exists():
-            print(f"Data for commit {commit.id} already exists; skipping")
-            commit = next_commit
-            continue
-
-        my_checkout(repo, commit)
+        with self.timer("checkout"):
+            my_checkout(self.repo, commit)
 
-        diff = repo.diff(commit, next_commit)
-        new_py_files = [delta.new_file.path for delta in diff.deltas if delta.status == pygit2.GIT_DELTA_ADDED and delta.new_file.path.endswith('.py')]
-        if new_py_files or remaining_before_test_discovery <= 0:
-            n_test_estimate = 0.9 * len(test_files) + 0.5 * len(new_py_files)
-            print(f"Renewing test discovery as files {new_py_files} were added; expecting {n_test_estimate} tests")
-            test_files = collect_tests(pytest_args, n_test_estimate)
-            print(f"Discovered {len(test_files)} tests")
-            remaining_before_test_discovery = max_test_discovery_interval
+        # only test files that changed since they were last seen are collected again
+        with self.timer("discovery"):
+            tests_by_file = self.test_discovery.collect(commit.tree, self.repo_path, self.pytest_options)
+        test_files = {file for file, tests in tests_by_file.items() if tests}
+        print(f"Discovered {sum(len(tests) for tests in tests_by_file.values())} tests in {len(test_files)} files")
 
         # skip commits that don't look like bugfixes
-        if not modifies_test_and_code(diff, test_files):
+        if not files_modify_test_and_code(entry["modified_files"], test_files):
             print(f"Skipping commit {commit.id}")
-            commit = next_commit
-            continue
+            return "skipped: not a bugfix"
+
+        modified_lines = entry["modified_lines"]
 
-        # Get modified functions and test files
-        modified_lines = get_modified_lines(diff)
-        # save to the file for conftest.py to read
-        tmp_to_track = Path("to_track.json")
-        with open(tmp_to_track, 'w') as f:
-            json.dump(modified_lines["old"], f)
+        # the same tests run on both commits, so the examples are comparable
+        selection = None
+        if self.select_tests:
+            with self.timer("selection"):
+                selection = self._select_tests(commit, entry, tests_by_file)
 
         # Run pytest on parent commit
         # note we might have run on this commit already; but we have now new modified functions!
         print(f"Running tests on parent: {commit.id} ({datetime.fromtimestamp(commit.commit_time)})")
-        pytest.main(pytest_args_run)
-        
-        if Path('result.json').exists():
-            data_path_commit.mkdir(parents=True, exist_ok=True)
-            Path('result.json').rename(data_path_commit.joinpath('negative_example.json'))
-        else:
-            print("No result found for parent {commit.id}!")
+        if not self._run_traced(commit, modified_lines["old"], data_path_commit, 'negative_example.jsonl', 0, selection, "pytest_parent"):
+            return "skipped: no selected tests"
 
         # ==========================================
-        commit = next_commit
-
         # Run pytest on current commit
-        my_checkout(repo, commit)
+        with self.timer("checkout"):
+            my_checkout(self.repo, next_commit)
 
-        with open('to_track.json', 'w') as f:
-            json.dump(modified_lines["new"], f)
+        if selection is not None:
+            # the child can rename or remove selected tests, and pytest runs nothing when given a missing node id
+            with self.timer("discovery"):
+                child_tests = self.test_discovery.collect(next_commit.tree, self.repo_path, self.pytest_options)
+            test_files, test_ids = selection
+            child_ids = {test_id for tests in child_tests.values() for test_id in tests}
+            missing = [test_id for test_id in test_ids if test_id not in child_ids]
+            if missing:
+                print(f"Leaving out {len(missing)} selected tests missing from the child, such as {missing[0]}")
+            selection = (test_files, [test_id for test_id in test_ids if test_id in child_ids])
 
-        print(f"Running tests on new commit {commit.id} ({datetime.fromtimestamp(commit.commit_time)})")
-        pytest.main(pytest_args_run)
+        print(f"Running tests on new commit {next_commit.id} ({datetime.fromtimestamp(next_commit.commit_time)})")
+        if not self._run_traced(next_commit, modified_lines["new"], data_path_commit, 'positive_example.jsonl', 1, selection, "pytest_child"):
+            return "skipped: no selected tests"
+        return "done"
 
-        if Path('result.json').exists():
-            data_path_commit.mkdir(parents=True, exist_ok=True)
-            Path('result.json').rename(data_path_commit.joinpath('positive_example.json'))
-        else:
-            print("No result found for {commit.id}!")
+# set in each pool worker by _init_worker
+worker_options = {}
+# the processors of the worktrees this worker has opened, by worktree path: the pool hands a worker
+# different worktrees, and their caches and checkouts stay valid between its jobs
+worker_processors: Dict[Path, CommitPairProcessor] = {}
+
+def _init_worker(select_tests, objects_path):
+    worker_options.update(select_tests=select_tests, objects_path=objects_path)
+
+def _process_pair_in_worker(repo_name: str, worktree: str, entry: Dict) -> Dict:
+    worktree_path = Path(worktree).absolute()
+    processor = worker_processors.get(worktree_path)
+    if processor is None:
+        scratch_path = worktree_path.with_name(worktree_path.name + ".scratch")
+        scratch_path.mkdir(exist_ok=True)
+        worktree = pygit2.Repository(worktree_path)
+        # a full reset when the worktree is first opened, as for the main checkout: a worker killed mid-checkout or
+        # tests rewriting tracked files leave files that later checkouts, which only rewrite what changes, wouldn't fix
+        worktree.reset(worktree.head.target, pygit2.GIT_RESET_HARD)
+        processor = worker_processors[worktree_path] = CommitPairProcessor(
+            worktree, worktree_path, Path('data', repo_name), Path('Repos', repo_name), scratch_path,
+            canonical_repo_path=Path('Repos', repo_name, "code"), **worker_options)
+    return processor.process(entry)
+
+def _record_pair(run_log: RunLog, catalog: Catalog, repo_name: str, entry: Dict, record: Dict):
+    examples = record.pop("examples", {})
+    run_log.write("commit", **record)
+    catalog.record_pair(repo_name, entry, record["status"], record["duration"], examples)
+    print(f"Commit {entry['parent']}: {record['status']}")
+
+def _open_repo(repo_name: str) -> pygit2.Repository:
+    repo_path = Path('Repos', repo_name, "code")
+    if not os.path.exists(repo_path):
+        raise ValueError(f"Directory {repo_path} does not exist")
+
+    repo = pygit2.Repository(repo_path)
+    main_branch = repo.branches['main']
+    # a full reset once per run, as later checkouts only rewrite the files that change
+    repo.reset(repo.head.target, pygit2.GIT_RESET_HARD)
+    # Check out the latest commit on main and reset to it
+    repo.checkout(main_branch.name)
+    main_commit = main_branch.peel()
+    my_checkout(repo, main_commit)
+    return repo
+
+def process_repos(repo_names: List[str], skip_existing = True, start_at = 0, workers = 1, select_tests = True,
+                  catalog_path: Path = Path('catalog.sqlite'), objects_path: Path | None = Path('objects.sqlite')):
+    """
+    Processes the commit pairs of several repositories with at most `workers` pytest sessions at once.
+    The state of every pair is kept in the catalog (pending, running, done, skipped or failed with the reason),
+    so a new run resumes with the pairs that aren't done or skipped. The repositories with the fewest pairs
+    to process go first, so their results arrive early.
+    """
+    catalog = Catalog(catalog_path)
+    repos, run_logs, jobs = {}, {}, {}
+    for repo_name in repo_names:
+        repos[repo_name] = _open_repo(repo_name)
+        data_path = Path('data', repo_name)
+        run_logs[repo_name] = RunLog(Path('Repos', repo_name, "run_log.jsonl"), repo_name)
+        run_logs[repo_name].write("start", workers=workers, select_tests=select_tests, start_at=start_at)
+        if data_path.exists() and not catalog.pairs(repo_name):
+            # results mined before the catalog
+            index_data_dir(catalog, data_path.parent, repo_names=[repo_name])
+        jobs[repo_name] = get_commit_pairs(repos[repo_name], repo_name, catalog, skip_existing, start_at, run_logs[repo_name])
+        catalog.add_pending(repo_name, jobs[repo_name])
+        if not jobs[repo_name]:
+            print(f"Nothing to process in repo {repo_name}")
+            run_logs[repo_name].write("end", peak_rss=peak_rss_bytes())
+
+    order = sorted((repo_name for repo_name in repo_names if jobs[repo_name]), key=lambda repo_name: len(jobs[repo_name]))
+    queue = deque((repo_name, entry) for repo_name in order for entry in jobs[repo_name])
+    remaining = {repo_name: len(jobs[repo_name]) for repo_name in order}
+    for repo_name in order:
+        first = jobs[repo_name][0]
+        print(f"Processing {len(jobs[repo_name])} commit pairs of repo {repo_name} starting with {first['parent']}  (at {datetime.fromtimestamp(first['commit_time'])})")
+
+    def finish(repo_name: str, entry: Dict, record: Dict):
+        _record_pair(run_logs[repo_name], catalog, repo_name, entry, record)
+        remaining[repo_name] -= 1
+        if not remaining[repo_name]:
+            run_logs[repo_name].write("end", peak_rss=max(peak_rss_bytes(), peak_rss_bytes(children=True)))
+
+    if workers <= 1:
+        processor = None
+        while queue:
+            repo_name, entry = queue.popleft()
+            if processor is None or processor.repo is not repos[repo_name]:
+                processor = CommitPairProcessor(repos[repo_name], Path('Repos', repo_name, "code"), Path('data', repo_name),
+                                                Path('Repos', repo_name), select_tests=select_tests, objects_path=objects_path)
+            catalog.set_running(repo_name, entry["parent"])
+            finish(repo_name, entry, processor.process(entry))
+        catalog.close()
+        return
+
+    # every job runs in a linked worktree of its repository that no other job is using, so checkouts don't interfere;
+    # a repository gets as many worktrees as it can use at once
+    free_worktrees: Dict[str, List[Path]] = {}
+    running = {}
+    with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker, initargs=(select_tests, objects_path)) as executor:
+        while queue or running:
+            while queue and len(running) < workers:
+                repo_name, entry = queue.popleft()
+                if repo_name not in free_worktrees:
+                    free_worktrees[repo_name] = prepare_worktrees(repos[repo_name], Path('Repos', repo_name, "worktrees"),
+                                                                  min(workers, len(jobs[repo_name])))
+                worktree_path = free_worktrees[repo_name].pop()
+                catalog.set_running(repo_name, entry["parent"])
+                future = executor.submit(_process_pair_in_worker, repo_name, str(worktree_path), entry)
+                running[future] = (repo_name, entry, worktree_path)
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                repo_name, entry, worktree_path = running.pop(future)
+                free_worktrees[repo_name].append(worktree_path)
+                try:
+                    record = future.result()
+                except Exception as e:
+                    print(f"Processing commit {entry['parent']} failed: {e}")
+                    record = {"parent": entry["parent"], "child": entry["child"], "status": f"failed: {e}", "duration": 0.0, "stages": {}}
+                finish(repo_name, entry, record)
+    catalog.close()
+
+def process_repo(repo_name: str, skip_existing = True, start_at = 0, workers = 1, select_tests = True,
+                 catalog_path: Path = Path('catalog.sqlite'), objects_path: Path | None = Path('objects.sqlite')):
+    process_repos([repo_name], skip_existing, start_at, workers, select_tests, catalog_path, objects_path)
+
+def main():
+    parser = argparse.ArgumentParser(description="Trace the tests of the bugfix commit pairs of cloned repositories.")
+    parser.add_argument("repos", nargs="*", help="names of the repositories under Repos/ (default: all of them)")
+    parser.add_argument("--workers", type=int, default=1, help="pytest sessions running at once")
+    parser.add_argument("--start-at", type=datetime.fromisoformat, default=datetime(2019, 1, 1),
+                        help="oldest commit date to consider")
+    parser.add_argument("--all-tests", action="store_true", help="run every test instead of those reaching the modified lines")
+    parser.add_argument("--redo", action="store_true", help="process again the pairs already done or skipped")
+    args = parser.parse_args()
 
-    print(len(skipped_no_parent))
-    print(skipped_no_parent[:100])
+    repo_names = args.repos or sorted(path.parent.name for path in Path('Repos').glob("*/code"))
+    process_repos(repo_names, skip_existing=not args.redo, start_at=args.start_at.timestamp(), workers=args.workers,
+                  select_tests=not args.all_tests)
 
 if __name__ == "__main__":
-    process_repo('requests', start_at=datetime(2019, 1, 1).timestamp())
+    main()
@@ -0,0 +1,147 @@
+"""
+Batches of the encoded data points without padding everything to 512 tokens.
+
+TokenDataset serves the token ids of a TokenCache unpadded, fitted to `max_length` by one of the FIT_STRATEGIES,
+LengthBucketSampler puts data points of similar length in the same batch, and PaddingCollator pads each batch
+to its longest member. torch is only needed for the tensors of the collator:
+
+    dataset = TokenDataset(cache, entries, labels, max_length=512, strategy="keep_target")
+    loader = DataLoader(dataset, batch_sampler=LengthBucketSampler(dataset.lengths, 16, shuffle=True),
+                        collate_fn=PaddingCollator(tokenizer.pad_token_id))
+"""
+from typing import Dict, Iterator, List, Sequence
+
+import numpy as np
+
+from token_cache import TokenCache
+
+# "truncate": keep the first tokens, as truncation=True (cuts the target line and variables of long inputs)
+# "keep_target": drop the start of the code context, so the target line and the variables stay
+# "window": one example per window of the code context, each with the target line and the variables
+FIT_STRATEGIES = ("truncate", "keep_target", "window")
+
+
+def fit_to_length(input_ids: np.ndarray, context_len: int, max_length: int, strategy: str = "keep_target",
+                  stride: int | None = None) -> List[np.ndarray]:
+    """
+    The examples made of the token ids of a data point (start token, code context, target line and variables,
+    end token), at most `max_length` long. Only "window" makes more than one, overlapping by `stride` tokens
+    of context (half the context room by default).
+    """
+    if strategy not in FIT_STRATEGIES:
+        raise ValueError(f"Unknown strategy {strategy!r}, expected one of {FIT_STRATEGIES}")
+    if len(input_ids) <= max_length:
+        return [input_ids]
+    start, end = input_ids[:1], input_ids[-1:]
+    context, tail = input_ids[1:context_len], input_ids[context_len:-1]
+    room = max_length - 2 - len(tail)
+    if strategy == "truncate" or room <= 0:
+        # the target line and the variables alone are too long: they are cut at the end
+        return [np.concatenate([input_ids[:max_length - 1], end])]
+    if strategy == "keep_target":
+        # the end of the context is the closest to the target line
+        return [np.concatenate([start, context[len(context) - room:], tail, end])]
+
+    step = max(room - (stride if stride is not None else room // 2), 1)
+    window_starts = list(range(0, len(context) - room, step)) + [len(context) - room]
+    return [np.concatenate([start, context[offset:offset + room], tail, end]) for offset in window_starts]
+
+
+class TokenDataset:
+    """
+    Examples of the data points of `entries` in a token cache, unpadded. With the "window" strategy a data point
+    can give several examples; `data_points[i]` is the index of the data point of example `i`.
+    """
+    def __init__(self, cache: TokenCache, entries: Sequence[int], labels: Sequence[int], max_length: int = 512,
+                 strategy: str = "keep_target", stride: int | None = None):
+        self.examples: List[np.ndarray] = []
+        data_points = []
+        context_lengths = cache.context_lengths(np.asarray(entries, dtype=np.int64))
+        for index, (entry, context_len) in enumerate(zip(entries, context_lengths)):
+            for example in fit_to_length(cache.input_ids(int(entry)), int(context_len), max_length, strategy, stride):
+                self.examples.append(example)
+                data_points.append(index)
+        self.data_points = np.asarray(data_points, dtype=np.int64)
+        self.labels = np.asarray(labels, dtype=np.int64)[self.data_points]
+        self.lengths = np.fromiter((len(example) for example in self.examples), dtype=np.int64, count=len(self.examples))
+
+    def __len__(self) -> int:
+        return len(self.examples)
+
+    def __getitem__(self, index: int) -> Dict:
+        return {"input_ids": self.examples[index], "labels": int(self.labels[index])}
+
+
+class LengthBucketSampler:
+    """
+    Batches of indices of examples with similar lengths, to pass as batch_sampler to a DataLoader.
+    Lengths are split into buckets of `bucket_width` tokens; with `shuffle`, the examples of a bucket and the order
+    of the batches change on every epoch, but a batch still only holds examples of one bucket.
+    """
+    def __init__(self, lengths: Sequence[int], batch_size: int, bucket_width: int = 32, shuffle: bool = False,
+                 drop_last: bool = False, seed: int = 0):
+        self.lengths = np.asarray(lengths, dtype=np.int64)
+        self.batch_size = batch_size
+        self.bucket_width = bucket_width
+        self.shuffle = shuffle
+        self.drop_last = drop_last
+        self.rng = np.random.default_rng(seed)
+
+    def batches(self) -> List[np.ndarray]:
+        buckets = self.lengths // self.bucket_width
+        # indices by bucket, shortest first; stable so that without shuffling the order is reproducible
+        if self.shuffle:
+            order = self.rng.permutation(len(self.lengths))
+            order = order[np.argsort(buckets[order], kind="stable")]
+        else:
+            order = np.argsort(buckets, kind="stable")
+        boundaries = np.flatnonzero(np.diff(buckets[order])) + 1
+        batches = []
+        for bucket in np.split(order, boundaries):
+            for start in range(0, len(bucket), self.batch_size):
+                batch = bucket[start:start + self.batch_size]
+                if len(batch) == self.batch_size or not self.drop_last:
+                    batches.append(batch)
+        if self.shuffle:
+            batches = [batches[index] for index in self.rng.permutation(len(batches))]
+        return batches
+
+    def __iter__(self) -> Iterator[List[int]]:
+        for batch in self.batches():
+            yield batch.tolist()
+
+    def __len__(self) -> int:
+        counts = np.bincount(self.lengths // self.bucket_width) if len(self.lengths) else np.zeros(0, dtype=np.int64)
+        if self.drop_last:
+            return int((counts // self.batch_size).sum())
+        return int(((counts + self.batch_size - 1) // self.batch_size).sum())
+
+
+class PaddingCollator:
+    """
+    Pads the input ids of a batch to its longest member (rounded up to `pad_to_multiple_of`), with the attention mask.
+    Returns torch tensors, or numpy arrays with return_tensors="np".
+    """
+    def __init__(self, pad_token_id: int, pad_to_multiple_of: int | None = None, return_tensors: str = "pt"):
+        self.pad_token_id = pad_token_id
+        self.pad_to_multiple_of = pad_to_multiple_of
+        self.return_tensors = return_tensors
+
+    def __call__(self, examples: List[Dict]) -> Dict:
+        length = max(len(example["input_ids"]) for example in examples)
+        if self.pad_to_multiple_of:
+            length = -(-length // self.pad_to_multiple_of) * self.pad_to_multiple_of
+        input_ids = np.full((len(examples), length), self.pad_token_id, dtype=np.int64)
+        attention_mask = np.zeros((len(examples), length), dtype=np.int64)
+        for row, example in enumerate(examples):
+            input_ids[row, :len(example["input_ids"])] = example["input_ids"]
+            attention_mask[row, :len(example["input_ids"])] = 1
+        batch = {
+            "input_ids": input_ids,
+            "attention_mask": attention_mask,
+            "labels": np.array([int(example["labels"]) for example in examples], dtype=np.int64),
+        }
+        if self.return_tensors == "pt":
+            import torch
+            batch = {name: torch.from_numpy(array) for name, array in batch.items()}
+        return batch
@@ -0,0 +1,145 @@
+"""
+CPU throughput of fixed padding against length buckets with dynamic padding.
+
+"fixed" pads every data point to --max-length as CodeTestDataset did (padding='max_length', truncation=True),
+in batches of consecutive data points; "bucketed" uses TokenDataset, LengthBucketSampler and PaddingCollator.
+For both, reports the share of padding and the time to build the batches, and with torch installed, the tokens
+per second of a small transformer encoder run over the batches on the CPU. The data points come from a token
+cache, or are synthetic, with lengths drawn like the ones of the requests history (median around 300 tokens,
+a tail over 512).
+
+    python benchmarks/bench_batching.py --cache token_cache --output bench_batching.json
+"""
+import argparse
+import json
+import platform
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+import numpy as np
+
+ROOT = Path(__file__).resolve().parents[1]
+sys.path.insert(0, str(ROOT))
+
+from batching import LengthBucketSampler, PaddingCollator, TokenDataset
+from token_cache import TokenCache, pad_and_truncate
+
+PAD_TOKEN_ID = 1
+
+
+def synthetic_cache(path: Path, count: int, seed: int) -> TokenCache:
+    rng = np.random.default_rng(seed)
+    lengths = np.clip(rng.lognormal(np.log(300), 0.6, count), 20, 4000).astype(np.int64)
+    context_lengths = np.minimum(rng.integers(60, 200, count), lengths - 10)
+    tokens = rng.integers(3, 50000, int(lengths.sum()))
+    cache = TokenCache(path)
+    keys = [rng.bytes(16) for _ in range(count)]
+    cache.append(keys, tokens, lengths, context_lengths, "synthetic")
+    return cache
+
+
+def fixed_batches(cache: TokenCache, entries: np.ndarray, batch_size: int, max_length: int):
+    collator = PaddingCollator(PAD_TOKEN_ID, return_tensors="np")
+    for start in range(0, len(entries), batch_size):
+        examples = []
+        for entry in entries[start:start + batch_size]:
+            input_ids, _ = pad_and_truncate(cache.input_ids(int(entry)), max_length, PAD_TOKEN_ID)
+            examples.append({"input_ids": input_ids, "labels": 0})
+        batch = collator(examples)
+        # the padding of pad_and_truncate is not attended to either
+        batch["attention_mask"] = (batch["input_ids"] != PAD_TOKEN_ID).astype(np.int64)
+        yield batch
+
+
+def bucketed_batches(cache: TokenCache, entries: np.ndarray, batch_size: int, max_length: int, strategy: str):
+    dataset = TokenDataset(cache, entries, np.zeros(len(entries), dtype=np.int64), max_length, strategy)
+    sampler = LengthBucketSampler(dataset.lengths, batch_size, shuffle=True)
+    collator = PaddingCollator(PAD_TOKEN_ID, return_tensors="np")
+    for indices in sampler:
+        yield collator([dataset[index] for index in indices])
+
+
+def make_model():
+    try:
+        import torch
+    except ImportError:
+        return None
+    torch.manual_seed(0)
+    embedding = torch.nn.Embedding(50265, 256, padding_idx=PAD_TOKEN_ID)
+    layer = torch.nn.TransformerEncoderLayer(256, 4, dim_feedforward=1024, batch_first=True)
+    encoder = torch.nn.TransformerEncoder(layer, 4, enable_nested_tensor=False).eval()
+
+    def forward(batch):
+        with torch.no_grad():
+            input_ids = torch.from_numpy(batch["input_ids"])
+            padding = torch.from_numpy(batch["attention_mask"] == 0)
+            encoder(embedding(input_ids), src_key_padding_mask=padding)
+    return forward
+
+
+def measure(batches, forward, limit: int | None) -> dict:
+    real = padded = count = 0
+    build = model = 0.0
+    iterator = iter(batches)
+    while limit is None or count < limit:
+        start = time.perf_counter()
+        batch = next(iterator, None)
+        build += time.perf_counter() - start
+        if batch is None:
+            break
+        real += int(batch["attention_mask"].sum())
+        padded += batch["input_ids"].size
+        count += 1
+        if forward:
+            start = time.perf_counter()
+            forward(batch)
+            model += time.perf_counter() - start
+    result = {"batches": count, "tokens": real, "padded_tokens": padded,
+              "padding_share": 1 - real / padded if padded else 0.0, "build_seconds": build}
+    if forward:
+        result["model_seconds"] = model
+        result["tokens_per_second"] = real / model if model else None
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--cache", type=Path, help="token cache to read; synthetic data points if not given")
+    parser.add_argument("--count", type=int, default=2000, help="synthetic data points")
+    parser.add_argument("--batch-size", type=int, default=16)
+    parser.add_argument("--max-length", type=int, default=512)
+    parser.add_argument("--strategy", default="keep_target")
+    parser.add_argument("--batches", type=int, default=None, help="batches run through the model, all by default")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", default="bench_batching.json")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        cache = TokenCache(args.cache) if args.cache else synthetic_cache(Path(tmp) / "cache", args.count, args.seed)
+        entries = np.arange(len(cache))
+        forward = make_model()
+        if forward is None:
+            print("torch is not installed: only the padding and the time to build batches are measured")
+        results = {
+            "fixed": measure(fixed_batches(cache, entries, args.batch_size, args.max_length), forward, args.batches),
+            "bucketed": measure(bucketed_batches(cache, entries, args.batch_size, args.max_length, args.strategy),
+                                forward, args.batches),
+        }
+
+    with open(args.output, "w") as f:
+        json.dump({"python": platform.python_version(), "parameters": {**vars(args), "cache": str(args.cache)},
+                   "results": results}, f, indent=2)
+
+    print(f"\n{'':<10}{'batches':>8}{'tokens':>10}{'padded':>10}{'padding':>9}{'build s':>9}{'tokens/s':>10}")
+    for name, result in results.items():
+        tokens_per_second = result.get("tokens_per_second")
+        print(f"{name:<10}{result['batches']:>8}{result['tokens']:>10}{result['padded_tokens']:>10}"
+              f"{100 * result['padding_share']:>8.1f}%{result['build_seconds']:>9.2f}"
+              f"{tokens_per_second if tokens_per_second is not None else float('nan'):>10.0f}")
+    print(f"Results written to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,217 @@
+"""
+Benchmark suite for the stages of the mining pipeline.
+
+Builds a synthetic git repository of `--modules` modules (each with a test file) and `--commits` commits,
+then times: walking the history (get_all_commits), classifying and diffing each commit pair
+(modifies_test_and_code, get_modified_lines), test collection (collect_tests), checkouts of consecutive
+commits (the former hard reset + forced checkout, and checkout_changed_paths), pytest runs of the
+stacktrace_test fixture with and without myplugin tracing, and the processing of whole commit pairs.
+Every stage is run `--repeat` times; the results are written as JSON to compare revisions.
+
+    python benchmarks/bench_pipeline.py --modules 50 --commits 200 --output bench_pipeline.json
+"""
+import argparse
+import importlib.util
+import json
+import platform
+import random
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parents[1]
+sys.path.insert(0, str(ROOT / "plugin"))
+sys.path.insert(0, str(ROOT))
+
+import pygit2
+
+from git_utils import (checkout_changed_paths, get_all_commits, get_modified_lines, load_or_plan_commit_pairs,
+                       modifies_test_and_code, skip_first)
+from test_utils import collect_tests, run_isolated, run_pytest
+
+FUNCTIONS_PER_MODULE = 20
+
+
+def module_source(module: int, version: int) -> str:
+    functions = []
+    for function in range(FUNCTIONS_PER_MODULE):
+        functions.append(f"def f{function}(a, b):\n"
+                         f"    c = a * {function + 1}\n"
+                         f"    for i in range(b):\n"
+                         f"        c += i % {function + 2}\n"
+                         f"    return c + {version}\n")
+    return "\n\n".join(functions)
+
+
+def test_source(module: int, version: int) -> str:
+    tests = [f"from pkg.mod{module} import *\n"]
+    for function in range(FUNCTIONS_PER_MODULE):
+        tests.append(f"def test_f{function}():\n"
+                     f"    assert f{function}(1, 3) >= {version}\n")
+    return "\n\n".join(tests)
+
+
+def make_synthetic_repo(path: Path, modules: int, commits: int, seed: int = 0) -> pygit2.Repository:
+    """
+    A repository where every commit changes one module; one commit in three also changes its test file.
+    """
+    rng = random.Random(seed)
+    repo = pygit2.init_repository(str(path), initial_head="main")
+    files = {"conftest.py": "", "pkg/__init__.py": ""}
+    for module in range(modules):
+        files[f"pkg/mod{module}.py"] = module_source(module, 0)
+        files[f"tests/test_mod{module}.py"] = test_source(module, 0)
+
+    for version in range(commits):
+        if version > 0:
+            module = rng.randrange(modules)
+            files = {f"pkg/mod{module}.py": module_source(module, version)}
+            if version % 3 == 0:
+                files[f"tests/test_mod{module}.py"] = test_source(module, version)
+        for name, content in files.items():
+            file_path = path / name
+            file_path.parent.mkdir(parents=True, exist_ok=True)
+            file_path.write_text(content)
+        repo.index.add_all()
+        repo.index.write()
+        tree = repo.index.write_tree()
+        signature = pygit2.Signature("bench", "bench@example.com", 1_600_000_000 + 100 * version, 0)
+        parents = [] if repo.head_is_unborn else [repo.head.target]
+        repo.create_commit("HEAD", signature, signature, f"commit {version}", tree, parents)
+    return repo
+
+
+def full_checkout(repo, commit):
+    # my_checkout before checkout_changed_paths
+    repo.reset(commit.id, pygit2.GIT_RESET_HARD)
+    repo.checkout_tree(commit.tree, strategy=pygit2.GIT_CHECKOUT_FORCE)
+    repo.set_head(commit.id)
+
+
+def load_pipeline():
+    # __main__.py can't be imported by its name
+    spec = importlib.util.spec_from_file_location("pipeline", ROOT / "__main__.py")
+    pipeline = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(pipeline)
+    return pipeline
+
+
+def measure(function, repeat: int, items: int = 1) -> dict:
+    runs = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        runs.append(time.perf_counter() - start)
+    median = statistics.median(runs)
+    return {"seconds": median, "runs": runs, "items": items, "ms_per_item": 1000 * median / items}
+
+
+def bench_history(repo, repeat: int) -> dict:
+    commits = list(get_all_commits(repo))
+    test_files = {f"tests/{path.name}" for path in Path(repo.workdir, "tests").iterdir()}
+
+    def diff_all():
+        for commit in skip_first(get_all_commits(repo)):
+            diff = repo.diff(commit.parents[0], commit)
+            modifies_test_and_code(diff, test_files)
+            get_modified_lines(diff)
+
+    return {
+        "walk": measure(lambda: list(get_all_commits(repo)), repeat, len(commits)),
+        "diff": measure(diff_all, repeat, len(commits) - 1),
+    }
+
+
+def bench_checkout(repo, repeat: int) -> dict:
+    commits = list(get_all_commits(repo))
+
+    def walk_with(checkout):
+        for commit in commits:
+            checkout(repo, commit)
+
+    results = {
+        "checkout_full": measure(lambda: walk_with(full_checkout), repeat, len(commits)),
+        "checkout_incremental": measure(lambda: walk_with(checkout_changed_paths), repeat, len(commits)),
+    }
+    full_checkout(repo, commits[-1])
+    return results
+
+
+def bench_tracing(work_path: Path, repeat: int) -> dict:
+    # the fixture without its conftest.py, which installs a tracer of its own
+    shutil.copytree(ROOT / "stacktrace_test" / "src", work_path / "src", ignore=shutil.ignore_patterns("__pycache__"))
+    shutil.copy(ROOT / "stacktrace_test" / "test.py", work_path / "test_sum.py")
+    options = ["-q", "-p", "no:cacheprovider", "--rootdir", str(work_path), str(work_path / "test_sum.py")]
+    traced = ["-p", "myplugin", "--trace-lines", "src/sum.py:2,5-8", "--trace-output", str(work_path / "result.jsonl")]
+    return {
+        "pytest_untraced": measure(lambda: run_isolated(run_pytest, ["-p", "no:myplugin"] + options), repeat),
+        "pytest_traced": measure(lambda: run_isolated(run_pytest, traced + options), repeat),
+    }
+
+
+def bench_pairs(repo, work_path: Path, pairs: int) -> dict:
+    pipeline = load_pipeline()
+    plan = load_or_plan_commit_pairs(repo, work_path / "plan.json")[:pairs]
+    processor = pipeline.CommitPairProcessor(repo, Path(repo.workdir), work_path / "data", work_path / "state", work_path)
+    statuses = []
+
+    def process_all():
+        # the discovery and footprint caches are warm after the first pair, as in a long run
+        for entry in plan:
+            statuses.append(processor.process(entry)["status"])
+
+    result = measure(process_all, 1, max(len(plan), 1))
+    result["statuses"] = statuses
+    return result
+
+
+def revision() -> str | None:
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], cwd=ROOT, capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--modules", type=int, default=20)
+    parser.add_argument("--commits", type=int, default=50)
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--pairs", type=int, default=3, help="commit pairs processed end to end")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", default="bench_pipeline.json")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        tmp = Path(tmp)
+        repo = make_synthetic_repo(tmp / "code", args.modules, args.commits, args.seed)
+        stages = bench_history(repo, args.repeat)
+        stages["collect_tests"] = measure(lambda: collect_tests(["-p", "no:myplugin", "-p", "no:cacheprovider", str(tmp / "code")]),
+                                          args.repeat, args.modules)
+        stages.update(bench_checkout(repo, args.repeat))
+        (tmp / "tracing").mkdir()
+        stages.update(bench_tracing(tmp / "tracing", args.repeat))
+        stages["process_pair"] = bench_pairs(repo, tmp, args.pairs)
+
+    result = {
+        "revision": revision(),
+        "python": platform.python_version(),
+        "pygit2": pygit2.__version__,
+        "parameters": vars(args),
+        "stages": stages,
+    }
+    with open(args.output, "w") as f:
+        json.dump(result, f, indent=2)
+
+    print(f"\n{'stage':<22}{'median s':>10}{'items':>8}{'ms/item':>10}")
+    for name, stage in stages.items():
+        print(f"{name:<22}{stage['seconds']:>10.3f}{stage['items']:>8}{stage['ms_per_item']:>10.2f}")
+    print(f"Results written to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,154 @@
+"""
+Micro-benchmark for the tracing hot path of myplugin.
+
+Runs a synthetic workload modelled on stacktrace_test/src/sum.py (a tracked module plus an
+untracked helper module) under sys.settrace and reports trace events per second for the
+previous Path.match-in-a-loop implementation and for the current InterestingLinesIndex one.
+Rates and the speedup are computed from the tracing overhead: the traced time minus the untraced run.
+
+    python benchmarks/bench_trace_function.py --iterations 20000
+"""
+import argparse
+import importlib
+import linecache
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1] / "plugin"))
+
+from myplugin import plugin_module
+from myplugin.recorder import TraceRecorder
+
+TRACKED_SOURCE = '''def sum(num1, num2):
+    return num1 + num2
+
+def sum_only_positive(num1, num2):
+    if num1 > 0 and num2 > 0:
+        return num1 + num2
+    elif num1 > 0:
+        return num1
+    elif num2 > 0:
+        return num2
+    return None
+'''
+
+UNTRACKED_SOURCE = '''def clamp(value, low, high):
+    if value < low:
+        return low
+    if value > high:
+        return high
+    return value
+
+def checksum(values):
+    total = 0
+    for value in values:
+        total = (total * 31 + value) % 1000003
+    return total
+'''
+
+# a few tracked lines, plus unrelated entries like a real diff would have
+INTERESTING_LINES = {
+    "src/sum.py": {2, 5, 6},
+    "tests/test_sum.py": set(range(1, 40)),
+    "requests/auth.py": set(range(15, 48)),
+}
+
+
+def make_workload(root: Path):
+    for package, name, source in (("src", "sum", TRACKED_SOURCE), ("lib", "helpers", UNTRACKED_SOURCE)):
+        package_dir = root / package
+        package_dir.mkdir(parents=True, exist_ok=True)
+        (package_dir / "__init__.py").write_text("")
+        (package_dir / f"{name}.py").write_text(source)
+    sys.path.insert(0, str(root))
+    tracked = importlib.import_module("src.sum")
+    helpers = importlib.import_module("lib.helpers")
+
+    def workload(iterations):
+        for i in range(iterations):
+            a = helpers.clamp(i % 7 - 3, -2, 2)
+            tracked.sum_only_positive(a, i % 3)
+            tracked.sum(a, i)
+            helpers.checksum(range(8))
+
+    return workload
+
+
+class LegacyTraceFunction:
+    """The hot path before InterestingLinesIndex: a Path and a Path.match loop for every event."""
+    def __init__(self, interesting_lines, max_previous_lines=10):
+        self.interesting_lines = interesting_lines
+        self.previous_lines = []
+        self.max_previous_lines = max_previous_lines
+        self.hits = 0
+
+    def __call__(self, frame, event, arg):
+        if event in ('line', 'call') and frame.f_code.co_name != "<module>":
+            filename = frame.f_code.co_filename
+            file_path = Path(filename)
+            lineno = frame.f_lineno
+            current_line = linecache.getline(filename, lineno).strip()
+            for file, lines in self.interesting_lines.items():
+                if file_path.match(file) and lineno in lines:
+                    self.hits += 1
+            if current_line:
+                self.previous_lines.append(current_line)
+                if len(self.previous_lines) > self.max_previous_lines:
+                    self.previous_lines.pop(0)
+        return self
+
+
+class CountingTraceFunction:
+    def __init__(self):
+        self.events = 0
+
+    def __call__(self, frame, event, arg):
+        self.events += 1
+        return self
+
+
+def run_traced(trace, workload, iterations) -> float:
+    start = time.perf_counter()
+    sys.settrace(trace)
+    try:
+        workload(iterations)
+    finally:
+        sys.settrace(None)
+    return time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--iterations", type=int, default=20000)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        workload = make_workload(Path(tmp))
+
+        # the number of events the untouched workload generates is the same for every tracer
+        counter = CountingTraceFunction()
+        run_traced(counter, workload, args.iterations)
+        events = counter.events
+
+        start = time.perf_counter()
+        workload(args.iterations)
+        untraced = time.perf_counter() - start
+
+        legacy = run_traced(LegacyTraceFunction(INTERESTING_LINES), workload, args.iterations)
+        recorder = TraceRecorder(Path(tmp) / "result.jsonl")
+        indexed = run_traced(plugin_module.TraceFunction(recorder, interesting_lines=INTERESTING_LINES), workload, args.iterations)
+        recorder.close()
+
+    # the workload itself costs the same under every tracer, so only the overhead measures the hot path
+    legacy_overhead = max(legacy - untraced, 1e-9)
+    indexed_overhead = max(indexed - untraced, 1e-9)
+    print(f"{events} trace events, untraced run {untraced:.3f}s")
+    print(f"before (Path.match loop):      {legacy:.3f}s, overhead {legacy_overhead:.3f}s  {events / legacy_overhead:,.0f} events/s")
+    print(f"after  (InterestingLinesIndex): {indexed:.3f}s, overhead {indexed_overhead:.3f}s  {events / indexed_overhead:,.0f} events/s")
+    print(f"speedup: {legacy_overhead / indexed_overhead:.1f}x")
+
+
+if __name__ == "__main__":
+    main()
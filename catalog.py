@@ -0,0 +1,310 @@
+"""
+SQLite catalog of the mined results: one row per commit pair, per tracked line and per trace record.
+
+process_repos adds the pairs it plans as pending, marks them running while they are processed, and records every
+pair it finishes, with the lines it tracked and where each trace record sits
+in the payload files (data/<repo>/<commit>/*.jsonl, as byte offset and length), so resume checks, dataset
+building and analysis are indexed queries instead of walks over data/. The database is in WAL mode,
+so several runs can update it at once while others read it. A payload file of references (see myplugin.objects)
+is indexed by reference, with the number of records it stands for.
+
+    python catalog.py index data              # catalog results mined before the catalog existed
+    python catalog.py stats
+    python catalog.py query "SELECT status, count(*) FROM pairs GROUP BY status"
+"""
+import argparse
+import json
+import sqlite3
+import time
+from pathlib import Path
+from typing import Dict, Iterable, Iterator, List, Set, Tuple
+
+from dataset_store import EXAMPLE_LABELS
+from git_utils import PLAN_VERSION
+from myplugin.intervals import iter_lines
+from myplugin.objects import read_records
+
+CATALOG_PATH = Path("catalog.sqlite")
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS pairs (
+    repo TEXT NOT NULL,
+    parent TEXT NOT NULL,
+    child TEXT NOT NULL,
+    commit_time INTEGER,
+    -- pending, running, done, skipped or failed, and why
+    status TEXT NOT NULL,
+    reason TEXT,
+    duration REAL,
+    updated REAL NOT NULL,
+    PRIMARY KEY (repo, parent)
+);
+CREATE INDEX IF NOT EXISTS pairs_status ON pairs (repo, status);
+CREATE TABLE IF NOT EXISTS examples (
+    repo TEXT NOT NULL,
+    parent TEXT NOT NULL,
+    -- 0 for the negative example, traced at the parent, 1 for the positive one, traced at the child
+    label INTEGER NOT NULL,
+    path TEXT NOT NULL,
+    bytes INTEGER NOT NULL,
+    records INTEGER NOT NULL,
+    PRIMARY KEY (repo, parent, label)
+);
+CREATE TABLE IF NOT EXISTS lines (
+    repo TEXT NOT NULL,
+    parent TEXT NOT NULL,
+    label INTEGER NOT NULL,
+    -- relative to the repository
+    file TEXT NOT NULL,
+    line INTEGER NOT NULL,
+    records INTEGER NOT NULL,
+    PRIMARY KEY (repo, parent, label, file, line)
+);
+CREATE INDEX IF NOT EXISTS lines_file ON lines (repo, file, line);
+CREATE TABLE IF NOT EXISTS records (
+    repo TEXT NOT NULL,
+    parent TEXT NOT NULL,
+    label INTEGER NOT NULL,
+    file TEXT NOT NULL,
+    line INTEGER NOT NULL,
+    offset INTEGER NOT NULL,
+    length INTEGER NOT NULL,
+    -- records a reference stands for, 1 for a plain record
+    count INTEGER NOT NULL DEFAULT 1
+);
+CREATE INDEX IF NOT EXISTS records_example ON records (repo, parent, label);
+CREATE INDEX IF NOT EXISTS records_line ON records (repo, file, line);
+"""
+
+# (file, line, offset, length, count) of each record or reference of a payload file
+RecordIndex = List[Tuple[str, int, int, int, int]]
+
+
+class Catalog:
+    """
+    A connection to the catalog, created if needed. Each process opens its own.
+    """
+    def __init__(self, path: Path = CATALOG_PATH, timeout: float = 60.0):
+        self.path = Path(path)
+        self.connection = sqlite3.connect(self.path, timeout=timeout)
+        self.connection.row_factory = sqlite3.Row
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+        with self.connection:
+            self.connection.executescript(SCHEMA)
+
+    def close(self):
+        self.connection.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, traceback):
+        self.close()
+
+    def record_pair(self, repo: str, entry: Dict, status: str, duration: float | None = None,
+                    examples: Dict[int, Tuple[Path, RecordIndex]] | None = None):
+        """
+        Replaces what is known of a pair: its status ("done", "skipped: <reason>" or "failed: <reason>"),
+        and for each label, the payload file, the tracked lines and the index of its records.
+        Everything is written in one transaction, so readers see a pair complete or not at all.
+        """
+        parent = entry["parent"]
+        state, _, reason = status.partition(": ")
+        with self.connection:
+            for table in ("examples", "lines", "records"):
+                self.connection.execute(f"DELETE FROM {table} WHERE repo = ? AND parent = ?", (repo, parent))
+            self.connection.execute(
+                "INSERT OR REPLACE INTO pairs VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                (repo, parent, entry["child"], entry.get("commit_time"), state, reason or None, duration, time.time()))
+            for label, (path, index) in (examples or {}).items():
+                self.connection.execute("INSERT INTO examples VALUES (?, ?, ?, ?, ?, ?)",
+                                        (repo, parent, label, str(path), Path(path).stat().st_size,
+                                         sum(record[4] for record in index)))
+                self.connection.executemany("INSERT INTO records VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                                            ((repo, parent, label, *record) for record in index))
+                counts = {}
+                for file, line, _, _, count in index:
+                    counts[file, line] = counts.get((file, line), 0) + count
+                tracked = entry.get("modified_lines", {}).get("old" if label == 0 else "new", {})
+                for file, intervals in tracked.items():
+                    for line in iter_lines(intervals):
+                        counts.setdefault((file, line), 0)
+                self.connection.executemany("INSERT INTO lines VALUES (?, ?, ?, ?, ?, ?)",
+                                            ((repo, parent, label, file, line, count) for (file, line), count in counts.items()))
+
+    def add_pending(self, repo: str, entries: Iterable[Dict]):
+        """
+        Adds the pairs of `entries` that the catalog doesn't have yet, as pending.
+        """
+        now = time.time()
+        with self.connection:
+            self.connection.executemany(
+                "INSERT OR IGNORE INTO pairs VALUES (?, ?, ?, ?, 'pending', NULL, NULL, ?)",
+                ((repo, entry["parent"], entry["child"], entry.get("commit_time"), now) for entry in entries))
+
+    def set_running(self, repo: str, parent: str):
+        with self.connection:
+            self.connection.execute("UPDATE pairs SET status = 'running', reason = NULL, updated = ? WHERE repo = ? AND parent = ?",
+                                    (time.time(), repo, parent))
+
+    def finished(self, repo: str) -> Set[str]:
+        """
+        Parents of the pairs of `repo` that don't need to run again: done, or skipped as not a bugfix.
+        Failed pairs are retried, as are the pending ones and those left running by an interrupted run.
+        """
+        rows = self.connection.execute("SELECT parent FROM pairs WHERE repo = ? AND status IN ('done', 'skipped')", (repo,))
+        return {row["parent"] for row in rows}
+
+    def pairs(self, repo: str | None = None, status: str | None = None) -> List[sqlite3.Row]:
+        query, parameters = "SELECT * FROM pairs WHERE 1", []
+        if repo is not None:
+            query += " AND repo = ?"
+            parameters.append(repo)
+        if status is not None:
+            query += " AND status = ?"
+            parameters.append(status)
+        return self.connection.execute(query + " ORDER BY commit_time", parameters).fetchall()
+
+    def examples(self, repo: str | None = None, label: int | None = None) -> List[sqlite3.Row]:
+        """
+        Payload files of the done pairs, oldest first.
+        """
+        query = ("SELECT examples.*, pairs.child, pairs.commit_time FROM examples JOIN pairs USING (repo, parent)"
+                 " WHERE pairs.status = 'done'")
+        parameters = []
+        if repo is not None:
+            query += " AND examples.repo = ?"
+            parameters.append(repo)
+        if label is not None:
+            query += " AND examples.label = ?"
+            parameters.append(label)
+        return self.connection.execute(query + " ORDER BY pairs.commit_time, examples.label", parameters).fetchall()
+
+    def read_records(self, repo: str, parent: str, label: int, file: str | None = None,
+                     line: int | None = None) -> Iterator[Dict]:
+        """
+        The records of an example, or of one of its files or lines, read at their offsets in the payload file,
+        with references expanded.
+        """
+        example = self.connection.execute("SELECT path FROM examples WHERE repo = ? AND parent = ? AND label = ?",
+                                          (repo, parent, label)).fetchone()
+        if example is None:
+            return
+        query = "SELECT offset, length FROM records WHERE repo = ? AND parent = ? AND label = ?"
+        parameters = [repo, parent, label]
+        if file is not None:
+            query += " AND file = ?"
+            parameters.append(file)
+        if line is not None:
+            query += " AND line = ?"
+            parameters.append(line)
+        with open(example["path"], "rb") as f:
+            # the header of a file of references, if any, is needed to expand them
+            lines = [f.readline().decode()]
+            for row in self.connection.execute(query + " ORDER BY offset", parameters).fetchall():
+                f.seek(row["offset"])
+                lines.append(f.read(row["length"]).decode())
+        if lines[0].strip() and "objects" not in json.loads(lines[0]):
+            lines = lines[1:]
+        yield from read_records(Path(example["path"]), lines)
+
+    def stats(self) -> Dict:
+        one = lambda query: self.connection.execute(query).fetchone()[0]
+        return {
+            "pairs": {row["status"]: row["count"] for row in
+                      self.connection.execute("SELECT status, count(*) AS count FROM pairs GROUP BY status")},
+            "examples": one("SELECT count(*) FROM examples"),
+            "bytes": one("SELECT coalesce(sum(bytes), 0) FROM examples"),
+            "tracked_lines": one("SELECT count(*) FROM lines"),
+            "hit_lines": one("SELECT count(*) FROM lines WHERE records > 0"),
+            "references": one("SELECT count(*) FROM records"),
+            "records": one("SELECT coalesce(sum(count), 0) FROM records"),
+        }
+
+
+def index_payload(path: Path, repo_path: Path | None = None) -> RecordIndex:
+    """
+    The index of a JSON Lines trace file; file names are made relative to `repo_path` when under it.
+    """
+    index = []
+    offset = 0
+    with open(path, "rb") as f:
+        for raw in f:
+            if raw.strip():
+                record = json.loads(raw)
+                # the header of a file of references isn't a record
+                if "file" in record:
+                    index.append((relative_file(record["file"], repo_path), record["line"], offset, len(raw),
+                                  record.get("count", 1)))
+            offset += len(raw)
+    return index
+
+
+def relative_file(file: str, repo_path: Path | None) -> str:
+    path = Path(file)
+    if repo_path is not None and path.is_relative_to(repo_path):
+        return path.relative_to(repo_path).as_posix()
+    return file
+
+
+def index_data_dir(catalog: Catalog, data_path: Path, repos_path: Path = Path('Repos'),
+                   repo_names: Iterable[str] | None = None) -> int:
+    """
+    Adds the pairs of data/<repo>/<commit>/ missing from the catalog, as done; returns how many were added.
+    Older result.json payloads have no byte offsets and are left out.
+    """
+    added = 0
+    for repo_dir in sorted(data_path.iterdir()):
+        if not repo_dir.is_dir() or (repo_names is not None and repo_dir.name not in repo_names):
+            continue
+        repo_path = (repos_path / repo_dir.name / "code").absolute()
+        plan = {}
+        plan_path = repos_path / repo_dir.name / "plan.json"
+        if plan_path.exists():
+            with open(plan_path) as f:
+                saved = json.load(f)
+            # the modified lines of older plans are lists of line numbers
+            if saved.get("version") == PLAN_VERSION:
+                plan = {entry["parent"]: entry for entry in saved["pairs"]}
+        known = {row["parent"] for row in catalog.pairs(repo_dir.name)}
+        for commit_dir in sorted(repo_dir.iterdir()):
+            # the .tmp directories of pairs in progress are left out
+            if not commit_dir.is_dir() or commit_dir.suffix == ".tmp" or commit_dir.name in known:
+                continue
+            examples = {}
+            for name, label in EXAMPLE_LABELS.items():
+                path = commit_dir / f"{name}.jsonl"
+                if path.exists():
+                    examples[label] = (path, index_payload(path, repo_path))
+            entry = plan.get(commit_dir.name, {"parent": commit_dir.name, "child": None})
+            catalog.record_pair(repo_dir.name, {**entry, "child": entry.get("child") or ""}, "done", examples=examples)
+            added += 1
+    return added
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--catalog", type=Path, default=CATALOG_PATH)
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    index = subparsers.add_parser("index", help="catalog the results of a data directory")
+    index.add_argument("data", type=Path)
+    index.add_argument("--repos", type=Path, default=Path('Repos'))
+    subparsers.add_parser("stats", help="print the size of the catalog")
+    query = subparsers.add_parser("query", help="run an SQL query")
+    query.add_argument("sql")
+    args = parser.parse_args()
+
+    with Catalog(args.catalog) as catalog:
+        if args.command == "index":
+            print(f"Added {index_data_dir(catalog, args.data, args.repos)} commit pairs")
+        elif args.command == "stats":
+            for name, value in catalog.stats().items():
+                print(f"{name}: {value}")
+        else:
+            for row in catalog.connection.execute(args.sql):
+                print(tuple(row))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,463 @@
+"""
+Columnar store of the mined trace records, instead of one pair of JSON files per commit under data/.
+
+Every string (repository, commit, file path, source line, variable name and repr) is interned once in a string table,
+and records are rows of fixed-width integer columns referring to it; the code context and the variables of a record
+are runs in list columns. Records point to the source file they were traced in by blob id: each blob is stored once,
+as a run of interned lines, and code windows around the traced lines are cut from there (see code_windows). All files are raw little-endian arrays that are memory-mapped when read, so filtering
+by repository, commit or label only touches those columns. New commits are appended in place: meta.json holds
+the committed lengths, so an interrupted append is simply ignored and truncated by the next writer.
+
+    python dataset_store.py convert data dataset
+    python dataset_store.py stats dataset
+"""
+import argparse
+import json
+import os
+from pathlib import Path
+from typing import Dict, Iterable, Iterator, List, Set, Tuple
+
+import numpy as np
+import pygit2
+
+from myplugin.objects import read_records
+
+# one entry per record
+COLUMNS = {
+    "repo": np.dtype("<i4"),
+    "commit": np.dtype("<i4"),
+    "label": np.dtype("<i1"),
+    "file": np.dtype("<i4"),
+    "line": np.dtype("<i4"),
+    "target_line": np.dtype("<i4"),
+    "context_start": np.dtype("<i8"),
+    "context_len": np.dtype("<i4"),
+    "variables_start": np.dtype("<i8"),
+    "variables_len": np.dtype("<i4"),
+    # index in the blob columns, -1 when the source is unknown
+    "blob": np.dtype("<i4"),
+}
+# one entry per source blob
+BLOB_COLUMNS = {
+    "blob_oid": np.dtype("<i4"),
+    "blob_lines_start": np.dtype("<i8"),
+    "blob_lines_len": np.dtype("<i4"),
+}
+# runs referenced by the *_start and *_len columns, as string ids
+LIST_COLUMNS = {
+    "context": np.dtype("<i4"),
+    "variable_names": np.dtype("<i4"),
+    "variable_values": np.dtype("<i4"),
+    "blob_lines": np.dtype("<i4"),
+}
+STRING_OFFSETS = np.dtype("<i8")
+FORMAT_VERSION = 2
+
+EXAMPLE_LABELS = {"negative_example": 0, "positive_example": 1}
+
+
+def _read_array(path: Path, dtype: np.dtype, length: int) -> np.ndarray:
+    if length == 0:
+        return np.empty(0, dtype)
+    return np.memmap(path, dtype=dtype, mode="r", shape=(length,))
+
+
+class DatasetStore:
+    """
+    Read-only view of a store directory, as of the last committed append.
+    """
+    def __init__(self, path: Path):
+        self.path = Path(path)
+        with open(self.path / "meta.json") as f:
+            self.meta = json.load(f)
+        if self.meta["version"] != FORMAT_VERSION:
+            raise ValueError(f"{self.path} has format version {self.meta['version']}, expected {FORMAT_VERSION}: convert the data again")
+        self._columns: Dict[str, np.ndarray] = {}
+        self._strings: Dict[int, str] = {}
+        self.string_offsets = _read_array(self.path / "strings.offsets", STRING_OFFSETS, self.meta["strings"] + 1)
+        self.string_data = _read_array(self.path / "strings.bin", np.dtype("u1"), int(self.string_offsets[-1]))
+
+    def __len__(self) -> int:
+        return self.meta["rows"]
+
+    def column(self, name: str) -> np.ndarray:
+        if name not in self._columns:
+            if name in COLUMNS:
+                self._columns[name] = _read_array(self.path / f"{name}.col", COLUMNS[name], self.meta["rows"])
+            elif name in BLOB_COLUMNS:
+                self._columns[name] = _read_array(self.path / f"{name}.col", BLOB_COLUMNS[name], self.meta["blobs"])
+            else:
+                self._columns[name] = _read_array(self.path / f"{name}.col", LIST_COLUMNS[name], self.meta["lengths"][name])
+        return self._columns[name]
+
+    def string(self, string_id: int) -> str:
+        text = self._strings.get(string_id)
+        if text is None:
+            start, end = self.string_offsets[string_id], self.string_offsets[string_id + 1]
+            text = self._strings[string_id] = self.string_data[start:end].tobytes().decode("utf-8", errors="surrogatepass")
+        return text
+
+    def string_id(self, text: str) -> int | None:
+        """
+        The id of an interned string, found by scanning the table; meant for the few values used in filters.
+        """
+        encoded = text.encode("utf-8", errors="surrogatepass")
+        lengths = np.diff(self.string_offsets)
+        for string_id in np.flatnonzero(lengths == len(encoded)):
+            if self.string_data[self.string_offsets[string_id]:self.string_offsets[string_id + 1]].tobytes() == encoded:
+                return int(string_id)
+        return None
+
+    def commits(self) -> Set[Tuple[str, str]]:
+        return {tuple(key.split("/", 1)) for key in self.meta["commits"]}
+
+    def select(self, repo: str | None = None, commit: str | None = None, label: int | None = None) -> np.ndarray:
+        """
+        Indices of the rows matching all the given filters, reading only the filtered columns.
+        """
+        mask = np.ones(len(self), dtype=bool)
+        for name, value in (("repo", repo), ("commit", commit)):
+            if value is not None:
+                string_id = self.string_id(value)
+                if string_id is None:
+                    return np.empty(0, dtype=np.int64)
+                mask &= self.column(name) == string_id
+        if label is not None:
+            mask &= self.column("label") == label
+        return np.flatnonzero(mask)
+
+    def records(self, rows: Iterable[int] | None = None) -> Iterator[Dict]:
+        """
+        The rows as dicts in the layout of the trace files, with the repository, commit and label they belong to.
+        """
+        if rows is None:
+            rows = range(len(self))
+        columns = {name: self.column(name) for name in COLUMNS}
+        context = self.column("context")
+        variable_names = self.column("variable_names")
+        variable_values = self.column("variable_values")
+        for row in rows:
+            context_start = int(columns["context_start"][row])
+            variables_start = int(columns["variables_start"][row])
+            variables_end = variables_start + int(columns["variables_len"][row])
+            yield {
+                "repo": self.string(int(columns["repo"][row])),
+                "commit": self.string(int(columns["commit"][row])),
+                "label": int(columns["label"][row]),
+                "file": self.string(int(columns["file"][row])),
+                "line": int(columns["line"][row]),
+                "code_context": [self.string(int(string_id))
+                                 for string_id in context[context_start:context_start + int(columns["context_len"][row])]],
+                "target_line": self.string(int(columns["target_line"][row])),
+                "variables": {self.string(int(name)): self.string(int(value))
+                              for name, value in zip(variable_names[variables_start:variables_end],
+                                                     variable_values[variables_start:variables_end])},
+            }
+
+    def code_windows(self, rows: Iterable[int], window_size: int = 5) -> List[Tuple[str, str] | None]:
+        """
+        For each row, the lines within `window_size` of its traced line and the stripped traced line,
+        as get_code_context in the notebook; None where the source blob is unknown or shorter.
+        All windows are gathered with one vectorized lookup in the interned blob lines.
+        """
+        rows = np.asarray(rows, dtype=np.int64)
+        if len(rows) == 0:
+            return []
+        blobs = self.column("blob")[rows].astype(np.int64)
+        lines = self.column("line")[rows].astype(np.int64)
+        known = blobs >= 0
+        if self.meta["blobs"]:
+            known_blobs = np.where(known, blobs, 0)
+            starts = self.column("blob_lines_start")[known_blobs].astype(np.int64)
+            lengths = self.column("blob_lines_len")[known_blobs].astype(np.int64)
+        else:
+            starts = lengths = np.zeros(len(rows), dtype=np.int64)
+        known &= (lines >= 1) & (lines <= lengths)
+
+        window_starts = np.maximum(lines - window_size - 1, 0)
+        window_ends = np.minimum(lines + window_size, lengths)
+        counts = np.where(known, window_ends - window_starts, 0)
+        ends = np.cumsum(counts)
+        # position in blob_lines of every line of every window
+        positions = np.repeat(starts + window_starts - (ends - counts), counts) + np.arange(ends[-1])
+        blob_lines = self.column("blob_lines")
+        line_ids = blob_lines[positions]
+        target_ids = blob_lines[np.where(known, starts + lines - 1, 0)] if len(blob_lines) else np.zeros(len(rows), dtype=np.int64)
+
+        # each distinct line is decoded once
+        unique_ids, inverse = np.unique(line_ids, return_inverse=True)
+        texts = [self.string(int(string_id)) for string_id in unique_ids]
+        window_lines = [texts[index] for index in inverse]
+        windows = []
+        for i in range(len(rows)):
+            if not known[i]:
+                windows.append(None)
+                continue
+            windows.append(('\n'.join(window_lines[ends[i] - counts[i]:ends[i]]), self.string(int(target_ids[i])).strip()))
+        return windows
+
+
+class DatasetWriter:
+    """
+    Appends the records of whole commits to a store directory, creating it if needed.
+    Rows are buffered and written by flush(), which also commits them to meta.json; the writer is a context manager.
+    Only one writer may use a store at a time.
+    """
+    def __init__(self, path: Path, flush_rows: int = 100000):
+        self.path = Path(path)
+        self.path.mkdir(parents=True, exist_ok=True)
+        self.flush_rows = flush_rows
+        meta_path = self.path / "meta.json"
+        if meta_path.exists():
+            with open(meta_path) as f:
+                self.meta = json.load(f)
+        else:
+            self.meta = {"version": FORMAT_VERSION, "rows": 0, "strings": 0, "blobs": 0,
+                         "lengths": {name: 0 for name in LIST_COLUMNS}, "commits": []}
+        if self.meta["version"] != FORMAT_VERSION:
+            raise ValueError(f"{self.path} has format version {self.meta['version']}, expected {FORMAT_VERSION}: convert the data again")
+        self._truncate_uncommitted()
+
+        store = DatasetStore(self.path) if meta_path.exists() else None
+        self.string_ids: Dict[str, int] = {}
+        for string_id in range(self.meta["strings"]):
+            self.string_ids[store.string(string_id)] = string_id
+        self.string_end = int(store.string_offsets[-1]) if store else 0
+        self.blob_ids: Dict[str, int] = {}
+        if store:
+            for blob_id, string_id in enumerate(store.column("blob_oid")):
+                self.blob_ids[store.string(int(string_id))] = blob_id
+        self.committed_commits = set(self.meta["commits"])
+        self._reset_buffers()
+
+    def _file_lengths(self) -> Dict[str, int]:
+        lengths = {f"{name}.col": self.meta["rows"] * dtype.itemsize for name, dtype in COLUMNS.items()}
+        for name, dtype in BLOB_COLUMNS.items():
+            lengths[f"{name}.col"] = self.meta["blobs"] * dtype.itemsize
+        for name, dtype in LIST_COLUMNS.items():
+            lengths[f"{name}.col"] = self.meta["lengths"][name] * dtype.itemsize
+        lengths["strings.offsets"] = (self.meta["strings"] + 1) * STRING_OFFSETS.itemsize
+        return lengths
+
+    def _truncate_uncommitted(self):
+        for name, length in self._file_lengths().items():
+            path = self.path / name
+            if not path.exists():
+                path.touch()
+            if path.stat().st_size > length:
+                os.truncate(path, length)
+        if self.meta["strings"] == 0 and (self.path / "strings.offsets").stat().st_size == 0:
+            np.zeros(1, STRING_OFFSETS).tofile(self.path / "strings.offsets")
+        offsets = _read_array(self.path / "strings.offsets", STRING_OFFSETS, self.meta["strings"] + 1)
+        strings_path = self.path / "strings.bin"
+        if not strings_path.exists():
+            strings_path.touch()
+        if strings_path.stat().st_size > offsets[-1]:
+            os.truncate(strings_path, int(offsets[-1]))
+
+    def _reset_buffers(self):
+        self.rows = {name: [] for name in COLUMNS}
+        self.lists = {name: [] for name in LIST_COLUMNS}
+        self.blobs = {name: [] for name in BLOB_COLUMNS}
+        self.new_strings: List[bytes] = []
+        self.new_commits: List[str] = []
+
+    def intern(self, text: str) -> int:
+        string_id = self.string_ids.get(text)
+        if string_id is None:
+            string_id = self.string_ids[text] = len(self.string_ids)
+            self.new_strings.append(text.encode("utf-8", errors="surrogatepass"))
+        return string_id
+
+    def intern_blob(self, oid: str | None, read_blob) -> int:
+        """
+        The index of the blob `oid`, stored on first use from the bytes returned by `read_blob(oid)`; -1 if unknown.
+        """
+        if oid is None:
+            return -1
+        blob_id = self.blob_ids.get(oid)
+        if blob_id is not None:
+            return blob_id
+        data = read_blob(oid) if read_blob else None
+        if data is None:
+            return -1
+        lines = [self.intern(line) for line in data.decode("utf-8", errors="replace").splitlines()]
+        blob_id = self.blob_ids[oid] = len(self.blob_ids)
+        self.blobs["blob_oid"].append(self.intern(oid))
+        self.blobs["blob_lines_start"].append(self.meta["lengths"]["blob_lines"] + len(self.lists["blob_lines"]))
+        self.blobs["blob_lines_len"].append(len(lines))
+        self.lists["blob_lines"].extend(lines)
+        return blob_id
+
+    def has_commit(self, repo: str, commit: str) -> bool:
+        key = f"{repo}/{commit}"
+        return key in self.committed_commits or key in self.new_commits
+
+    def append_commit(self, repo: str, commit: str, examples: Dict[int, Iterable[Dict]], read_blob=None):
+        """
+        Adds the trace records of a commit, by label. Records are dicts with "file", "line", "code_context",
+        "target_line" and "variables", as written by TraceRecorder, and the "blob" id of the traced file if known.
+        `read_blob(oid)` returns the content of blobs not stored yet, or None.
+        """
+        repo_id, commit_id = self.intern(repo), self.intern(commit)
+        context_length = self.meta["lengths"]["context"] + len(self.lists["context"])
+        variables_length = self.meta["lengths"]["variable_names"] + len(self.lists["variable_names"])
+        for label, records in examples.items():
+            for record in records:
+                context = [self.intern(line) for line in record["code_context"]]
+                variables = record["variables"]
+                row = self.rows
+                row["repo"].append(repo_id)
+                row["commit"].append(commit_id)
+                row["label"].append(label)
+                row["file"].append(self.intern(record["file"]))
+                row["line"].append(record["line"])
+                row["target_line"].append(self.intern(record["target_line"]))
+                row["context_start"].append(context_length)
+                row["context_len"].append(len(context))
+                row["variables_start"].append(variables_length)
+                row["variables_len"].append(len(variables))
+                row["blob"].append(self.intern_blob(record.get("blob"), read_blob))
+                self.lists["context"].extend(context)
+                self.lists["variable_names"].extend(self.intern(name) for name in variables)
+                self.lists["variable_values"].extend(self.intern(value) for value in variables.values())
+                context_length += len(context)
+                variables_length += len(variables)
+        self.new_commits.append(f"{repo}/{commit}")
+        if len(self.rows["repo"]) >= self.flush_rows:
+            self.flush()
+
+    def flush(self):
+        if not self.new_commits and not self.new_strings:
+            return
+        for name, dtype in COLUMNS.items():
+            with open(self.path / f"{name}.col", "ab") as f:
+                np.asarray(self.rows[name], dtype=dtype).tofile(f)
+        for name, dtype in BLOB_COLUMNS.items():
+            with open(self.path / f"{name}.col", "ab") as f:
+                np.asarray(self.blobs[name], dtype=dtype).tofile(f)
+        for name, dtype in LIST_COLUMNS.items():
+            with open(self.path / f"{name}.col", "ab") as f:
+                np.asarray(self.lists[name], dtype=dtype).tofile(f)
+        with open(self.path / "strings.bin", "ab") as data, open(self.path / "strings.offsets", "ab") as offsets:
+            lengths = np.fromiter((len(text) for text in self.new_strings), dtype=STRING_OFFSETS, count=len(self.new_strings))
+            ends = self.string_end + np.cumsum(lengths)
+            for text in self.new_strings:
+                data.write(text)
+            ends.astype(STRING_OFFSETS).tofile(offsets)
+            if len(ends):
+                self.string_end = int(ends[-1])
+            for f in (data, offsets):
+                f.flush()
+                os.fsync(f.fileno())
+
+        self.meta["rows"] += len(self.rows["repo"])
+        self.meta["blobs"] += len(self.blobs["blob_oid"])
+        for name in LIST_COLUMNS:
+            self.meta["lengths"][name] += len(self.lists[name])
+        self.meta["strings"] = len(self.string_ids)
+        self.meta["commits"].extend(self.new_commits)
+        self.committed_commits.update(self.new_commits)
+        # the append becomes visible to readers only now
+        tmp_path = self.path / "meta.json.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(self.meta, f)
+        tmp_path.replace(self.path / "meta.json")
+        self._reset_buffers()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, traceback):
+        if exc_type is None:
+            self.flush()
+
+
+def read_example(path: Path) -> Iterator[Dict]:
+    """
+    The records of a trace file: JSON Lines, with references expanded, or the nested layout of older result.json files.
+    """
+    if path.suffix == ".json":
+        with open(path) as f:
+            for file, lines in json.load(f).items():
+                for line, records in lines.items():
+                    for record in records:
+                        yield {"file": file, "line": int(line), **record}
+        return
+    yield from read_records(path)
+
+
+def blob_reader(repo_path: Path):
+    """
+    Reads blobs by id from the repository at `repo_path`, or from nowhere if it doesn't exist.
+    """
+    if not repo_path.exists():
+        return None
+    repo = pygit2.Repository(str(repo_path))
+
+    def read_blob(oid: str) -> bytes | None:
+        try:
+            return repo[oid].data
+        except (KeyError, ValueError):
+            return None
+    return read_blob
+
+
+def convert_data_dir(data_path: Path, store_path: Path, repos_path: Path = Path('Repos')) -> int:
+    """
+    Appends the commits of data/<repo>/<commit>/ that are not in the store yet; returns how many were added.
+    Source blobs are read from the clones at <repos_path>/<repo>/code.
+    """
+    added = 0
+    with DatasetWriter(store_path) as writer:
+        for repo_dir in sorted(data_path.iterdir()):
+            if not repo_dir.is_dir():
+                continue
+            read_blob = blob_reader(repos_path / repo_dir.name / "code")
+            for commit_dir in sorted(repo_dir.iterdir()):
+                if (not commit_dir.is_dir() or commit_dir.suffix == ".tmp"
+                        or writer.has_commit(repo_dir.name, commit_dir.name)):
+                    continue
+                examples = {}
+                for name, label in EXAMPLE_LABELS.items():
+                    path = commit_dir / f"{name}.jsonl"
+                    if not path.exists():
+                        path = commit_dir / f"{name}.json"
+                    if path.exists():
+                        examples[label] = read_example(path)
+                writer.append_commit(repo_dir.name, commit_dir.name, examples, read_blob)
+                added += 1
+    return added
+
+
+def store_stats(store: DatasetStore) -> Dict:
+    sizes = {path.name: path.stat().st_size for path in store.path.iterdir() if path.is_file()}
+    labels = np.bincount(store.column("label"), minlength=2) if len(store) else np.zeros(2, dtype=int)
+    return {
+        "rows": len(store),
+        "commits": len(store.meta["commits"]),
+        "strings": store.meta["strings"],
+        "blobs": store.meta["blobs"],
+        "labels": {name: int(labels[label]) for name, label in EXAMPLE_LABELS.items()},
+        "bytes": sum(sizes.values()),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    commands = parser.add_subparsers(dest="command", required=True)
+    convert = commands.add_parser("convert", help="append the commits of a data directory to a store")
+    convert.add_argument("data_path", type=Path)
+    convert.add_argument("store_path", type=Path)
+    convert.add_argument("--repos-path", type=Path, default=Path("Repos"), help="where the clones of the repositories are")
+    stats = commands.add_parser("stats", help="print the size of a store")
+    stats.add_argument("store_path", type=Path)
+    args = parser.parse_args()
+
+    if args.command == "convert":
+        print(f"Added {convert_data_dir(args.data_path, args.store_path, args.repos_path)} commits to {args.store_path}")
+    print(json.dumps(store_stats(DatasetStore(args.store_path)), indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,11 +1,84 @@
+from concurrent.futures import ThreadPoolExecutor, as_completed
 import json
 from pathlib import Path
+import re
 import string
+import threading
 import requests
+import requests.adapters
 import time
+from typing import Tuple
+from urllib.parse import urlparse
 import diskcache
+import pygit2
 
-cache = diskcache.Cache('cache_directory')
+from git_utils import get_commit_files as get_local_commit_files
+
+# commit pages addressed by their full SHA never change
+IMMUTABLE_URL = re.compile(r'/repos/[^/]+/[^/]+/commits/[0-9a-f]{40}$')
+
+class HTTPCache:
+    """
+    Cache of JSON responses keyed by URL and query parameters, leaving out the headers, so the token is not part of the key.
+    Immutable resources are served without a request. Other responses are stored with their ETag/Last-Modified
+    and revalidated with If-None-Match/If-Modified-Since: a 304 doesn't count against the rate limit.
+    Failed requests are never cached. The store is only opened on first use.
+    """
+    def __init__(self, directory='cache_directory'):
+        self.directory = directory
+        self._store = None
+        self.lock = threading.Lock()
+        self.counts = {'hits': 0, 'misses': 0, 'revalidated': 0}
+
+    @property
+    def store(self) -> diskcache.Cache:
+        with self.lock:
+            if self._store is None:
+                self._store = diskcache.Cache(str(self.directory))
+            return self._store
+
+    def _count(self, name):
+        with self.lock:
+            self.counts[name] += 1
+
+    def fetch(self, get, url, headers, params) -> Tuple[requests.Response | None, object]:
+        """
+        Returns the response (None when served from the cache) and its JSON data, or None as data if the request failed.
+        `get` sends the request, with the same signature as requests.get.
+        """
+        key = json.dumps([url, sorted((params or {}).items())])
+        entry = self.store.get(key)
+        if entry is not None and entry['immutable']:
+            self._count('hits')
+            return None, entry['data']
+
+        headers = dict(headers)
+        if entry is not None:
+            if entry['etag']:
+                headers['If-None-Match'] = entry['etag']
+            if entry['last_modified']:
+                headers['If-Modified-Since'] = entry['last_modified']
+        response = get(url, headers=headers, params=params)
+        if response.status_code == 304 and entry is not None:
+            self._count('revalidated')
+            return response, entry['data']
+        if response.status_code != 200:
+            return response, None
+
+        self._count('misses')
+        data = response.json()
+        entry = {
+            'immutable': bool(IMMUTABLE_URL.search(urlparse(url).path)),
+            'etag': response.headers.get('ETag'),
+            'last_modified': response.headers.get('Last-Modified'),
+            'data': data,
+        }
+        # without a validator, the entry could never be reused
+        if entry['immutable'] or entry['etag'] or entry['last_modified']:
+            self.store.set(key, entry)
+        return response, data
+
+http_cache = HTTPCache('cache_directory')
 
 def wait_until(reset_time, buffer = 2):
     sleep_time = reset_time - int(time.time()) + buffer  # Add a 5-second buffer
@@ -14,12 +87,11 @@ def wait_until(reset_time, buffer = 2):
         time.sleep(sleep_time)
 
 # Function to check and handle rate limits
-@cache.memoize(expire=86400)
 def call_with_rate_limit(url, headers, params):
     while True:
-        response = requests.get(url, headers=headers, params=params)
-        if response.status_code == 200:
-            return response.json()
+        response, data = http_cache.fetch(requests.get, url, headers, params)
+        if data is not None:
+            return data
         if (response.status_code == 403
             and 'X-RateLimit-Remaining' in response.headers
             and response.headers['X-RateLimit-Remaining'] == '0'):
@@ -107,41 +179,268 @@ def get_commit_files(owner, repo, sha, token):
 def is_ascii(s):
     return all(c in string.printable for c in s)
 
-def main():
+# ========================================================================================================
+
+API_URL = 'https://api.github.com'
+
+class RateLimiter:
+    """
+    Token bucket shared by all crawler threads, driven by GitHub's X-RateLimit-* headers:
+    the remaining budget is spread evenly until the reset time, and when it runs out
+    every thread waits for the reset instead of sending requests that would be rejected.
+    """
+    def __init__(self, capacity: int = 10):
+        self.capacity = capacity
+        self.tokens = float(capacity)
+        # until the first response tells us the real budget
+        self.refill_per_second = float(capacity)
+        self.reset_time = None
+        self.updated = time.monotonic()
+        self.condition = threading.Condition()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.refill_per_second)
+        self.updated = now
+
+    def acquire(self):
+        with self.condition:
+            while True:
+                if self.reset_time is not None and time.time() >= self.reset_time:
+                    # the window was reset: allow a probe request to learn the new budget
+                    self.reset_time = None
+                    self.tokens = max(self.tokens, 1)
+                self._refill()
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                if self.refill_per_second > 0:
+                    wait = (1 - self.tokens) / self.refill_per_second
+                else:
+                    wait = max(self.reset_time - time.time(), 0) + 0.05 if self.reset_time else 1
+                self.condition.wait(wait)
+
+    def update(self, headers):
+        if 'X-RateLimit-Remaining' not in headers or 'X-RateLimit-Reset' not in headers:
+            return
+        remaining = int(headers['X-RateLimit-Remaining'])
+        reset_time = int(headers['X-RateLimit-Reset'])
+        with self.condition:
+            self._refill()
+            self.reset_time = reset_time
+            self.tokens = min(self.tokens, remaining)
+            seconds_left = reset_time - time.time()
+            self.refill_per_second = 0.0 if remaining == 0 else remaining / max(seconds_left, 1)
+            self.condition.notify_all()
+
+class GitHubCrawler:
+    """
+    Fetches repositories, their commits and the files changed by each commit with up to `max_in_flight`
+    concurrent requests over one pooled HTTP session, writing files.json for test-touching commits as results arrive.
+    `api_url` can point to a local server mimicking the GitHub endpoints. Responses go through `cache` (see HTTPCache).
+    A rate-limited request is sent at most `max_attempts` times, waiting `backoff * 2**attempt` seconds between
+    attempts when the response says neither when to retry nor when the limit resets.
+    """
+    def __init__(self, token=None, api_url=API_URL, max_in_flight=8, output_path=Path('data'), cache: HTTPCache | None = None,
+                 max_attempts=5, backoff=1.0):
+        self.api_url = api_url.rstrip('/')
+        self.output_path = output_path
+        self.max_in_flight = max_in_flight
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=max_in_flight)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        if token:
+            self.session.headers['Authorization'] = f'token {token}'
+        self.rate_limiter = RateLimiter()
+        self.cache = cache if cache is not None else http_cache
+        self.max_attempts = max_attempts
+        self.backoff = backoff
+        # every request, whichever thread sends it, takes a slot
+        self.in_flight = threading.BoundedSemaphore(max_in_flight)
+        # commits queued for fetching, so listing a long history doesn't pile up tasks
+        self.pending = threading.BoundedSemaphore(2 * max_in_flight)
+        self.lock = threading.Lock()
+        self.counts = {'repositories': 0, 'commits': 0, 'files': 0}
+
+    def _send(self, url, headers, params):
+        self.rate_limiter.acquire()
+        with self.in_flight:
+            response = self.session.get(url, headers=headers, params=params)
+        self.rate_limiter.update(response.headers)
+        return response
+
+    def _retry_delay(self, response, attempt):
+        """
+        Seconds to wait before sending a rate-limited request again, or None if `response` isn't rate-limited.
+        Secondary limits only send Retry-After; the primary limit sends X-RateLimit-Reset, which the rate
+        limiter already waits for.
+        """
+        if response.status_code not in (403, 429):
+            return None
+        headers = response.headers
+        retry_after = headers.get('Retry-After')
+        if retry_after is not None and retry_after.isdigit():
+            return int(retry_after)
+        if headers.get('X-RateLimit-Remaining') == '0' and 'X-RateLimit-Reset' in headers:
+            return 0
+        if retry_after is not None or response.status_code == 429 or 'rate limit' in response.text.lower():
+            return self.backoff * 2 ** attempt
+        return None
+
+    def get(self, path, params=None):
+        url = f'{self.api_url}{path}'
+        for attempt in range(self.max_attempts):
+            response, data = self.cache.fetch(self._send, url, {}, params)
+            if data is not None:
+                return data
+            delay = self._retry_delay(response, attempt)
+            if delay is None:
+                print('Unknown error:', response.status_code, response.text[:200])
+                return None
+            if attempt + 1 < self.max_attempts:
+                print(f'Rate limit exceeded on {url}; retrying in {delay:g}s.')
+                time.sleep(delay)
+        print(f'Rate limit still exceeded on {url} after {self.max_attempts} attempts; giving up.')
+        return None
+
+    def get_repositories(self, X, Y, language='Python', sort='stars', order='desc'):
+        repos = []
+        per_page = 100
+        start_page = (X - 1) // per_page + 1
+        end_page = (Y - 1) // per_page + 1
+        for page in range(start_page, end_page + 1):
+            params = {'q': f'language:{language}', 'sort': sort, 'order': order, 'per_page': per_page, 'page': page}
+            repos_json = self.get('/search/repositories', params)
+            if not repos_json or 'items' not in repos_json:
+                print(f"Error fetching repository {page=}: {repos_json}")
+                continue
+            repos.extend(repos_json['items'])
+        start_index = (X - 1) % per_page
+        return repos[start_index:start_index + (Y - X + 1)]
+
+    def get_default_branch(self, owner, repo):
+        repo_data = self.get(f'/repos/{owner}/{repo}')
+        if not repo_data or 'default_branch' not in repo_data:
+            print(f'Error fetching default branch for {owner}/{repo}: {repo_data}')
+            return 'main' # default to 'main' if the API call fails
+        return repo_data['default_branch']
+
+    def get_commits_from_branch(self, owner, repo, branch):
+        params = {'sha': branch, 'per_page': 100, 'page': 1}
+        while True:
+            commits_json = self.get(f'/repos/{owner}/{repo}/commits', dict(params))
+            if not commits_json:
+                return
+            for commit in commits_json:
+                yield commit['sha']
+            params['page'] += 1
+
+    def save_commit_files(self, owner, repo, sha):
+        commit_data = self.get(f'/repos/{owner}/{repo}/commits/{sha}')
+        if not commit_data or 'files' not in commit_data:
+            print(f'Error fetching commit {sha}: {commit_data}')
+            return
+        test_files = write_commit_files(self.output_path, owner, repo, sha, commit_data['files'])
+        if test_files:
+            print(f'Commit {owner}/{repo}@{sha} changes {test_files} test files')
+            with self.lock:
+                self.counts['files'] += test_files
+
+    def _release_after(self, function, *args):
+        try:
+            function(*args)
+        except requests.RequestException as e:
+            print(f'Request failed for {args}: {e}')
+        finally:
+            self.pending.release()
+
+    def crawl_repository(self, owner, repo, executor):
+        with self.lock:
+            self.counts['repositories'] += 1
+        for sha in self.get_commits_from_branch(owner, repo, self.get_default_branch(owner, repo)):
+            with self.lock:
+                self.counts['commits'] += 1
+            self.pending.acquire()
+            executor.submit(self._release_after, self.save_commit_files, owner, repo, sha)
+
+    def crawl_local_repository(self, owner, repo, clone_url, repos_path: Path):
+        """
+        Mirrors the repository as a bare clone under `repos_path` and finds the changed files of each commit with local diffs.
+        """
+        with self.lock:
+            self.counts['repositories'] += 1
+        mirror = mirror_repository(clone_url, repos_path / repo / 'mirror.git')
+        # the remote HEAD is the default branch
+        head = mirror.references['refs/remotes/origin/HEAD'].resolve().target
+        for commit in mirror.walk(head, pygit2.GIT_SORT_TIME):
+            with self.lock:
+                self.counts['commits'] += 1
+            test_files = write_commit_files(self.output_path, owner, repo, str(commit.id), get_local_commit_files(mirror, commit))
+            if test_files:
+                with self.lock:
+                    self.counts['files'] += test_files
+        print(f'Scanned {owner}/{repo} locally')
+
+    def crawl(self, X, Y, language='Python', local_clones_path: Path | None = None):
+        """
+        With `local_clones_path`, the API is only used to search repositories: commits are read from local clones.
+        """
+        print('Fetching repositories...')
+        repos = self.get_repositories(X, Y, language=language)
+        with ThreadPoolExecutor(max_workers=self.max_in_flight) as commit_executor:
+            # a few repositories are listed concurrently; their commit requests share the executor
+            with ThreadPoolExecutor(max_workers=max(1, self.max_in_flight // 4)) as repo_executor:
+                if local_clones_path is not None:
+                    futures = [repo_executor.submit(self.crawl_local_repository, repo['owner']['login'], repo['name'],
+                                                    repo['clone_url'], local_clones_path)
+                               for repo in repos]
+                else:
+                    futures = [repo_executor.submit(self.crawl_repository, repo['owner']['login'], repo['name'], commit_executor)
+                               for repo in repos]
+                for future in as_completed(futures):
+                    future.result()
+        print(f"Done: {self.counts}, cache: {self.cache.counts}")
+        return self.counts
+
+def mirror_repository(clone_url, path: Path) -> pygit2.Repository:
+    """
+    Returns the bare clone of `clone_url` at `path`, cloning it or fetching the new commits.
+    """
+    if path.exists():
+        repo = pygit2.Repository(str(path))
+        repo.remotes['origin'].fetch()
+        return repo
+    path.parent.mkdir(parents=True, exist_ok=True)
+    return pygit2.clone_repository(clone_url, str(path), bare=True)
+
+def write_commit_files(output_path: Path, owner, repo_name, sha, files) -> int:
+    """
+    Saves the files of a commit that changes tests, in the layout used by main. Returns the number of test files.
+    """
+    test_files = 0
+    for file in files:
+        filename = file['filename']
+        if not is_ascii(filename):
+            print(f'File {filename} is not ASCII. Skipping...')
+            continue
+        if 'test' in filename.strip().lower():
+            test_files += 1
+    if test_files:
+        path = output_path / owner / repo_name / f'commit_{sha}' / sha
+        path.mkdir(parents=True, exist_ok=True)
+        tmp_path = path / "files.json.tmp"
+        with open(tmp_path, 'w') as f:
+            json.dump(files, f, indent=4)
+        # readers never see a half-written file
+        tmp_path.replace(path / "files.json")
+    return test_files
+
+def main(max_in_flight=8, api_url=API_URL, local_clones_path: Path | None = Path('Repos')):
     token = "<token>"
     X = 10
     Y = 100
-    repository_count = 0
-    commit_count = 0
-    file_count = 0
-    print('Fetching repositories...')
-    for repo in get_repositories_from_X_to_Y(X, Y, language='Python', sort='stars', order='desc', token=token):
-        print(f"until now: {repository_count=}, {commit_count=}, {file_count=}")
-        repository_count += 1
-        owner = repo['owner']['login']
-        repo_name = repo['name']
-        print(f'\nProcessing repository #{repository_count}: {owner}/{repo_name}')
-        for sha in get_commits_from_branch(owner, repo_name, get_default_branch(owner,repo_name,token), token):
-            print(f"until now: {repository_count=}, {commit_count=}, {file_count=}")
-            commit_count += 1
-            print(f'Fetching commit #{commit_count}: {sha}...')
-            files = get_commit_files(owner, repo_name, sha, token)
-            if not files:
-                continue
-            for file in files:
-                filename = file['filename']
-                print(f'Checking file {filename}...')
-                if not is_ascii(filename):
-                    print(f'File {filename} is not ASCII. Skipping...')
-                    continue
-                if 'test' in filename.strip().lower():
-                    file_count += 1
-                    print(f'File #{file_count}: Commit {sha} changes file {filename}')
-                    # Save the data to a file
-                    path = Path('data') / owner / repo_name / f'commit_{sha}' / sha
-                    path.mkdir(parents=True, exist_ok=True)
-                    with open(path / "files.json", 'w') as f:
-                        json.dump(files, f, indent=4)
+    GitHubCrawler(token, api_url=api_url, max_in_flight=max_in_flight).crawl(X, Y, language='Python', local_clones_path=local_clones_path)
 
 if __name__ == '__main__':
     main()
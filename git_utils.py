@@ -1,24 +1,86 @@
 from collections import defaultdict
 from datetime import datetime
+import json
 import pdb
+import time
 from typing import Dict, Generator, List, Tuple, Set
 import pygit2
 from itertools import islice
+from pathlib import Path, PurePosixPath
 
+from myplugin.intervals import Intervals, add_line
+
+# bumped when the planned entries change shape, so older plan.json files are planned again
+PLAN_VERSION = 2
 
 def get_all_commits(repo: pygit2.Repository) -> pygit2.Walker:
     return repo.walk(repo.head.target, pygit2.GIT_SORT_TIME | pygit2.GIT_SORT_REVERSE)
 
 
+def prepare_worktrees(repo: pygit2.Repository, worktrees_path: Path, count: int) -> List[Path]:
+    """
+    Returns the paths of `count` linked worktrees of `repo` under `worktrees_path`,
+    creating the missing ones and reusing those left by a previous run.
+    """
+    worktrees_path.mkdir(parents=True, exist_ok=True)
+    paths = []
+    for i in range(count):
+        name = f"worker-{i}"
+        path = worktrees_path / name
+        if name in repo.list_worktrees():
+            worktree = repo.lookup_worktree(name)
+            if not worktree.is_prunable:
+                paths.append(path)
+                continue
+            # the directory was removed by hand: drop the stale registration and start over
+            worktree.prune(True)
+            if name in repo.branches.local:
+                repo.branches.local.delete(name)
+        repo.add_worktree(name, str(path))
+        paths.append(path)
+    return paths
+
+
+def checkout_changed_paths(repo: pygit2.Repository, commit: pygit2.Commit) -> List[str]:
+    """
+    Moves HEAD (detached), the index and the working tree from the current HEAD commit to `commit`,
+    rewriting only the paths that differ between the two trees. Returns those paths.
+    Bytecode cached for the touched modules is removed, as it could be stale when a file is rewritten
+    within the same second with the same size.
+    """
+    current = repo.head.peel(pygit2.Commit)
+    paths = set()
+    if current.id != commit.id:
+        for delta in repo.diff(current, commit).deltas:
+            paths.add(delta.old_file.path)
+            paths.add(delta.new_file.path)
+    if paths:
+        # forced: the target content wins over local changes to these paths
+        repo.checkout_tree(commit.tree, strategy=pygit2.GIT_CHECKOUT_FORCE, paths=sorted(paths))
+        clear_cached_bytecode(Path(repo.workdir), paths)
+    repo.set_head(commit.id)
+    return sorted(paths)
+
+def clear_cached_bytecode(workdir: Path, paths):
+    for path in paths:
+        source = PurePosixPath(path)
+        if source.suffix != '.py':
+            continue
+        for cached in workdir.joinpath(source.parent, '__pycache__').glob(f'{source.stem}.*.pyc'):
+            cached.unlink(missing_ok=True)
+
+
 def skip_first(iterable):
     return islice(iterable, 1, None)
 
 def modifies_test_and_code(patches, test_files: Set[str]) -> bool:
+    return files_modify_test_and_code((patch.delta.new_file.path for patch in patches), test_files)
+
+def files_modify_test_and_code(files, test_files: Set[str]) -> bool:
     commit_modifies_test = False
     commit_modifies_code = False
     print('test_files:', test_files)
-    for patch in patches:
-        file = patch.delta.new_file.path
+    for file in files:
         if not file.endswith('.py'):
             continue
         if file in test_files:
@@ -42,14 +104,13 @@ def get_commits_that_modify_test_and_code(repo: pygit2.Repository, test_files: L
 
 # ========================================================================================================
 
-def get_modified_lines(diff) -> Dict[str, Dict[str, List[int]]]:
+def get_modified_lines(diff) -> Dict[str, Dict[str, Intervals]]:
     """
-    Returns due ditionaries
-    with the same keys, the functions
-    values are the filename they find themselves in
+    Returns the lines of the python files covered by the hunks of `diff`, changed and context lines,
+    as sorted, merged [first, last] intervals by file: in the parent under "old", in the child under "new".
     """
-    modified_lines: Dict[str, Dict[str, List[int]]] = {"old": defaultdict(list), "new": defaultdict(list)}
-   
+    modified_lines: Dict[str, Dict[str, Intervals]] = {"old": defaultdict(list), "new": defaultdict(list)}
+
     for patch in diff:
         new_file = patch.delta.new_file.path
         old_file = patch.delta.old_file.path
@@ -61,8 +122,143 @@ def get_modified_lines(diff) -> Dict[str, Dict[str, List[int]]]:
             for line in hunk.lines:
                 # Collect both added and removed lines (lines that have either a new or old line number)
                 if line.old_lineno != -1:
-                    modified_lines["old"][old_file].append(line.old_lineno)
+                    add_line(modified_lines["old"][old_file], line.old_lineno)
                 if line.new_lineno != -1:
-                    modified_lines["new"][new_file].append(line.new_lineno)
+                    add_line(modified_lines["new"][new_file], line.new_lineno)
+
+    return {side: dict(lines) for side, lines in modified_lines.items()}
+
+# ========================================================================================================
+
+def looks_like_test_file(path: str) -> bool:
+    """
+    Cheap stand-in for test discovery, decided from the path alone.
+    Errs on the side of inclusion: pytest's default file patterns plus anything under a test directory.
+    """
+    parts = PurePosixPath(path).parts
+    name = parts[-1]
+    if not name.endswith('.py') or name == 'conftest.py':
+        return False
+    if name.startswith('test_') or name.endswith('_test.py'):
+        return True
+    return any(part in ('test', 'tests', 'testing') for part in parts[:-1])
+
+def iter_tree_files(tree: pygit2.Tree, prefix: str = '') -> Generator[Tuple[str, pygit2.Oid], None, None]:
+    """
+    Yields (path, blob id) for every file in `tree`, recursively, without checking anything out.
+    """
+    for entry in tree:
+        path = f"{prefix}{entry.name}"
+        if isinstance(entry, pygit2.Tree):
+            yield from iter_tree_files(entry, f"{path}/")
+        elif isinstance(entry, pygit2.Blob):
+            yield path, entry.id
+
+def get_modified_py_files(diff: pygit2.Diff) -> List[str]:
+    # deltas only: no patch is generated
+    return [delta.new_file.path for delta in diff.deltas if delta.new_file.path.endswith('.py')]
+
+# delta status characters of pygit2, as named by the GitHub commits API
+FILE_STATUS = {'A': 'added', 'D': 'removed', 'M': 'modified', 'R': 'renamed', 'C': 'copied', 'T': 'changed'}
+
+def get_commit_files(repo: pygit2.Repository, commit: pygit2.Commit) -> List[Dict]:
+    """
+    Returns the files changed by `commit` relative to its first parent, in the format of the "files"
+    of the GitHub commits API, without any request.
+    """
+    if commit.parents:
+        diff = repo.diff(commit.parents[0], commit)
+    else:
+        diff = commit.tree.diff_to_tree(swap=True)
+    diff.find_similar()
+    files = []
+    for patch in diff:
+        delta = patch.delta
+        status = FILE_STATUS.get(delta.status_char(), 'modified')
+        _, additions, deletions = patch.line_stats
+        file = {
+            "sha": str(delta.old_file.id if status == 'removed' else delta.new_file.id),
+            "filename": delta.new_file.path,
+            "status": status,
+            "additions": additions,
+            "deletions": deletions,
+            "changes": additions + deletions,
+        }
+        if status == 'renamed':
+            file["previous_filename"] = delta.old_file.path
+        if not delta.is_binary:
+            # like GitHub, the patch starts at the first hunk
+            text = patch.text or ''
+            hunks_start = text.find('\n@@')
+            if hunks_start != -1:
+                file["patch"] = text[hunks_start + 1:]
+        files.append(file)
+    return files
+
+def plan_commit_pairs(repo: pygit2.Repository, start_at = 0, skipped: Dict[str, int] | None = None) -> List[Dict]:
+    """
+    Walks the history once using only tree diffs, without touching the working tree,
+    and returns the (parent, child) pairs that look like bugfixes: they modify both test and code files.
+    Test files are guessed with looks_like_test_file; test discovery confirms them after checkout.
+    The other pairs are counted in `skipped` by reason.
+    """
+    if skipped is None:
+        skipped = defaultdict(int)
+    plan = []
+    commit_walker = get_all_commits(repo)
+    commit = next(commit_walker)
+    for next_commit in commit_walker:
+        if commit.commit_time < start_at:
+            commit = next_commit
+            continue
+        if commit not in next_commit.parents:
+            skipped["not parent"] += 1
+            commit = next_commit
+            continue
+
+        diff = repo.diff(commit, next_commit)
+        modified_files = get_modified_py_files(diff)
+        test_files = [file for file in modified_files if looks_like_test_file(file)]
+        if test_files and len(test_files) < len(modified_files):
+            plan.append({
+                "parent": str(commit.id),
+                "child": str(next_commit.id),
+                "commit_time": commit.commit_time,
+                "modified_files": modified_files,
+                "test_files": test_files,
+                "modified_lines": get_modified_lines(diff),
+            })
+        else:
+            skipped["not a bugfix"] += 1
+        commit = next_commit
+    return plan
+
+def load_or_plan_commit_pairs(repo: pygit2.Repository, plan_path: Path, start_at = 0,
+                              skipped: Dict[str, int] | None = None) -> List[Dict]:
+    """
+    Returns the plan saved at `plan_path` if it was made for the current HEAD, `start_at` and PLAN_VERSION,
+    otherwise plans again and saves the result. The pairs left out of the plan are counted in `skipped`.
+    """
+    if skipped is None:
+        skipped = defaultdict(int)
+    head = str(repo.head.target)
+    if plan_path.exists():
+        with open(plan_path) as f:
+            saved = json.load(f)
+        if saved["head"] == head and saved["start_at"] == start_at and saved.get("version") == PLAN_VERSION:
+            for reason, count in saved.get("skipped", {}).items():
+                skipped[reason] += count
+            return saved["pairs"]
 
-    return modified_lines
\ No newline at end of file
+    start = time.time()
+    plan_skipped = defaultdict(int)
+    pairs = plan_commit_pairs(repo, start_at, plan_skipped)
+    print(f"Planned {len(pairs)} candidate commit pairs in {time.time() - start:.1f}s")
+    plan_path.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = plan_path.with_name(plan_path.name + ".tmp")
+    with open(tmp_path, 'w') as f:
+        json.dump({"version": PLAN_VERSION, "head": head, "start_at": start_at, "pairs": pairs, "skipped": plan_skipped}, f)
+    tmp_path.replace(plan_path)
+    for reason, count in plan_skipped.items():
+        skipped[reason] += count
+    return pairs
@@ -0,0 +1,136 @@
+"""
+Sets of line numbers as sorted, merged [first, last] intervals: the modified lines of a diff take one interval
+per hunk rather than one entry per line, and a lookup is a binary search over the interval starts.
+
+On the command line, the intervals of a file are written "path:first-last,line,...", as --trace-lines takes them.
+"""
+from bisect import bisect_right
+from typing import Dict, Iterable, List, Sequence
+
+Intervals = List[List[int]]
+
+
+def to_intervals(lines: Iterable[int]) -> Intervals:
+    """
+    Sorted, merged [first, last] intervals covering `lines`.
+    """
+    intervals = []
+    for line in sorted(set(lines)):
+        if intervals and intervals[-1][1] == line - 1:
+            intervals[-1][1] = line
+        else:
+            intervals.append([line, line])
+    return intervals
+
+
+def merge_intervals(intervals: Iterable[Sequence[int]]) -> Intervals:
+    """
+    Sorted intervals where the overlapping and adjacent ones of `intervals` are merged.
+    """
+    merged = []
+    for first, last in sorted(intervals):
+        if merged and first <= merged[-1][1] + 1:
+            merged[-1][1] = max(merged[-1][1], last)
+        else:
+            merged.append([first, last])
+    return merged
+
+
+def add_line(intervals: Intervals, line: int):
+    """
+    Adds `line` to sorted intervals, in place; cheap when lines come in increasing order, as in a hunk.
+    """
+    if intervals and intervals[-1][0] <= line <= intervals[-1][1] + 1:
+        intervals[-1][1] = max(intervals[-1][1], line)
+    elif intervals and line < intervals[-1][0]:
+        intervals[:] = merge_intervals(intervals + [[line, line]])
+    else:
+        intervals.append([line, line])
+
+
+def intervals_intersect(a: Intervals, b: Intervals) -> bool:
+    """
+    Whether two lists of sorted intervals have a line in common.
+    """
+    i = j = 0
+    while i < len(a) and j < len(b):
+        if a[i][1] < b[j][0]:
+            i += 1
+        elif b[j][1] < a[i][0]:
+            j += 1
+        else:
+            return True
+    return False
+
+
+def iter_lines(intervals: Intervals) -> Iterable[int]:
+    for first, last in intervals:
+        yield from range(first, last + 1)
+
+
+def format_intervals(intervals: Intervals) -> str:
+    return ",".join(str(first) if first == last else f"{first}-{last}" for first, last in intervals)
+
+
+def parse_intervals(text: str) -> Intervals:
+    intervals = []
+    for part in text.split(","):
+        first, _, last = part.partition("-")
+        intervals.append([int(first), int(last or first)])
+    return merge_intervals(intervals)
+
+
+def parse_tracked_lines(arguments: Iterable[str]) -> Dict[str, Intervals]:
+    """
+    The intervals by file of "path:intervals" arguments; a file given several times gets the union.
+    """
+    tracked: Dict[str, Intervals] = {}
+    for argument in arguments:
+        path, separator, text = argument.rpartition(":")
+        if not separator or not path:
+            raise ValueError(f"Expected path:intervals, got {argument!r}")
+        tracked[path] = merge_intervals(tracked.get(path, []) + parse_intervals(text))
+    return tracked
+
+
+class LineIntervals:
+    """
+    An immutable set of line numbers held as sorted, merged intervals.
+    Memory and lookup time depend on the number of intervals, not on how many lines they cover.
+    """
+    __slots__ = ("starts", "ends")
+
+    def __init__(self, intervals: Iterable[Sequence[int]] = ()):
+        merged = merge_intervals(intervals)
+        self.starts = [first for first, _ in merged]
+        self.ends = [last for _, last in merged]
+
+    @classmethod
+    def from_lines(cls, lines: Iterable[int]) -> "LineIntervals":
+        return cls(to_intervals(lines))
+
+    def __contains__(self, line: int) -> bool:
+        i = bisect_right(self.starts, line) - 1
+        return i >= 0 and line <= self.ends[i]
+
+    def __bool__(self) -> bool:
+        return bool(self.starts)
+
+    def __eq__(self, other) -> bool:
+        return isinstance(other, LineIntervals) and self.starts == other.starts and self.ends == other.ends
+
+    def __repr__(self) -> str:
+        return f"LineIntervals({self.intervals()})"
+
+    def intervals(self) -> Intervals:
+        return [[first, last] for first, last in zip(self.starts, self.ends)]
+
+    def overlaps(self, first: int, last: int) -> bool:
+        """
+        Whether a line of [first, last] is in the set.
+        """
+        i = bisect_right(self.starts, last) - 1
+        return i >= 0 and self.ends[i] >= first
+
+    def union(self, other: "LineIntervals") -> "LineIntervals":
+        return LineIntervals(self.intervals() + other.intervals())
@@ -0,0 +1,248 @@
+"""
+Content-addressed store of trace record payloads, shared by all the commits of all the repositories.
+
+The payload of a record (code context, target line and variables, with object addresses removed) is stored once,
+compressed, under a hash of its content. Trace files then hold references instead of records: one line per distinct
+payload of a traced line, {"file", "line", "ref", "count"}, after a header line {"objects": <store path, relative
+to the trace file>}. read_records expands them back to `count` full records, and passes plain records through.
+
+    python -m myplugin.objects pack data --objects objects.sqlite
+    python -m myplugin.objects stats data
+"""
+import argparse
+import hashlib
+import json
+import os
+import sqlite3
+import time
+import zlib
+from itertools import islice
+from pathlib import Path
+from typing import Dict, Iterable, Iterator, List, Tuple
+
+from .representation import ADDRESS
+
+PAYLOAD_FIELDS = ("code_context", "target_line", "variables")
+OBJECTS_PATH = Path("objects.sqlite")
+
+
+def normalize(record: Dict) -> Dict:
+    payload = {name: record[name] for name in PAYLOAD_FIELDS if name in record}
+    if "variables" in payload:
+        payload["variables"] = {name: ADDRESS.sub("", value) for name, value in payload["variables"].items()}
+    return payload
+
+
+def object_id(payload: Dict) -> str:
+    return hashlib.blake2b(json.dumps(payload, sort_keys=True).encode("utf-8", errors="surrogatepass"),
+                           digest_size=16).hexdigest()
+
+
+class ObjectStore:
+    """
+    An SQLite file in WAL mode, so the sessions of several workers can add objects at once.
+    A connection belongs to the thread that opened it.
+    """
+    def __init__(self, path: Path = OBJECTS_PATH, timeout: float = 60.0):
+        self.path = Path(path)
+        self.connection = sqlite3.connect(self.path, timeout=timeout)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+        with self.connection:
+            self.connection.execute("CREATE TABLE IF NOT EXISTS objects (id TEXT PRIMARY KEY, payload BLOB NOT NULL) WITHOUT ROWID")
+
+    def close(self):
+        self.connection.close()
+
+    def put_many(self, payloads: Dict[str, Dict]):
+        with self.connection:
+            self.connection.executemany(
+                "INSERT OR IGNORE INTO objects VALUES (?, ?)",
+                ((ref, zlib.compress(json.dumps(payload).encode("utf-8", errors="surrogatepass"))) for ref, payload in payloads.items()))
+
+    def get_many(self, refs: Iterable[str]) -> Dict[str, Dict]:
+        refs = list(set(refs))
+        payloads = {}
+        # within SQLite's limit on query parameters
+        for start in range(0, len(refs), 500):
+            chunk = refs[start:start + 500]
+            rows = self.connection.execute(f"SELECT id, payload FROM objects WHERE id IN ({','.join('?' * len(chunk))})", chunk)
+            for ref, payload in rows:
+                payloads[ref] = json.loads(zlib.decompress(payload))
+        missing = set(refs) - payloads.keys()
+        if missing:
+            raise KeyError(f"{len(missing)} objects missing from {self.path}, such as {next(iter(missing))}")
+        return payloads
+
+    def stats(self) -> Dict:
+        count, size = self.connection.execute("SELECT count(*), coalesce(sum(length(payload)), 0) FROM objects").fetchone()
+        return {"objects": count, "payload_bytes": size}
+
+
+def header(store_path: Path, trace_dir: Path) -> Dict:
+    return {"objects": os.path.relpath(Path(store_path).absolute(), Path(trace_dir).absolute())}
+
+
+class ReferenceWriter:
+    """
+    Writes the header to `output_file`, then turns records into references as they come. Every `batch_size` records,
+    the new objects go to the store and the references to the file, the repeated ones of the batch counted once,
+    so memory stays bounded however long the session runs. The store is opened by the first flush, so the writer
+    belongs to the thread that adds records; close() flushes the rest and must be called from that thread too.
+    """
+    def __init__(self, store_path: Path, output_file, trace_dir: Path, batch_size: int = 1000):
+        self.store_path = Path(store_path)
+        self.output_file = output_file
+        self.batch_size = batch_size
+        self.store: ObjectStore | None = None
+        self.pending = 0
+        self.payloads: Dict[str, Dict] = {}
+        self.references: Dict[Tuple, Dict] = {}
+        output_file.write(json.dumps(header(self.store_path, trace_dir)) + '\n')
+
+    def add(self, record: Dict):
+        payload = normalize(record)
+        ref = object_id(payload)
+        self.payloads.setdefault(ref, payload)
+        extra = {name: value for name, value in record.items() if name not in PAYLOAD_FIELDS}
+        key = (ref, json.dumps(extra, sort_keys=True))
+        reference = self.references.get(key)
+        if reference is None:
+            self.references[key] = {**extra, "ref": ref, "count": 1}
+        else:
+            reference["count"] += 1
+        self.pending += 1
+        if self.pending >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        if not self.pending:
+            return
+        if self.store is None:
+            self.store = ObjectStore(self.store_path)
+        # objects first: a reference on disk always has its object
+        self.store.put_many(self.payloads)
+        for reference in self.references.values():
+            self.output_file.write(json.dumps(reference) + '\n')
+        self.output_file.flush()
+        self.payloads.clear()
+        self.references.clear()
+        self.pending = 0
+
+    def close(self):
+        self.flush()
+        if self.store is not None:
+            self.store.close()
+
+
+def read_records(path: Path, lines: Iterable[str] | None = None, chunk_size: int = 500) -> Iterator[Dict]:
+    """
+    The records of a JSON Lines trace file, with references expanded; `lines` replaces the file's lines if given.
+    The file is read as it goes, and the objects of `chunk_size` references at a time.
+    """
+    path = Path(path)
+    if lines is None:
+        with open(path) as f:
+            yield from read_records(path, f, chunk_size)
+        return
+    lines = (line for line in lines if line.strip())
+    first = next(lines, None)
+    if first is None:
+        return
+    entry = json.loads(first)
+    if "objects" not in entry:
+        yield entry
+        for line in lines:
+            yield json.loads(line)
+        return
+    store = ObjectStore(path.parent / entry["objects"])
+    try:
+        while entries := [json.loads(line) for line in islice(lines, chunk_size)]:
+            payloads = store.get_many(entry["ref"] for entry in entries if "ref" in entry)
+            for entry in entries:
+                if "ref" not in entry:
+                    yield entry
+                    continue
+                ref, count = entry.pop("ref"), entry.pop("count", 1)
+                for _ in range(count):
+                    yield {**entry, **payloads[ref]}
+    finally:
+        store.close()
+
+
+def pack_file(path: Path, store_path: Path) -> bool:
+    """
+    Rewrites a trace file of plain records as references; returns False if it already holds references.
+    """
+    with open(path) as f:
+        first = f.readline()
+        if not first.strip() or "objects" in json.loads(first):
+            return False
+        f.seek(0)
+        tmp_path = path.with_name(path.name + ".tmp")
+        with open(tmp_path, "w") as out:
+            writer = ReferenceWriter(store_path, out, path.parent)
+            for line in f:
+                if line.strip():
+                    writer.add(json.loads(line))
+            writer.close()
+    tmp_path.replace(path)
+    return True
+
+
+def trace_files(data_path: Path) -> List[Path]:
+    # leaving out the .tmp directories of the pairs in progress
+    return sorted(path for path in data_path.glob("*/*/*.jsonl") if path.parent.suffix != ".tmp")
+
+
+def data_stats(data_path: Path) -> Dict:
+    """
+    Size of the trace files under data/<repo>/<commit>/ and of the objects they use, the size the expanded
+    records would take, and how long loading them all takes.
+    """
+    stats = {"files": 0, "references": 0, "records": 0, "reference_bytes": 0, "expanded_bytes": 0}
+    stores = set()
+    start = time.perf_counter()
+    for path in trace_files(data_path):
+        stats["files"] += 1
+        stats["reference_bytes"] += path.stat().st_size
+        with open(path) as f:
+            first = f.readline()
+            references = sum(1 for line in f if line.strip())
+        if first.strip() and "objects" in json.loads(first):
+            stores.add((path.parent / json.loads(first)["objects"]).resolve())
+            stats["references"] += references
+        for record in read_records(path):
+            stats["records"] += 1
+            stats["expanded_bytes"] += len(json.dumps(record)) + 1
+    stats["load_seconds"] = time.perf_counter() - start
+    stats["objects"] = stats["object_bytes"] = 0
+    for store_path in stores:
+        stats["object_bytes"] += store_path.stat().st_size
+        store = ObjectStore(store_path)
+        stats["objects"] += store.stats()["objects"]
+        store.close()
+    stats["stored_bytes"] = stats["reference_bytes"] + stats["object_bytes"]
+    return stats
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    pack = subparsers.add_parser("pack", help="rewrite the trace files of a data directory as references")
+    pack.add_argument("data", type=Path)
+    pack.add_argument("--objects", type=Path, default=OBJECTS_PATH)
+    stats = subparsers.add_parser("stats", help="disk use and load time of the trace files of a data directory")
+    stats.add_argument("data", type=Path)
+    args = parser.parse_args()
+
+    if args.command == "pack":
+        packed = sum(pack_file(path, args.objects) for path in trace_files(args.data))
+        print(f"Packed {packed} trace files")
+    else:
+        for name, value in data_stats(args.data).items():
+            print(f"{name}: {value}")
+
+
+if __name__ == "__main__":
+    main()
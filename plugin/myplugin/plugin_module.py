@@ -3,22 +3,50 @@ import json
 import linecache
 import sys
 import threading
-from collections import defaultdict
 from pathlib import Path
-from typing import Dict, Set
+from collections import deque
+from typing import Deque, Dict, Iterable, List, Tuple
 
-lock = threading.Lock()
+from myplugin.intervals import LineIntervals, parse_tracked_lines
+from myplugin.recorder import SAMPLING_POLICIES, TraceRecorder
+from myplugin.representation import VariableRepresenter
 
-def read_intersting_lines():
-    interesting_lines_list = json.load(open("to_track.json"))
-    # convert to set for faster lookup
-    interesting_lines = {filename: set(lines) for filename, lines in interesting_lines_list.items()}
+def read_intersting_lines(to_track_path="to_track.json") -> Dict[str, LineIntervals]:
+    """
+    The lines to trace from a JSON file of line numbers by relative file path.
+    """
+    with open(to_track_path) as f:
+        interesting_lines_list = json.load(f)
+    interesting_lines = {filename: LineIntervals.from_lines(lines) for filename, lines in interesting_lines_list.items()}
 
     print("Conftest.py has interesting files: ", interesting_lines.keys())
     return interesting_lines
 
-# indexed by file first, then line number
-file_info = defaultdict(lambda: defaultdict(list))
+class InterestingLinesIndex:
+    """
+    Resolves the relative paths of the tracked files against each co_filename only once,
+    so the hot path is one dict lookup plus a binary search over the intervals of the file.
+    Tracked lines are given as LineIntervals, or as any iterable of line numbers.
+    Files with no tracked lines map to an empty set.
+    """
+    def __init__(self, interesting_lines: Dict[str, LineIntervals | Iterable[int]]):
+        self.interesting_lines = {file: lines if isinstance(lines, LineIntervals) else LineIntervals.from_lines(lines)
+                                  for file, lines in interesting_lines.items()}
+        self._lines_by_filename: Dict[str, LineIntervals] = {}
+
+    def _resolve(self, filename: str) -> LineIntervals:
+        file_path = Path(filename)
+        lines = LineIntervals()
+        for file, file_lines in self.interesting_lines.items():
+            if file_path.match(file):
+                lines = lines.union(file_lines)
+        return lines
+
+    def lines_for(self, filename: str) -> LineIntervals:
+        lines = self._lines_by_filename.get(filename)
+        if lines is None:
+            lines = self._lines_by_filename[filename] = self._resolve(filename)
+        return lines
 
 """
 def pytest_collection_modifyitems(items):
@@ -37,17 +65,26 @@ def pytest_collection_modifyitems(items):
             item.add_marker(pytest.mark.timeout(target_timeout))
 """
 
-def represent_variable(var_name, var_value, is_init: bool):
+def represent_variable(var_name, var_value, is_init: bool, representer: VariableRepresenter, line_key=None):
     # Special handling for 'self' to check if it's partially initialized
     if is_init and var_name == 'self':
         return "<partially initialized object>"
     try:
-        return repr(var_value)
+        return representer.represent(var_value, line_key)
     except Exception as e:
-        return "<unrepresentable object> (error: {e})"
+        return f"<unrepresentable object> (error: {e})"
+
 
+def resolve_lines(locations) -> List[str]:
+    # source text is only looked up when a record is emitted
+    lines = (linecache.getline(filename, lineno).strip() for filename, lineno in locations)
+    return [line for line in lines if line]
 
-def trace_function(frame, event, arg, previous_lines, interesting_lines: Dict[str, Set[int]]) -> None:
+def trace_function(frame, event, arg, previous_lines: Deque[Tuple[str, int]], interesting_lines: InterestingLinesIndex,
+                   recorder: TraceRecorder, representer: VariableRepresenter) -> Tuple[str, int] | None:
+    """
+    Records the frame if its line is tracked; returns the (filename, line number) to add to the history, if any.
+    """
     if event not in ['line','call']:
         return None
     
@@ -58,77 +95,238 @@ def trace_function(frame, event, arg, previous_lines, interesting_lines: Dict[st
         return None
 
     filename = code.co_filename
-    file_path = Path(filename)
     lineno = frame.f_lineno
 
     is_init = event == 'call' and code.co_name == '__init__'
 
     try:
-        current_line = linecache.getline(filename, lineno).strip()
-        for file, lines  in interesting_lines.items():
-            if file_path.match(file) and lineno in lines:
-                local_vars = { var_name: represent_variable(var_name, var_value, is_init) for var_name, var_value in frame.f_locals.items() }
-                data = {
-                    "code_context": previous_lines,
-                    "target_line": current_line,
-                    "variables": local_vars,
-                }
-                with lock:
-                    file_info[filename][lineno].append(data)
+        if lineno in interesting_lines.lines_for(filename) and recorder.wants_sample(filename, lineno):
+            local_vars = { var_name: represent_variable(var_name, var_value, is_init, representer, (filename, lineno, var_name))
+                           for var_name, var_value in frame.f_locals.items() }
+            data = {
+                "code_context": resolve_lines(previous_lines),
+                "target_line": linecache.getline(filename, lineno).strip(),
+                "variables": local_vars,
+            }
+            recorder.record(filename, lineno, data)
     except Exception as e:
         print(f"Error processing {filename}:{lineno} {code.co_name}: {e}")
 
-    return current_line
+    return filename, lineno
 
 class TraceFunction:
-    def __init__(self, max_previous_lines=10):
-        self.interesting_lines = read_intersting_lines()
-        self.previous_lines = []
+    def __init__(self, recorder: TraceRecorder, max_previous_lines=10,
+                 interesting_lines: Dict[str, LineIntervals | Iterable[int]] | None = None,
+                 representer: VariableRepresenter | None = None):
+        if interesting_lines is None:
+            interesting_lines = {}
+        self.interesting_lines = InterestingLinesIndex(interesting_lines)
+        self.recorder = recorder
+        self.representer = representer if representer is not None else VariableRepresenter()
         self.max_previous_lines = max_previous_lines
+        # each thread keeps its own history, so contexts of concurrent threads don't mix
+        self.thread_state = threading.local()
+        # approximate with several threads: increments are not atomic
+        self.events = 0
+
+    @property
+    def previous_lines(self) -> Deque[Tuple[str, int]]:
+        """
+        Ring of the (filename, line number) pairs last executed by the current thread.
+        """
+        try:
+            return self.thread_state.previous_lines
+        except AttributeError:
+            previous_lines = self.thread_state.previous_lines = deque(maxlen=self.max_previous_lines)
+            return previous_lines
+
 
-    def _update_history(self, new_line: str | None):
-        if new_line:
-            self.previous_lines.append(new_line)
-            if len(self.previous_lines) > self.max_previous_lines:
-                self.previous_lines.pop(0)
-    
     def __call__(self, frame, event, arg):
-        new_line = trace_function(frame, event, arg, self.previous_lines, self.interesting_lines)
-        self._update_history(new_line)    
+        self.events += 1
+        if event == 'call' and not self.interesting_lines.lines_for(frame.f_code.co_filename):
+            # no local trace for frames in files without tracked lines: their line events are never delivered
+            return None
+        previous_lines = self.previous_lines
+        location = trace_function(frame, event, arg, previous_lines, self.interesting_lines, self.recorder, self.representer)
+        if location:
+            previous_lines.append(location)
         return self
 
+    def start(self):
+        sys.settrace(self)
+        threading.settrace(self)
+
+    def stop(self):
+        sys.settrace(None)
+        threading.settrace(None)
+
+
+class MonitoringTraceFunction(TraceFunction):
+    """
+    sys.monitoring (PEP 669) backend, available from Python 3.12.
+    Only PY_START is enabled globally: the first call of each code object decides whether it belongs to a file
+    with interesting lines. If so, LINE events are turned on for that code object alone, otherwise PY_START is
+    disabled for it and it is never seen again. Like the settrace backend, which traces every frame of such a file,
+    the code context then includes the lines of untracked helpers of the file.
+    For tracked code objects, PY_RESUME is turned on too and counts as a 'call', like the settrace backend
+    sees a generator or coroutine resuming, so both backends build the same code context. PY_THROW can't be
+    turned on per code object: a resume by throw() is only seen by its next LINE event, where settrace also
+    sees a 'call'.
+
+    DISABLE outlives the session and even sys.monitoring.free_tool_id(); stop() re-arms PY_START on the code
+    objects it disabled, rather than calling sys.monitoring.restart_events(), which would also re-arm the events
+    other tools disabled. When tool ids 3 and 4 are both taken, for instance by other tools, start() falls back
+    to sys.settrace.
+    """
+    def __init__(self, recorder: TraceRecorder, max_previous_lines=10,
+                 interesting_lines: Dict[str, LineIntervals | Iterable[int]] | None = None,
+                 representer: VariableRepresenter | None = None):
+        super().__init__(recorder, max_previous_lines, interesting_lines, representer)
+        self.tool_id = None
+        # code object -> whether LINE events are enabled for it
+        self.tracked_code = {}
+
+    def _is_tracked(self, code) -> bool:
+        return code.co_name != "<module>" and bool(self.interesting_lines.lines_for(code.co_filename))
+
+    def _on_py_start(self, code, instruction_offset):
+        is_tracked = self.tracked_code.get(code)
+        if is_tracked is None:
+            is_tracked = self.tracked_code[code] = self._is_tracked(code)
+            if is_tracked:
+                events = sys.monitoring.events
+                sys.monitoring.set_local_events(self.tool_id, code, events.LINE | events.PY_RESUME)
+        if not is_tracked:
+            return sys.monitoring.DISABLE
+        self(sys._getframe(1), 'call', None)
+
+    def _on_py_resume(self, code, instruction_offset):
+        self(sys._getframe(1), 'call', None)
+
+    def _on_line(self, code, line_number):
+        self(sys._getframe(1), 'line', None)
+
+    def start(self):
+        monitoring = sys.monitoring
+        # tool ids 0-2 and 5 are reserved for debuggers, coverage, profilers and optimizers
+        free_tool_ids = [tool_id for tool_id in (3, 4) if monitoring.get_tool(tool_id) is None]
+        if not free_tool_ids:
+            print("sys.monitoring tool ids 3 and 4 are taken: tracing with sys.settrace")
+            super().start()
+            return
+        self.tool_id = free_tool_ids[0]
+        monitoring.use_tool_id(self.tool_id, "myplugin")
+        events = monitoring.events
+        monitoring.register_callback(self.tool_id, events.PY_START, self._on_py_start)
+        monitoring.register_callback(self.tool_id, events.PY_RESUME, self._on_py_resume)
+        monitoring.register_callback(self.tool_id, events.LINE, self._on_line)
+        monitoring.set_events(self.tool_id, events.PY_START)
+
+    def stop(self):
+        if self.tool_id is None:
+            super().stop()
+            return
+        monitoring = sys.monitoring
+        events = monitoring.events
+        monitoring.set_events(self.tool_id, events.NO_EVENTS)
+        for code, is_tracked in self.tracked_code.items():
+            if not is_tracked:
+                # setting local events clears the DISABLE of PY_START, so the next session sees the code again
+                monitoring.set_local_events(self.tool_id, code, events.PY_START)
+            monitoring.set_local_events(self.tool_id, code, events.NO_EVENTS)
+        for event in (events.PY_START, events.PY_RESUME, events.LINE):
+            monitoring.register_callback(self.tool_id, event, None)
+        monitoring.free_tool_id(self.tool_id)
+        self.tool_id = None
+        self.tracked_code.clear()
+
+
+def make_trace_function(interesting_lines: Dict[str, LineIntervals | Iterable[int]], recorder: TraceRecorder, representer: VariableRepresenter) -> TraceFunction:
+    # sys.settrace is kept as the fallback for interpreters older than 3.12
+    if hasattr(sys, "monitoring"):
+        return MonitoringTraceFunction(recorder, interesting_lines=interesting_lines, representer=representer)
+    return TraceFunction(recorder, interesting_lines=interesting_lines, representer=representer)
+
+active_trace_function = None
+# trace events, tracked line hits and records of the last session, for the process that ran it
+last_session_stats = None
+
+def pytest_addoption(parser):
+    group = parser.getgroup("myplugin")
+    group.addoption("--trace-lines", action="append", default=[], metavar="PATH:INTERVALS",
+                    help="lines to trace in a file, by relative path, such as src/calc.py:2-5,9; can be repeated")
+    group.addoption("--to-track", default=None,
+                    help="JSON file with the lines to trace, by relative file path")
+    group.addoption("--trace-output", default="result.jsonl",
+                    help="where to write the tracing result, as JSON Lines")
+    group.addoption("--trace-max-samples", type=int, default=100,
+                    help="maximum number of records kept per traced line")
+    group.addoption("--trace-sampling", choices=SAMPLING_POLICIES, default="dedup",
+                    help="which records to keep once a line is hit more than --trace-max-samples times")
+    group.addoption("--trace-repr-depth", type=int, default=3,
+                    help="nesting depth shown in variable values")
+    group.addoption("--trace-repr-length", type=int, default=200,
+                    help="maximum length of strings and other reprs in variable values")
+    group.addoption("--trace-repr-items", type=int, default=20,
+                    help="maximum number of elements shown per container")
+    group.addoption("--trace-hash-seen", action="store_true", default=False,
+                    help="record values already seen on a line as their type and a hash")
+    group.addoption("--trace-objects", default=None,
+                    help="object store for the record payloads; the output then holds references to them")
 
 def pytest_sessionstart(session):
+    global active_trace_function, last_session_stats
+    last_session_stats = None
     if session.config.getoption("collectonly", default=False):
         print("Skipping trace setup due to --collect-only option")
         return
+    # tracing is opt-in, so sessions that only load the plugin through its entry point are left alone
+    interesting_lines = {file: LineIntervals(intervals) for file, intervals in
+                         parse_tracked_lines(session.config.getoption("trace_lines")).items()}
+    if session.config.getoption("to_track"):
+        for file, lines in read_intersting_lines(session.config.getoption("to_track")).items():
+            interesting_lines[file] = lines.union(interesting_lines.get(file, LineIntervals()))
+    if not interesting_lines:
+        return
 
-    trace_function_callable = TraceFunction()
-
-    sys.settrace(trace_function_callable)
-    threading.settrace(trace_function_callable)
+    recorder = TraceRecorder(session.config.getoption("trace_output"),
+                             max_samples=session.config.getoption("trace_max_samples"),
+                             policy=session.config.getoption("trace_sampling"),
+                             objects_path=session.config.getoption("trace_objects"))
+    representer = VariableRepresenter(max_depth=session.config.getoption("trace_repr_depth"),
+                                      max_length=session.config.getoption("trace_repr_length"),
+                                      max_items=session.config.getoption("trace_repr_items"),
+                                      hash_seen=session.config.getoption("trace_hash_seen"))
+    active_trace_function = make_trace_function(interesting_lines, recorder, representer)
+    active_trace_function.start()
 
 def pytest_sessionfinish(session, exitstatus):
+    global active_trace_function, last_session_stats
     if session.config.getoption("collectonly", default=False):
         print("Skipping trace setup due to --collect-only option")
         return
     
-    sys.settrace(None)
-    threading.settrace(None)
+    if active_trace_function is None:
+        return
+    active_trace_function.stop()
     print("Tracing stopped.")
-    process_tracing_data(debug = True)
+    process_tracing_data(active_trace_function.recorder, debug = True)
+    summary = active_trace_function.recorder.summary()
+    last_session_stats = {
+        "trace_events": active_trace_function.events,
+        "trace_hits": sum(hits for lines in summary.values() for hits, _ in lines.values()),
+        "trace_records": sum(kept for lines in summary.values() for _, kept in lines.values()),
+    }
+    active_trace_function = None
 
-def process_tracing_data(debug = False):
-    # save result to a file
-    with open('result.json', 'w') as f:
-        json.dump(file_info, f)
+def process_tracing_data(recorder: TraceRecorder, debug = False):
+    # flush the remaining records to the output file
+    recorder.close()
     # debug print
     if debug:
         print("Tracing result:")
-        for file, file_data in file_info.items():
-            print(f"File: {file}: {file_data}")
-            for line_no, line_runs in file_data.items():
-                print(f"Line {line_no}: executed {len(line_runs)} times")
-                for vars in line_runs:
-                    print(vars)
-                print("")
+        for file, file_data in recorder.summary().items():
+            print(f"File: {file}")
+            for line_no, (hits, kept) in sorted(file_data.items()):
+                print(f"Line {line_no}: executed {hits} times, {kept} records kept")
+            print("")
@@ -0,0 +1,130 @@
+import json
+import queue
+import random
+import threading
+from collections import defaultdict
+from pathlib import Path
+from typing import Dict, List, Tuple
+
+from .objects import ReferenceWriter, read_records
+
+SAMPLING_POLICIES = ("first", "dedup", "reservoir")
+
+class TraceRecorder:
+    """
+    Writes trace records to a JSON Lines file through a background writer thread, keeping at most
+    `max_samples` records per traced line, so a session uses constant memory however long it runs.
+
+    Sampling policies:
+    - "first": the first `max_samples` hits of each line;
+    - "dedup": the first `max_samples` hits with distinct variable values;
+    - "reservoir": a uniform sample of all hits, kept in memory and written when the recorder closes.
+
+    With `objects_path`, the payloads of the records go to that object store and the file holds references to them,
+    written in batches by the same thread (see myplugin.objects).
+    """
+    def __init__(self, output_path, max_samples: int = 100, policy: str = "dedup", queue_size: int = 10000, seed: int = 0,
+                 objects_path=None):
+        if policy not in SAMPLING_POLICIES:
+            raise ValueError(f"Unknown sampling policy {policy}, expected one of {SAMPLING_POLICIES}")
+        self.output_path = Path(output_path)
+        self.max_samples = max_samples
+        self.policy = policy
+        self.lock = threading.Lock()
+        # indexed by (file, line number)
+        self.hits: Dict[Tuple[str, int], int] = defaultdict(int)
+        self.kept: Dict[Tuple[str, int], int] = defaultdict(int)
+        self.seen_states: Dict[Tuple[str, int], set] = defaultdict(set)
+        self.reservoirs: Dict[Tuple[str, int], List[Dict]] = defaultdict(list)
+        self.random = random.Random(seed)
+
+        # a bounded queue: tracing blocks rather than piling up records when the disk is slow
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.output_file = open(self.output_path, 'w')
+        self.references = ReferenceWriter(objects_path, self.output_file, self.output_path.parent) if objects_path else None
+        self.writer = threading.Thread(target=self._write_records, name="trace-recorder", daemon=True)
+        self.writer.start()
+
+    def _write_records(self):
+        while True:
+            record = self.queue.get()
+            if record is None:
+                if self.references:
+                    self.references.close()
+                break
+            if self.references:
+                self.references.add(record)
+                continue
+            self.output_file.write(json.dumps(record))
+            self.output_file.write('\n')
+
+    def wants_sample(self, filename: str, lineno: int) -> bool:
+        """
+        Whether a hit of this line could be kept, so callers can skip building records that would be dropped.
+        Every call counts as a hit.
+        """
+        key = (filename, lineno)
+        with self.lock:
+            self.hits[key] += 1
+            if self.policy == "reservoir":
+                # Algorithm R: the n-th hit replaces a random sample with probability max_samples / n
+                return self.hits[key] <= self.max_samples or self.random.randrange(self.hits[key]) < self.max_samples
+            return self.kept[key] < self.max_samples
+
+    def record(self, filename: str, lineno: int, data: Dict):
+        key = (filename, lineno)
+        record = {"file": filename, "line": lineno, **data}
+        with self.lock:
+            if self.policy == "reservoir":
+                reservoir = self.reservoirs[key]
+                if len(reservoir) < self.max_samples:
+                    reservoir.append(record)
+                else:
+                    reservoir[self.random.randrange(self.max_samples)] = record
+                return
+            if self.kept[key] >= self.max_samples:
+                return
+            if self.policy == "dedup":
+                state = hash(tuple(sorted(data["variables"].items())))
+                if state in self.seen_states[key]:
+                    return
+                self.seen_states[key].add(state)
+            self.kept[key] += 1
+        self.queue.put(record)
+
+    def close(self):
+        for reservoir in self.reservoirs.values():
+            for record in reservoir:
+                self.kept[(record["file"], record["line"])] += 1
+                self.queue.put(record)
+        self.reservoirs.clear()
+        self.queue.put(None)
+        self.writer.join()
+        self.output_file.close()
+
+    def summary(self) -> Dict[str, Dict[int, Tuple[int, int]]]:
+        """
+        (hits, kept records) by file and line number.
+        """
+        result = defaultdict(dict)
+        for (filename, lineno), hits in self.hits.items():
+            result[filename][lineno] = (hits, self.kept[(filename, lineno)])
+        return result
+
+
+def read_trace_records(path) -> Dict[str, Dict[str, List[Dict]]]:
+    """
+    Loads a trace file into the nested layout of the former result.json: records by file, then by line number.
+    Accepts both the JSON Lines files written by TraceRecorder, with records or references, and the older
+    single-document .json files.
+    """
+    path = Path(path)
+    if path.suffix == '.json':
+        with open(path) as f:
+            return json.load(f)
+    file_info = defaultdict(lambda: defaultdict(list))
+    for record in read_records(path):
+        # the blob id added by the pipeline is the same for all records of a file
+        record.pop("blob", None)
+        file_info[record.pop("file")][str(record.pop("line"))].append(record)
+    return file_info
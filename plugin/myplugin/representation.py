@@ -0,0 +1,66 @@
+import hashlib
+import re
+import reprlib
+from collections import defaultdict
+from typing import Dict, Set, Tuple
+
+# the address in default reprs such as "<function f at 0x7f3a2c1e4af0>", which never repeats across runs
+ADDRESS = re.compile(r" at 0x[0-9A-Fa-f]+(?=>|$)")
+
+SCALAR_TYPES = (bool, float, complex, type(None), type(Ellipsis))
+
+# above this many values remembered for a variable on a line, new values are no longer hashed
+MAX_SEEN_PER_LINE = 10000
+
+class VariableRepresenter(reprlib.Repr):
+    """
+    Size-capped repr of traced variables, bounding the capture cost of each hit whatever the object sizes:
+    containers show at most `max_items` elements down to `max_depth` levels, strings and other reprs
+    are cut to `max_length` characters, objects with more than `max_items` elements are only summarised
+    by type and length, and default object reprs are formatted without their address.
+
+    With `hash_seen`, a value already recorded for the same variable on the same line is replaced by its type name
+    and a stable hash; `line_key` identifies that variable and line.
+    """
+    def __init__(self, max_depth: int = 3, max_length: int = 200, max_items: int = 20, hash_seen: bool = False):
+        super().__init__()
+        self.maxlevel = max_depth
+        self.maxstring = self.maxother = self.maxlong = max_length
+        self.maxlist = self.maxtuple = self.maxset = self.maxfrozenset = self.maxdeque = self.maxarray = self.maxdict = max_items
+        self.max_length = max_length
+        self.max_items = max_items
+        self.hash_seen = hash_seen
+        self.seen: Dict[Tuple, Set[str]] = defaultdict(set)
+
+    def repr_instance(self, obj, level):
+        cls = type(obj)
+        if cls.__repr__ is object.__repr__:
+            return f"<{cls.__module__}.{cls.__qualname__} object>"
+        if hasattr(cls, '__len__'):
+            try:
+                length = len(obj)
+            except Exception:
+                length = None
+            # repr of a large collection costs far more than the traced line
+            if isinstance(length, int) and length > self.max_items:
+                return f"<{cls.__module__}.{cls.__qualname__} of length {length}>"
+        text = ADDRESS.sub("", repr(obj))
+        if len(text) > self.max_length:
+            half = (self.max_length - 3) // 2
+            text = text[:half] + '...' + text[len(text) - half:]
+        return text
+
+    def represent(self, value, line_key: Tuple | None = None) -> str:
+        if type(value) in SCALAR_TYPES:
+            text = repr(value)
+        else:
+            text = self.repr(value)
+        if not self.hash_seen or line_key is None:
+            return text
+        digest = hashlib.blake2b(text.encode(errors='replace'), digest_size=8).hexdigest()
+        seen = self.seen[line_key]
+        if digest in seen:
+            return f"<{type(value).__name__} #{digest}>"
+        if len(seen) < MAX_SEEN_PER_LINE:
+            seen.add(digest)
+        return text
@@ -0,0 +1,143 @@
+"""
+Run log of process_repo: one JSON line per event of a run, and a summary of the throughput and the slowest commits.
+
+    python run_log.py Repos/requests/run_log.jsonl --top 10
+"""
+import argparse
+from collections import Counter, defaultdict
+from contextlib import contextmanager
+import json
+import resource
+import sys
+import threading
+import time
+from pathlib import Path
+from typing import Dict, Iterator, List
+
+
+def peak_rss_bytes(children: bool = False) -> int:
+    """
+    Peak resident set size of this process, or of its terminated children.
+    """
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN if children else resource.RUSAGE_SELF)
+    # kilobytes on Linux, bytes on macOS
+    return usage.ru_maxrss if sys.platform == "darwin" else usage.ru_maxrss * 1024
+
+
+class StageTimer:
+    """
+    Wall-clock duration of the named stages of one commit pair; a stage entered several times adds up.
+    """
+    def __init__(self):
+        self.durations: Dict[str, float] = defaultdict(float)
+
+    @contextmanager
+    def __call__(self, stage: str):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.durations[stage] += time.perf_counter() - start
+
+
+class RunLog:
+    """
+    Appends the records of a run to a JSON Lines file, tagged with the run id (its start time).
+    Only the main process writes; pool workers send their records back.
+    """
+    def __init__(self, path: Path, repo_name: str):
+        self.path = path
+        self.repo_name = repo_name
+        self.run = time.strftime("%Y-%m-%dT%H:%M:%S")
+        self.lock = threading.Lock()
+        path.parent.mkdir(parents=True, exist_ok=True)
+
+    def write(self, event: str, **fields):
+        record = {"run": self.run, "repo": self.repo_name, "event": event, "time": time.time(), **fields}
+        with self.lock, open(self.path, "a") as f:
+            f.write(json.dumps(record) + "\n")
+
+
+def read_run_log(path: Path) -> Iterator[Dict]:
+    with open(path) as f:
+        for line in f:
+            if line.strip():
+                yield json.loads(line)
+
+
+def summarize(records: List[Dict], top: int = 10) -> Dict:
+    """
+    Throughput, outcomes, time per stage and slowest commits of the records of one run.
+    """
+    commits = [record for record in records if record["event"] == "commit"]
+    processed = [record for record in commits if record["status"] != "skipped: already exists"]
+    outcomes = Counter(record["status"].split(":")[0] for record in commits)
+    skip_reasons = Counter(record["status"].split(": ", 1)[1] for record in commits if record["status"].startswith("skipped"))
+    for record in records:
+        if record["event"] == "plan":
+            skip_reasons.update(record["skipped"])
+
+    wall_time = 0.0
+    if processed:
+        wall_time = max(record["time"] for record in processed) - min(record["time"] - record["duration"] for record in processed)
+    stages = defaultdict(float)
+    for record in processed:
+        for stage, duration in record["stages"].items():
+            stages[stage] += duration
+
+    slowest = sorted(processed, key=lambda record: record["duration"], reverse=True)[:top]
+    return {
+        "commits": len(processed),
+        "outcomes": dict(outcomes),
+        "skip_reasons": dict(skip_reasons),
+        "wall_time": wall_time,
+        "commits_per_hour": len(processed) / wall_time * 3600 if wall_time else None,
+        "stages": dict(stages),
+        "trace_events": sum(record.get("trace_events", 0) for record in processed),
+        "trace_records": sum(record.get("trace_records", 0) for record in processed),
+        "result_bytes": sum(record.get("result_bytes", 0) for record in processed),
+        "peak_rss": max((record.get("peak_rss", 0) for record in processed), default=0),
+        "slowest": [{"parent": record["parent"], "duration": record["duration"], "status": record["status"],
+                     "stages": record["stages"]} for record in slowest],
+    }
+
+
+def print_summary(run: str, summary: Dict):
+    print(f"Run {run}: {summary['commits']} commit pairs in {summary['wall_time']:.1f}s", end="")
+    if summary["commits_per_hour"] is not None:
+        print(f" ({summary['commits_per_hour']:.1f} commits/hour)")
+    else:
+        print()
+    print(f"  outcomes: {summary['outcomes']}")
+    print(f"  skip reasons: {summary['skip_reasons']}")
+    print(f"  trace events: {summary['trace_events']}, records: {summary['trace_records']}, "
+          f"result size: {summary['result_bytes'] / 1e6:.1f}MB, peak RSS: {summary['peak_rss'] / 1e6:.0f}MB")
+    total = sum(summary["stages"].values())
+    for stage, duration in sorted(summary["stages"].items(), key=lambda item: item[1], reverse=True):
+        print(f"  {stage:<16}{duration:>10.1f}s {100 * duration / total if total else 0:>5.1f}%")
+    print("  slowest commits:")
+    for record in summary["slowest"]:
+        stages = ", ".join(f"{stage} {duration:.1f}s" for stage, duration in record["stages"].items())
+        print(f"    {record['parent']} {record['duration']:.1f}s ({record['status']}): {stages}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("path", type=Path, help="run log written by process_repo")
+    parser.add_argument("--top", type=int, default=10, help="number of slowest commits to show")
+    parser.add_argument("--all-runs", action="store_true", help="summarize every run, not only the last one")
+    args = parser.parse_args()
+
+    runs = defaultdict(list)
+    for record in read_run_log(args.path):
+        runs[record["run"]].append(record)
+    if not runs:
+        print(f"No runs in {args.path}")
+        return
+    selected = list(runs) if args.all_runs else [list(runs)[-1]]
+    for run in selected:
+        print_summary(run, summarize(runs[run], args.top))
+
+
+if __name__ == "__main__":
+    main()
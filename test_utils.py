@@ -1,10 +1,27 @@
-from contextlib import redirect_stderr
+import configparser
+from contextlib import contextmanager, redirect_stderr
+import fcntl
+from fnmatch import fnmatch
+import hashlib
 from io import StringIO
+import json
+import multiprocessing
+import os
+from pathlib import Path, PurePosixPath
 import sys
-from typing import List, Set
+import threading
+import tomllib
+from collections import defaultdict
+from typing import Dict, Iterable, List, Set, Tuple
 
+import pygit2
 import pytest
 
+from git_utils import iter_tree_files, looks_like_test_file
+from myplugin import plugin_module
+from myplugin.intervals import Intervals, intervals_intersect, to_intervals
+from run_log import peak_rss_bytes
+
 def extract_test_files(test_lines: List[str]) -> Set[str]:
     tests = set()
     for line in test_lines:
@@ -14,7 +31,70 @@ def extract_test_files(test_lines: List[str]) -> Set[str]:
         tests.add(file)
     return tests
 
-def collect_tests(pytest_args, test_estimate: int) -> Set[str]:
+# imported once by the fork server, so every isolated pytest session starts warm
+PRELOADED_MODULES = ['pytest', 'pygit2', 'myplugin.plugin_module', 'git_utils', 'run_log', 'test_utils']
+
+class IsolatedRunError(Exception):
+    """
+    An isolated pytest session timed out or its process died.
+    """
+
+def _get_forkserver_context():
+    context = multiprocessing.get_context('forkserver')
+    context.set_forkserver_preload(PRELOADED_MODULES)
+    return context
+
+def _call_in_child(connection, function, args):
+    try:
+        connection.send((True, function(*args)))
+    except BaseException as e:
+        connection.send((False, repr(e)))
+    finally:
+        connection.close()
+
+def run_isolated(function, *args, timeout: float | None = None):
+    """
+    Calls `function(*args)` in a child process forked from a server that already imported pytest,
+    pygit2 and the plugin, and returns its result. Modules of the repository under test never stay
+    cached between sessions.
+    Raises IsolatedRunError on timeout, crash or exception in the child.
+    """
+    context = _get_forkserver_context()
+    parent_connection, child_connection = context.Pipe(duplex=False)
+    process = context.Process(target=_call_in_child, args=(child_connection, function, args))
+    process.start()
+    child_connection.close()
+    try:
+        if not parent_connection.poll(timeout):
+            process.kill()
+            raise IsolatedRunError(f"{function.__name__} timed out after {timeout}s")
+        try:
+            ok, result = parent_connection.recv()
+        except EOFError:
+            process.join()
+            raise IsolatedRunError(f"{function.__name__} crashed with exit code {process.exitcode}")
+    finally:
+        parent_connection.close()
+        process.join()
+    if not ok:
+        raise IsolatedRunError(f"{function.__name__} failed: {result}")
+    return result
+
+def run_pytest(pytest_args) -> int:
+    return int(pytest.main(pytest_args))
+
+def run_traced_pytest(pytest_args) -> Tuple[int, Dict]:
+    """
+    Runs pytest with the myplugin tracer and returns the exit code and the stats of the session:
+    trace events, tracked line hits and records (see plugin_module.last_session_stats) and peak RSS.
+    Meant to run in a child process (see run_isolated), so the peak RSS is the session's own.
+    """
+    exit_code = run_pytest(pytest_args)
+    stats = dict(plugin_module.last_session_stats or {})
+    stats["peak_rss"] = peak_rss_bytes()
+    return exit_code, stats
+
+def _collect_test_ids(pytest_args) -> List[str]:
     collected_lines = []
 
     class CollectPlugin:
@@ -32,7 +112,318 @@ def collect_tests(pytest_args, test_estimate: int) -> Set[str]:
     else:
         print("Pytest collection completed successfully.")
 
-    return extract_test_files(collected_lines)
+    return collected_lines
+
+def collect_test_ids(pytest_args, timeout: float | None = None) -> List[str]:
+    return run_isolated(_collect_test_ids, pytest_args, timeout=timeout)
+
+def collect_tests(pytest_args) -> Set[str]:
+    return extract_test_files(collect_test_ids(pytest_args))
+
+def load_json(path: Path) -> Dict:
+    if not path.exists():
+        return {}
+    with open(path) as f:
+        return json.load(f)
+
+@contextmanager
+def file_lock(path: Path):
+    """
+    Holds an exclusive lock on `path` with a ".lock" suffix, across processes.
+    """
+    path.parent.mkdir(parents=True, exist_ok=True)
+    with open(path.with_name(f"{path.name}.lock"), 'w') as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+def save_merged_json(path: Path, data: Dict) -> Dict:
+    """
+    Merges `data` into what other processes saved at `path` meanwhile, then replaces the file atomically.
+    The merge holds a lock on the file, so concurrent savers don't lose each other's entries.
+    Returns the merged dictionary.
+    """
+    with file_lock(path):
+        merged = load_json(path)
+        merged.update(data)
+        tmp_path = path.with_name(f"{path.name}.{os.getpid()}.tmp")
+        with open(tmp_path, 'w') as f:
+            json.dump(merged, f)
+        os.replace(tmp_path, path)
+    return merged
+
+# files whose changes can alter what pytest collects anywhere in the repo
+PYTEST_CONFIG_FILES = ('pytest.ini', 'pyproject.toml', 'setup.cfg', 'tox.ini')
+DEFAULT_PYTHON_FILES = ['test_*.py', '*_test.py']
+
+def python_files_patterns(tree: pygit2.Tree) -> List[str]:
+    """
+    The python_files patterns of the pytest configuration at the root of `tree`. Like pytest, takes pytest.ini
+    if there is one, else the first of pyproject.toml, tox.ini and setup.cfg with a pytest section.
+    """
+    for name, section in (('pytest.ini', 'pytest'), ('pyproject.toml', None), ('tox.ini', 'pytest'), ('setup.cfg', 'tool:pytest')):
+        if name not in tree:
+            continue
+        text = tree[name].data.decode(errors='replace')
+        if section is None:
+            try:
+                options = tomllib.loads(text).get('tool', {}).get('pytest', {}).get('ini_options')
+            except tomllib.TOMLDecodeError:
+                continue
+            if options is None:
+                continue
+            patterns = options.get('python_files')
+            if isinstance(patterns, str):
+                patterns = patterns.split()
+        else:
+            parser = configparser.ConfigParser(interpolation=None, strict=False)
+            try:
+                parser.read_string(text)
+            except configparser.Error:
+                continue
+            if not parser.has_section(section):
+                # pytest.ini is the configuration even without a [pytest] section
+                if name == 'pytest.ini':
+                    return DEFAULT_PYTHON_FILES
+                continue
+            patterns = parser.get(section, 'python_files', fallback='').split()
+        return list(patterns) if patterns else DEFAULT_PYTHON_FILES
+    return DEFAULT_PYTHON_FILES
+
+def matches_python_files(path: str, patterns: List[str]) -> bool:
+    """
+    Whether pytest collects the repo-relative `path` when it finds it in a directory: patterns without a slash
+    match the file name, the others the end of the path.
+    """
+    name = PurePosixPath(path).name
+    return any(fnmatch(f"/{path}", f"*/{pattern}") if '/' in pattern else fnmatch(name, pattern) for pattern in patterns)
+
+class TestDiscoveryCache:
+    """
+    Collected test ids per test file, keyed by the blob ids of the file, of the conftest.py files
+    above it and of the pytest configuration files. Only files whose key is not cached are collected again;
+    files no longer in the tree are simply not reported. Candidate files that the python_files patterns of the
+    configuration exclude are reported without tests.
+    The cache is saved as JSON, so restarting a run does not pay for discovery again.
+    """
+    # keep pytest from collecting this class
+    __test__ = False
+
+    def __init__(self, cache_path: Path, timeout: float | None = None):
+        self.cache_path = cache_path
+        self.timeout = timeout
+        self.tests_by_key: Dict[str, List[str]] = self._load()
+
+    def _load(self) -> Dict[str, List[str]]:
+        return load_json(self.cache_path)
+
+    def _save(self):
+        self.tests_by_key = save_merged_json(self.cache_path, self.tests_by_key)
+
+    @staticmethod
+    def _file_keys(tree: pygit2.Tree) -> Dict[str, str]:
+        test_files = {}
+        conftests = {}
+        config_ids = []
+        for path, oid in iter_tree_files(tree):
+            if PurePosixPath(path).name == 'conftest.py':
+                conftests[str(PurePosixPath(path).parent)] = str(oid)
+            if path in PYTEST_CONFIG_FILES:
+                config_ids.append(f"{path}:{oid}")
+            if looks_like_test_file(path):
+                test_files[path] = str(oid)
+
+        keys = {}
+        for path, oid in test_files.items():
+            parents = [str(parent) for parent in reversed(PurePosixPath(path).parents)]
+            key_parts = [path, oid] + [conftests[parent] for parent in parents if parent in conftests] + sorted(config_ids)
+            keys[path] = hashlib.sha1('\0'.join(key_parts).encode()).hexdigest()
+        return keys
+
+    def collect(self, tree: pygit2.Tree, repo_path: Path, pytest_args: List[str]) -> Dict[str, List[str]]:
+        """
+        Returns the collected test ids of every test file in `tree`, which must be checked out at `repo_path`.
+        `pytest_args` are the options to use, without the paths to collect.
+        """
+        keys = self._file_keys(tree)
+        stale = sorted(path for path, key in keys.items() if key not in self.tests_by_key)
+        if stale:
+            print(f"Collecting tests in {len(stale)} new or changed files; {len(keys) - len(stale)} cached")
+            collected: Dict[str, List[str]] = {path: [] for path in stale}
+            # pytest collects any file given as an argument, helpers and __init__.py files under tests/ included
+            patterns = python_files_patterns(tree)
+            test_files = [path for path in stale if matches_python_files(path, patterns)]
+            if test_files:
+                for test_id in collect_test_ids(pytest_args + [str(repo_path.joinpath(path)) for path in test_files], timeout=self.timeout):
+                    file = test_id.split('::', 1)[0]
+                    if file in collected:
+                        collected[file].append(test_id)
+            for path in stale:
+                self.tests_by_key[keys[path]] = collected[path]
+            self._save()
+        return {path: self.tests_by_key[key] for path, key in keys.items()}
+
+# ========================================================================================================
+
+class FootprintPlugin:
+    """
+    Records which lines of the files under `root` each test executes, setup and teardown included.
+    Uses sys.monitoring where available: LINE events are only turned on for code objects under `root`, and
+    PY_START is disabled for the others. Lines keep reporting while their test runs, so that no test has to
+    re-arm events with sys.monitoring.restart_events(), which would also re-arm those of other tools.
+    Falls back to sys.settrace when tool ids 3 to 5 are all taken.
+    """
+    def __init__(self, root: Path):
+        self.root = str(root.absolute()) + os.sep
+        self.footprints: Dict[str, Dict[str, Set[int]]] = {}
+        self._executed: Set[Tuple[str, int]] = set()
+        self._tool_id = None
+        # code object -> whether LINE events are enabled for it
+        self._code_under_root = {}
+
+    def _on_py_start(self, code, instruction_offset):
+        if code not in self._code_under_root:
+            under_root = self._code_under_root[code] = code.co_filename.startswith(self.root)
+            if under_root:
+                sys.monitoring.set_local_events(self._tool_id, code, sys.monitoring.events.LINE)
+        if not self._code_under_root[code]:
+            return sys.monitoring.DISABLE
+        # the line settrace reports with the 'call' event
+        self._executed.add((code.co_filename, code.co_firstlineno))
+
+    def _on_line(self, code, line_number):
+        self._executed.add((code.co_filename, line_number))
+
+    def _trace_lines(self, frame, event, arg):
+        if event == 'line':
+            self._executed.add((frame.f_code.co_filename, frame.f_lineno))
+        return self._trace_lines
+
+    def _trace_calls(self, frame, event, arg):
+        if not frame.f_code.co_filename.startswith(self.root):
+            return None
+        self._executed.add((frame.f_code.co_filename, frame.f_lineno))
+        return self._trace_lines
+
+    def pytest_sessionstart(self, session):
+        if not hasattr(sys, "monitoring"):
+            return
+        monitoring = sys.monitoring
+        # tool ids 0-2 belong to debuggers, coverage and profilers
+        for tool_id in (3, 4, 5):
+            try:
+                monitoring.use_tool_id(tool_id, "footprint")
+            except ValueError:
+                continue
+            self._tool_id = tool_id
+            monitoring.register_callback(tool_id, monitoring.events.PY_START, self._on_py_start)
+            monitoring.register_callback(tool_id, monitoring.events.LINE, self._on_line)
+            return
+        print("sys.monitoring tool ids 3 to 5 are taken: recording footprints with sys.settrace")
+
+    def pytest_sessionfinish(self, session, exitstatus):
+        if self._tool_id is None:
+            return
+        monitoring = sys.monitoring
+        for code, under_root in self._code_under_root.items():
+            if not under_root:
+                # setting local events clears the DISABLE of PY_START
+                monitoring.set_local_events(self._tool_id, code, monitoring.events.PY_START)
+            monitoring.set_local_events(self._tool_id, code, monitoring.events.NO_EVENTS)
+        monitoring.register_callback(self._tool_id, monitoring.events.PY_START, None)
+        monitoring.register_callback(self._tool_id, monitoring.events.LINE, None)
+        monitoring.free_tool_id(self._tool_id)
+        self._tool_id = None
+        self._code_under_root.clear()
+
+    @pytest.hookimpl(hookwrapper=True)
+    def pytest_runtest_protocol(self, item, nextitem):
+        self._executed = set()
+        if self._tool_id is not None:
+            sys.monitoring.set_events(self._tool_id, sys.monitoring.events.PY_START)
+        else:
+            sys.settrace(self._trace_calls)
+            threading.settrace(self._trace_calls)
+        try:
+            yield
+        finally:
+            if self._tool_id is not None:
+                sys.monitoring.set_events(self._tool_id, sys.monitoring.events.NO_EVENTS)
+            else:
+                sys.settrace(None)
+                threading.settrace(None)
+        footprint = defaultdict(set)
+        for filename, lineno in self._executed:
+            footprint[filename[len(self.root):].replace(os.sep, '/')].add(lineno)
+        self.footprints[item.nodeid] = footprint
+
+def _record_footprints(repo_path: Path, pytest_args) -> Tuple[int, Dict[str, Dict[str, Set[int]]]]:
+    plugin = FootprintPlugin(repo_path)
+    result = pytest.main(pytest_args, plugins=[plugin])
+    return int(result), {test_id: dict(files) for test_id, files in plugin.footprints.items()}
+
+class TestFootprints:
+    """
+    Maps each test id to the lines it executes, per repo-relative file, to run only the tests that
+    can reach the modified lines of a commit pair.
+    A footprint remembers the blob ids of the files it covers: it is recorded again only for tests that are new,
+    whose test file changed, or that touch any file whose content differs from when it was recorded. Footprints
+    can be many commits old, and a changed file can reach the modified lines by new paths.
+    Saved as JSON next to the test discovery cache.
+    """
+    # keep pytest from collecting this class
+    __test__ = False
+
+    def __init__(self, footprints_path: Path, timeout: float | None = None):
+        self.footprints_path = footprints_path
+        self.timeout = timeout
+        self.footprints: Dict[str, Dict] = load_json(footprints_path)
 
+    def _is_stale(self, test_id: str, test_file: str, blobs: Dict[str, str]) -> bool:
+        footprint = self.footprints.get(test_id)
+        if footprint is None or footprint["test_blob"] != blobs.get(test_file):
+            return True
+        return any(entry["blob"] != blobs.get(file) for file, entry in footprint["files"].items())
 
+    def update(self, tree: pygit2.Tree, repo_path: Path, pytest_options: List[str], tests_by_file: Dict[str, List[str]]):
+        """
+        Records the footprints that are missing or stale for this commit pair by running those tests,
+        with `tree` checked out at `repo_path`.
+        """
+        blobs = {path: str(oid) for path, oid in iter_tree_files(tree)}
+        stale = [test_id for file, test_ids in tests_by_file.items() for test_id in test_ids
+                 if self._is_stale(test_id, file, blobs)]
+        if not stale:
+            return
+        print(f"Recording the footprint of {len(stale)} tests")
+        pytest_args = ['-q', '-p', 'no:cacheprovider', '-p', 'no:myplugin'] + pytest_options + [f"{repo_path}/{test_id}" for test_id in stale]
+        result, footprints = run_isolated(_record_footprints, repo_path, pytest_args, timeout=self.timeout)
+        if result not in (pytest.ExitCode.OK, pytest.ExitCode.TESTS_FAILED):
+            print(f"Pytest encountered errors while recording footprints, code: {result}")
+        recorded = {}
+        for test_id in stale:
+            files = footprints.get(test_id, {})
+            recorded[test_id] = {
+                "test_blob": blobs.get(test_id.split('::', 1)[0]),
+                "files": {file: {"blob": blobs.get(file), "lines": to_intervals(lines)} for file, lines in files.items()},
+            }
+        self.footprints = save_merged_json(self.footprints_path, recorded)
 
+    def select(self, modified_lines: Dict[str, Intervals], tests_by_file: Dict[str, List[str]],
+               skip_files: Iterable[str] = ()) -> List[str]:
+        """
+        Ids of the tests, outside `skip_files`, whose footprint overlaps `modified_lines` (intervals by file).
+        """
+        skip_files = set(skip_files)
+        selected = []
+        for file, test_ids in tests_by_file.items():
+            if file in skip_files:
+                continue
+            for test_id in test_ids:
+                files = self.footprints.get(test_id, {}).get("files", {})
+                if any(modified_file in files and intervals_intersect(files[modified_file]["lines"], lines)
+                       for modified_file, lines in modified_lines.items()):
+                    selected.append(test_id)
+        return selected
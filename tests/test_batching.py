@@ -0,0 +1,42 @@
+import numpy as np
+
+from ..batching import LengthBucketSampler, PaddingCollator, TokenDataset, fit_to_length
+from ..token_cache import TokenCache
+from .test_token_cache import WordTokenizer, item
+
+
+def test_fit_to_length_keeps_the_target_line_and_variables():
+    # start token, 10 context tokens, 4 target and variable tokens, end token
+    input_ids = np.concatenate([[0], np.arange(100, 110), np.arange(200, 204), [2]])
+    assert fit_to_length(input_ids, 11, 16)[0] is input_ids
+    assert fit_to_length(input_ids, 11, 10, "truncate")[0].tolist() == [0] + list(range(100, 108)) + [2]
+    assert fit_to_length(input_ids, 11, 10, "keep_target")[0].tolist() == [0, 106, 107, 108, 109, 200, 201, 202, 203, 2]
+    windows = fit_to_length(input_ids, 11, 10, "window", stride=1)
+    assert [window[1:5].tolist() for window in windows] == [[100, 101, 102, 103], [103, 104, 105, 106], [106, 107, 108, 109]]
+    assert all(window[5:].tolist() == [200, 201, 202, 203, 2] for window in windows)
+    # no room for any context
+    assert fit_to_length(input_ids, 11, 5, "window")[0].tolist() == [0, 100, 101, 102, 2]
+
+
+def test_buckets_and_dynamic_padding(tmp_path):
+    cache = TokenCache(tmp_path / "cache")
+    items = [item(x) for x in range(6)]
+    entries = cache.encode(items, "words", loader=WordTokenizer)
+    dataset = TokenDataset(cache, entries, [0, 1, 0, 1, 0, 1], max_length=12, strategy="window")
+    assert len(dataset) > len(items) and dataset.lengths.max() == 12
+    assert set(dataset.data_points.tolist()) == set(range(6))
+
+    lengths = np.array([5, 40, 6, 41, 7, 100, 8])
+    sampler = LengthBucketSampler(lengths, batch_size=2, bucket_width=32, shuffle=True)
+    batches = list(sampler)
+    assert len(batches) == len(sampler) == 4
+    assert sorted(index for batch in batches for index in batch) == list(range(7))
+    assert all(len(set(lengths[batch] // 32)) == 1 for batch in batches)
+    assert len(LengthBucketSampler(lengths, batch_size=2, drop_last=True)) == 3
+
+    collator = PaddingCollator(pad_token_id=1, return_tensors="np")
+    batch = collator([{"input_ids": np.array([0, 5, 2]), "labels": 1}, {"input_ids": np.array([0, 2]), "labels": 0}])
+    assert batch["input_ids"].tolist() == [[0, 5, 2], [0, 2, 1]]
+    assert batch["attention_mask"].tolist() == [[1, 1, 1], [1, 1, 0]]
+    assert batch["labels"].tolist() == [1, 0]
+    assert PaddingCollator(1, pad_to_multiple_of=8, return_tensors="np")([dataset[0]])["input_ids"].shape == (1, 16)
@@ -0,0 +1,73 @@
+import json
+
+from ..catalog import Catalog, index_data_dir, index_payload
+
+
+def write_payload(path, records):
+    path.parent.mkdir(parents=True, exist_ok=True)
+    with open(path, "w") as f:
+        for record in records:
+            f.write(json.dumps(record) + "\n")
+
+
+def record(line, x):
+    return {"file": "/repos/demo/code/pkg/calc.py", "line": line, "code_context": ["a = 1"],
+            "target_line": "return a + b", "variables": {"a": repr(x)}}
+
+
+def test_pairs_lines_and_records(tmp_path):
+    payload = tmp_path / "data/demo/c1/negative_example.jsonl"
+    write_payload(payload, [record(2, 1), record(3, "é"), record(2, 5)])
+    index = index_payload(payload, tmp_path / "elsewhere")
+    data = payload.read_bytes()
+    assert [json.loads(data[offset:offset + length]) for _, _, offset, length, _ in index] == [record(2, 1), record(3, "é"), record(2, 5)]
+    assert index[0][0] == "/repos/demo/code/pkg/calc.py"
+
+    entry = {"parent": "c1", "child": "c2", "commit_time": 10, "modified_lines": {"old": {"pkg/calc.py": [[2, 2], [9, 9]]}, "new": {}}}
+    index = [("pkg/calc.py", line, offset, length, count) for _, line, offset, length, count in index]
+    with Catalog(tmp_path / "catalog.sqlite") as catalog:
+        catalog.record_pair("demo", entry, "done", 1.5, {0: (payload, index)})
+        catalog.record_pair("demo", {"parent": "c3", "child": "c4", "commit_time": 20}, "skipped: not a bugfix")
+        # a second connection, as another run would have
+        with Catalog(tmp_path / "catalog.sqlite") as other:
+            other.record_pair("demo", {"parent": "c5", "child": "c6", "commit_time": 30}, "failed: timed out")
+            assert other.finished("demo") == {"c1", "c3"}
+
+        assert [row["reason"] for row in catalog.pairs("demo")] == [None, "not a bugfix", "timed out"]
+        assert [row["records"] for row in catalog.examples("demo")] == [3]
+        lines = catalog.connection.execute("SELECT line, records FROM lines ORDER BY line").fetchall()
+        assert [tuple(row) for row in lines] == [(2, 2), (3, 1), (9, 0)]
+        assert [r["variables"]["a"] for r in catalog.read_records("demo", "c1", 0, line=2)] == ["1", "5"]
+        assert [r["variables"]["a"] for r in catalog.read_records("demo", "c1", 0)] == ["1", "'é'", "5"]
+
+        # recording a pair again replaces its lines and records
+        catalog.record_pair("demo", entry, "done", 1.0, {0: (payload, index[:1])})
+        assert catalog.stats() == {"pairs": {"done": 1, "skipped": 1, "failed": 1}, "examples": 1,
+                                   "bytes": payload.stat().st_size, "tracked_lines": 2, "hit_lines": 1, "references": 1,
+                                   "records": 1}
+
+
+def test_index_data_dir(tmp_path):
+    write_payload(tmp_path / "data/demo/c1/negative_example.jsonl", [record(2, 1)])
+    write_payload(tmp_path / "data/demo/c1/positive_example.jsonl", [record(2, 2), record(3, 2)])
+    (tmp_path / "data/demo/c2").mkdir()
+    with Catalog(tmp_path / "catalog.sqlite") as catalog:
+        assert index_data_dir(catalog, tmp_path / "data", tmp_path / "Repos") == 2
+        assert index_data_dir(catalog, tmp_path / "data", tmp_path / "Repos") == 0
+        assert catalog.finished("demo") == {"c1", "c2"}
+        assert [(row["label"], row["records"]) for row in catalog.examples("demo")] == [(0, 1), (1, 2)]
+
+
+def test_job_states(tmp_path):
+    entries = [{"parent": f"c{i}", "child": f"c{i + 1}", "commit_time": i} for i in range(3)]
+    with Catalog(tmp_path / "catalog.sqlite") as catalog:
+        catalog.record_pair("demo", entries[0], "done", 1.0)
+        catalog.add_pending("demo", entries)
+        catalog.set_running("demo", "c1")
+        assert [row["status"] for row in catalog.pairs("demo")] == ["done", "running", "pending"]
+        # an interrupted run leaves c1 running: it is processed again, like the pending pairs
+        assert catalog.finished("demo") == {"c0"}
+        catalog.record_pair("demo", entries[1], "failed: timed out", 2.0)
+        catalog.add_pending("demo", entries)
+        assert [(row["status"], row["reason"]) for row in catalog.pairs("demo")] == [
+            ("done", None), ("failed", "timed out"), ("pending", None)]
@@ -0,0 +1,86 @@
+import json
+
+from ..dataset_store import DatasetStore, DatasetWriter, convert_data_dir, read_example
+
+
+def write_example(path, records):
+    path.parent.mkdir(parents=True, exist_ok=True)
+    with open(path, "w") as f:
+        for record in records:
+            f.write(json.dumps(record) + "\n")
+
+
+def record(line, x, context=("a = 1",)):
+    return {"file": "/repos/demo/code/pkg/calc.py", "line": line, "code_context": list(context),
+            "target_line": "return a + b", "variables": {"a": repr(x), "b": "2"}}
+
+
+def test_convert_filter_and_append(tmp_path):
+    data_path = tmp_path / "data"
+    write_example(data_path / "demo/c1/negative_example.jsonl", [record(2, 1), record(2, 3, ())])
+    write_example(data_path / "demo/c1/positive_example.jsonl", [record(3, 1)])
+    write_example(data_path / "other/c2/positive_example.jsonl", [record(5, "é")])
+
+    assert convert_data_dir(data_path, tmp_path / "dataset") == 2
+    store = DatasetStore(tmp_path / "dataset")
+    assert len(store) == 4
+    assert store.commits() == {("demo", "c1"), ("other", "c2")}
+    # repeated strings are stored once
+    assert store.meta["strings"] == 13
+
+    negative = list(store.records(store.select(repo="demo", label=0)))
+    assert negative == [
+        {"repo": "demo", "commit": "c1", "label": 0, **record(2, 1)},
+        {"repo": "demo", "commit": "c1", "label": 0, **record(2, 3, ())},
+    ]
+    assert [r["variables"]["a"] for r in store.records(store.select(commit="c2"))] == ["'é'"]
+    assert len(store.select(repo="missing")) == 0
+
+    # only new commits are appended
+    write_example(data_path / "demo/c3/positive_example.jsonl", [record(7, 9)])
+    assert convert_data_dir(data_path, tmp_path / "dataset") == 1
+    store = DatasetStore(tmp_path / "dataset")
+    assert len(store) == 5
+    assert [r["line"] for r in store.records(store.select(commit="c3"))] == [7]
+    assert [r["line"] for r in store.records(store.select(commit="c1"))] == [2, 2, 3]
+
+
+def test_interrupted_append_is_ignored(tmp_path):
+    data_path = tmp_path / "data"
+    write_example(data_path / "demo/c1/negative_example.jsonl", [record(2, 1)])
+    convert_data_dir(data_path, tmp_path / "dataset")
+    # rows written without the meta.json update that commits them
+    with open(tmp_path / "dataset/line.col", "ab") as f:
+        f.write(b"\xff" * 12)
+    assert len(DatasetStore(tmp_path / "dataset")) == 1
+
+    write_example(data_path / "demo/c2/negative_example.jsonl", [record(4, 1)])
+    convert_data_dir(data_path, tmp_path / "dataset")
+    store = DatasetStore(tmp_path / "dataset")
+    assert [r["line"] for r in store.records()] == [2, 4]
+
+
+def test_code_windows_come_from_interned_blobs(tmp_path):
+    source = "".join(f"line {i}\n" for i in range(1, 21)).encode()
+    blobs = {"b1": source, "b2": b"def f():\n    return 1\n"}
+    records = [dict(record(line, 1), blob="b1") for line in (1, 10, 20)]
+    records += [dict(record(2, 1), blob="b2"), dict(record(3, 1), blob="b2"), dict(record(2, 1), blob="missing"), record(2, 1)]
+    data_path = tmp_path / "data"
+    write_example(data_path / "demo/c1/negative_example.jsonl", records)
+    with DatasetWriter(tmp_path / "dataset") as writer:
+        writer.append_commit("demo", "c1", {0: read_example(data_path / "demo/c1/negative_example.jsonl")}, blobs.get)
+
+    store = DatasetStore(tmp_path / "dataset")
+    # each blob is stored once, whatever the number of records
+    assert store.meta["blobs"] == 2
+    lines = source.decode().splitlines()
+    assert store.code_windows(range(len(store)), window_size=2) == [
+        ("\n".join(lines[0:3]), "line 1"),
+        ("\n".join(lines[7:12]), "line 10"),
+        ("\n".join(lines[17:20]), "line 20"),
+        ("def f():\n    return 1", "return 1"),
+        # beyond the end of the file, and unknown sources
+        None,
+        None,
+        None,
+    ]
@@ -0,0 +1,217 @@
+import hashlib
+import importlib
+import json
+import threading
+import time
+import types
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+import pygit2
+import pytest
+
+from .test_test_utils import commit_files
+
+def sha(name):
+    return hashlib.sha1(name.encode()).hexdigest()
+
+REPOS = {"r1": [sha("a1"), sha("a2"), sha("a3"), sha("a4")], "r2": [sha("b1"), sha("b2")]}
+# commits that touch a test file
+TEST_COMMITS = {sha("a2"), sha("a4"), sha("b1")}
+
+
+class FakeGitHub(BaseHTTPRequestHandler):
+    """
+    Mimics the GitHub endpoints used by the crawler, with rate-limit headers.
+    Every response has an ETag, and the first request for commit a3 is rejected as over the limit.
+    /secondary/<n>[/<retry-after>] is rejected by a secondary limit, with only a Retry-After header, n times.
+    """
+    lock = threading.Lock()
+    in_flight = 0
+    max_in_flight = 0
+    requests = 0
+    rejected = set()
+    secondary = {}
+
+    def send_secondary_limit(self, retry_after):
+        body = json.dumps({"message": "You have exceeded a secondary rate limit"}).encode()
+        self.send_response(403)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        if retry_after:
+            self.send_header("Retry-After", retry_after)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def send_json(self, data, status=200, remaining=1000):
+        body = json.dumps(data).encode()
+        etag = f'"{hashlib.sha1(body).hexdigest()}"'
+        if status == 200 and self.headers.get("If-None-Match") == etag:
+            status, body = 304, b""
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("ETag", etag)
+        self.send_header("Content-Length", str(len(body)))
+        self.send_header("X-RateLimit-Remaining", str(remaining))
+        self.send_header("X-RateLimit-Reset", str(int(time.time()) + 1))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        cls = type(self)
+        with cls.lock:
+            cls.requests += 1
+            cls.in_flight += 1
+            cls.max_in_flight = max(cls.max_in_flight, cls.in_flight)
+        try:
+            time.sleep(0.02)
+            self.route()
+        finally:
+            with cls.lock:
+                cls.in_flight -= 1
+
+    def route(self):
+        url = urlparse(self.path)
+        query = parse_qs(url.query)
+        parts = url.path.strip("/").split("/")
+        if parts[0] == "secondary":
+            with self.lock:
+                self.secondary[url.path] = self.secondary.get(url.path, 0) + 1
+                if self.secondary[url.path] <= int(parts[1]):
+                    return self.send_secondary_limit(parts[2] if len(parts) > 2 else None)
+            return self.send_json({"ok": True})
+        if parts == ["search", "repositories"]:
+            return self.send_json({"items": [{"owner": {"login": "o"}, "name": name} for name in REPOS]})
+        repo = parts[2]
+        if len(parts) == 3:
+            return self.send_json({"default_branch": "main"})
+        if len(parts) == 4:
+            page = int(query["page"][0])
+            return self.send_json([{"sha": sha} for sha in REPOS[repo]] if page == 1 else [])
+        sha = parts[4]
+        if sha == REPOS["r1"][2] and sha not in self.rejected:
+            self.rejected.add(sha)
+            return self.send_json({"message": "API rate limit exceeded"}, status=403, remaining=0)
+        filename = "tests/test_x.py" if sha in TEST_COMMITS else "src/x.py"
+        return self.send_json({"files": [{"filename": filename}, {"filename": "src/y.py"}]})
+
+    def log_message(self, format, *args):
+        pass
+
+
+@pytest.fixture
+def get_code():
+    return importlib.import_module("get_code")
+
+
+@pytest.fixture
+def server():
+    FakeGitHub.rejected.clear()
+    FakeGitHub.secondary.clear()
+    server = ThreadingHTTPServer(("127.0.0.1", 0), FakeGitHub)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def test_crawler_writes_commits_touching_tests(get_code, server, tmp_path):
+    crawler = get_code.GitHubCrawler(api_url=f"http://127.0.0.1:{server.server_port}", max_in_flight=4,
+                                     output_path=tmp_path / "data", cache=get_code.HTTPCache(tmp_path / "cache"))
+    counts = crawler.crawl(1, 2)
+
+    written = sorted(path.parent.name for path in (tmp_path / "data").glob("o/*/commit_*/*/files.json"))
+    assert written == sorted(TEST_COMMITS)
+    assert counts == {"repositories": 2, "commits": 6, "files": 3}
+    a2 = REPOS["r1"][1]
+    with open(tmp_path / f"data/o/r1/commit_{a2}/{a2}/files.json") as f:
+        assert json.load(f)[0]["filename"] == "tests/test_x.py"
+    # a3 was retried after the rate limit reset
+    assert REPOS["r1"][2] in FakeGitHub.rejected
+    assert 1 < FakeGitHub.max_in_flight <= 4
+
+
+def test_second_crawl_is_served_from_the_cache(get_code, server, tmp_path):
+    cache = get_code.HTTPCache(tmp_path / "cache")
+    api_url = f"http://127.0.0.1:{server.server_port}"
+    get_code.GitHubCrawler("first-token", api_url=api_url, output_path=tmp_path / "data", cache=cache).crawl(1, 2)
+    # the failed first request for a3 was not cached
+    assert cache.counts == {"hits": 0, "misses": 1 + 2 + 4 + 6, "revalidated": 0}
+
+    requests_before = FakeGitHub.requests
+    cache.counts = dict.fromkeys(cache.counts, 0)
+    # another token still uses the same entries
+    get_code.GitHubCrawler("second-token", api_url=api_url, output_path=tmp_path / "data", cache=cache).crawl(1, 2)
+    # commits by SHA are not requested again, listings are revalidated
+    assert cache.counts == {"hits": 6, "misses": 0, "revalidated": 1 + 2 + 4}
+    assert FakeGitHub.requests - requests_before == 7
+
+
+def test_secondary_limits_are_retried_after_a_delay_and_a_capped_number_of_times(get_code, server, tmp_path, monkeypatch):
+    crawler = get_code.GitHubCrawler(api_url=f"http://127.0.0.1:{server.server_port}", max_attempts=3, backoff=0.5,
+                                     cache=get_code.HTTPCache(tmp_path / "cache"))
+    # the crawler's own clock, so the fake server still sleeps
+    sleeps = []
+    clock = types.SimpleNamespace(**vars(time))
+    clock.sleep = sleeps.append
+    monkeypatch.setattr(get_code, "time", clock)
+
+    assert crawler.get("/secondary/2/7") == {"ok": True}
+    assert sleeps == [7, 7]
+
+    # without Retry-After the wait doubles on every attempt
+    sleeps.clear()
+    assert crawler.get("/secondary/2") == {"ok": True}
+    assert sleeps == [0.5, 1.0]
+
+    sleeps.clear()
+    assert crawler.get("/secondary/5/1") is None
+    assert sleeps == [1, 1]
+    assert FakeGitHub.secondary["/secondary/5/1"] == 3
+
+
+def test_rate_limiter_waits_for_reset(get_code):
+    limiter = get_code.RateLimiter()
+    reset = int(time.time()) + 1
+    limiter.update({"X-RateLimit-Remaining": "0", "X-RateLimit-Reset": str(reset)})
+    wait = reset - time.time()
+    start = time.monotonic()
+    limiter.acquire()
+    assert time.monotonic() - start > wait - 0.05
+
+
+def test_local_mode_reads_commits_from_bare_clones(get_code, tmp_path):
+    workdir = tmp_path / "work"
+    repo = pygit2.init_repository(str(workdir), initial_head="main")
+    first = commit_files(repo, workdir, {
+        "src/calc.py": "def add(a, b):\n    return a - b\n",
+        "tests/test_calc.py": "def test_add():\n    assert add(1, 2) == 3\n",
+    }, "first")
+    second = commit_files(repo, workdir, {"src/calc.py": "def add(a, b):\n    return a + b\n"}, "fix add")
+    remote_path = tmp_path / "remote.git"
+    pygit2.init_repository(str(remote_path), bare=True, initial_head="main")
+    repo.remotes.create("origin", str(remote_path)).push(["refs/heads/main"])
+
+    crawler = get_code.GitHubCrawler(output_path=tmp_path / "data", cache=get_code.HTTPCache(tmp_path / "cache"))
+    crawler.get_repositories = lambda X, Y, language: [{"owner": {"login": "o"}, "name": "calc", "clone_url": str(remote_path)}]
+    def no_requests(path, params=None):
+        raise AssertionError(f"unexpected request to {path}")
+    crawler.get = no_requests
+    assert crawler.crawl(1, 1, local_clones_path=tmp_path / "Repos") == {"repositories": 1, "commits": 2, "files": 1}
+
+    assert (tmp_path / "Repos/calc/mirror.git").is_dir()
+    assert not (tmp_path / f"data/o/calc/commit_{second.id}").exists()
+    with open(tmp_path / f"data/o/calc/commit_{first.id}/{first.id}/files.json") as f:
+        files = {file["filename"]: file for file in json.load(f)}
+    assert files["tests/test_calc.py"]["status"] == "added"
+    assert files["src/calc.py"]["additions"] == 2
+    assert files["src/calc.py"]["patch"].startswith("@@ -0,0 +1,2 @@\n+def add(a, b):")
+
+    # a second run fetches the new commits into the existing clone
+    third = commit_files(repo, workdir, {"tests/test_calc.py": "def test_add():\n    assert add(2, 2) == 4\n",
+                                         "src/calc.py": "def add(a, b):\n    return b + a\n"}, "more tests")
+    repo.remotes["origin"].push(["refs/heads/main"])
+    crawler.crawl(1, 1, local_clones_path=tmp_path / "Repos")
+    with open(tmp_path / f"data/o/calc/commit_{third.id}/{third.id}/files.json") as f:
+        assert {file["filename"]: file["status"] for file in json.load(f)} == {"src/calc.py": "modified", "tests/test_calc.py": "modified"}
@@ -1,11 +1,55 @@
 import pygit2
-from ..git_utils import get_modified_functions
+from ..git_utils import checkout_changed_paths, get_modified_lines
+from .test_test_utils import commit_files
 
-# Test the get_modified_functions function
-def test_get_modified_functions():
-    repo = pygit2.Repository("test_repo")
+# Test the get_modified_lines function
+def test_get_modified_lines(tmp_path):
+    workdir = tmp_path / "code"
+    repo = pygit2.init_repository(str(workdir))
+    first = commit_files(repo, workdir, {
+        "src/calc.py": "def f(a):\n    return a\n\ndef g(a):\n    return a - 1\n",
+        "README": "calc\n",
+    }, "first")
+    second = commit_files(repo, workdir, {
+        "src/calc.py": "def f(a):\n    return a\n\ndef g(a):\n    b = a\n    return b + 1\n",
+        "README": "calc!\n",
+    }, "second")
 
-    head_commit = repo.head.peel(pygit2.Commit)
-    
-    modified_functions = get_modified_functions(repo, head_commit)
-    assert modified_functions == {"f"}
\ No newline at end of file
+    modified_lines = get_modified_lines(repo.diff(first, second))
+    # changed lines and the context lines around them, only for python files, as intervals
+    assert modified_lines["old"] == {"src/calc.py": [[2, 5]]}
+    assert modified_lines["new"] == {"src/calc.py": [[2, 6]]}
+
+
+def test_checkout_changed_paths_rewrites_only_the_delta(tmp_path):
+    workdir = tmp_path / "code"
+    repo = pygit2.init_repository(str(workdir))
+    first = commit_files(repo, workdir, {
+        "src/calc.py": "def add(a, b):\n    return a - b\n",
+        "src/other.py": "X = 1\n",
+        "tests/test_calc.py": "def test_add():\n    pass\n",
+    }, "first")
+    second = commit_files(repo, workdir, {
+        "src/calc.py": "def add(a, b):\n    return a + b\n",
+        "tests/test_calc.py": None,
+        "tests/test_new.py": "def test_new():\n    pass\n",
+    }, "second")
+    pycache = workdir / "src" / "__pycache__"
+    pycache.mkdir()
+    (pycache / "calc.cpython-311.pyc").write_bytes(b"stale")
+    (pycache / "other.cpython-311.pyc").write_bytes(b"fresh")
+    other_mtime = (workdir / "src/other.py").stat().st_mtime_ns
+
+    assert checkout_changed_paths(repo, first) == ["src/calc.py", "tests/test_calc.py", "tests/test_new.py"]
+    assert repo.head_is_detached and repo.head.target == first.id
+    assert (workdir / "src/calc.py").read_text() == "def add(a, b):\n    return a - b\n"
+    assert (workdir / "tests/test_calc.py").exists() and not (workdir / "tests/test_new.py").exists()
+    assert not repo.status(untracked_files="no")
+    # untouched files and their bytecode are left alone
+    assert (workdir / "src/other.py").stat().st_mtime_ns == other_mtime
+    assert sorted(path.name for path in pycache.iterdir()) == ["other.cpython-311.pyc"]
+
+    assert checkout_changed_paths(repo, first) == []
+    checkout_changed_paths(repo, second)
+    assert (workdir / "tests/test_new.py").exists() and not (workdir / "tests/test_calc.py").exists()
+    assert not repo.status(untracked_files="no")
@@ -0,0 +1,45 @@
+import random
+
+import pytest
+
+from myplugin.intervals import (LineIntervals, add_line, format_intervals, intervals_intersect, merge_intervals,
+                                parse_tracked_lines, to_intervals)
+from myplugin.plugin_module import InterestingLinesIndex
+
+
+def test_line_intervals_match_a_set_of_lines():
+    rng = random.Random(0)
+    for _ in range(200):
+        lines = {rng.randrange(1, 200) for _ in range(rng.randrange(30))}
+        intervals = LineIntervals.from_lines(lines)
+        assert [line for line in range(0, 202) if line in intervals] == sorted(lines)
+        first = rng.randrange(1, 200)
+        last = first + rng.randrange(10)
+        assert intervals.overlaps(first, last) == any(first <= line <= last for line in lines)
+        other = to_intervals(rng.randrange(1, 200) for _ in range(rng.randrange(10)))
+        assert intervals_intersect(intervals.intervals(), other) == any(line in lines for first, last in other
+                                                                        for line in range(first, last + 1))
+
+
+def test_add_line_and_merge():
+    intervals = []
+    for line in [3, 4, 5, 9, 10, 1, 6]:
+        add_line(intervals, line)
+    assert intervals == [[1, 1], [3, 6], [9, 10]]
+    assert merge_intervals([[5, 8], [1, 2], [3, 3], [7, 12]]) == [[1, 3], [5, 12]]
+
+
+def test_tracked_lines_arguments():
+    tracked = parse_tracked_lines(["src/calc.py:9,2-5", "C:/repo/a.py:1-2", "src/calc.py:6"])
+    assert tracked == {"src/calc.py": [[2, 6], [9, 9]], "C:/repo/a.py": [[1, 2]]}
+    assert format_intervals(tracked["src/calc.py"]) == "2-6,9"
+    with pytest.raises(ValueError):
+        parse_tracked_lines(["1-2"])
+
+
+def test_index_merges_matching_files():
+    index = InterestingLinesIndex({"calc.py": LineIntervals([[2, 4]]), "src/calc.py": {8, 9}, "other.py": [1]})
+    lines = index.lines_for("/repo/src/calc.py")
+    assert lines == LineIntervals([[2, 4], [8, 9]])
+    assert 3 in lines and 5 not in lines
+    assert not index.lines_for("/repo/src/unrelated.py")
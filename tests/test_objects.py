@@ -0,0 +1,80 @@
+import io
+import json
+
+from myplugin.objects import ObjectStore, ReferenceWriter, data_stats, normalize, object_id, pack_file, read_records
+from myplugin.recorder import TraceRecorder, read_trace_records
+
+from ..catalog import Catalog, index_payload
+from ..dataset_store import read_example
+
+
+def trace(path, objects_path, values):
+    recorder = TraceRecorder(path, max_samples=10, policy="first", objects_path=objects_path)
+    for value in values:
+        recorder.record("src/calc.py", 3, {"code_context": ["x = 0"], "target_line": "x += 1", "variables": {"x": value}})
+    recorder.close()
+
+
+def test_payloads_are_stored_once(tmp_path):
+    objects_path = tmp_path / "objects.sqlite"
+    (tmp_path / "c1").mkdir()
+    (tmp_path / "c2").mkdir()
+    trace(tmp_path / "c1/negative_example.jsonl", objects_path, ["1", "<A object at 0x00007F1234567890>", "1"])
+    trace(tmp_path / "c2/positive_example.jsonl", objects_path, ["1", "<A object at 0x00007F0000000000>", "2"])
+
+    lines = (tmp_path / "c1/negative_example.jsonl").read_text().splitlines()
+    assert json.loads(lines[0]) == {"objects": "../objects.sqlite"}
+    assert [json.loads(line)["count"] for line in lines[1:]] == [2, 1]
+    store = ObjectStore(objects_path)
+    assert store.stats()["objects"] == 3
+    store.close()
+
+    records = read_trace_records(tmp_path / "c2/positive_example.jsonl")["src/calc.py"]["3"]
+    assert [record["variables"]["x"] for record in records] == ["1", "<A object>", "2"]
+    assert [record["line"] for record in read_example(tmp_path / "c1/negative_example.jsonl")] == [3, 3, 3]
+
+
+def test_pack_file_and_catalog(tmp_path):
+    path = tmp_path / "data/demo/c1/negative_example.jsonl"
+    path.parent.mkdir(parents=True)
+    records = [{"file": "/repos/demo/code/calc.py", "line": line, "blob": "b1", "code_context": [],
+                "target_line": "x += 1", "variables": {"x": str(value)}} for line, value in [(3, 1), (3, 1), (4, 1), (3, 2)]]
+    path.write_text("".join(json.dumps(record) + "\n" for record in records))
+    plain_bytes = path.stat().st_size
+
+    assert pack_file(path, tmp_path / "objects.sqlite")
+    assert not pack_file(path, tmp_path / "objects.sqlite")
+    assert sorted(map(json.dumps, read_records(path)), key=len) == sorted(map(json.dumps, records), key=len)
+    stats = data_stats(tmp_path / "data")
+    assert (stats["files"], stats["references"], stats["records"], stats["objects"]) == (1, 3, 4, 2)
+    assert stats["reference_bytes"] < plain_bytes
+
+    index = index_payload(path)
+    assert [(line, count) for _, line, _, _, count in index] == [(3, 2), (4, 1), (3, 1)]
+    with Catalog(tmp_path / "catalog.sqlite") as catalog:
+        catalog.record_pair("demo", {"parent": "c1", "child": "c2"}, "done", examples={0: (path, index)})
+        assert [row["records"] for row in catalog.examples("demo")] == [4]
+        assert [r["variables"]["x"] for r in catalog.read_records("demo", "c1", 0, line=3)] == ["1", "1", "2"]
+
+
+def test_addresses_are_removed_in_any_case_and_length():
+    linux = normalize({"variables": {"x": "<object object at 0x7f0fb2fa4800>"}})
+    windows = normalize({"variables": {"x": "<object object at 0x000001D2C3B4A5F0>"}})
+    assert linux == windows == {"variables": {"x": "<object object>"}}
+    assert object_id(linux) == object_id(windows)
+
+
+def test_references_are_written_in_batches(tmp_path):
+    out = io.StringIO()
+    writer = ReferenceWriter(tmp_path / "objects.sqlite", out, tmp_path, batch_size=2)
+    for value in ["1", "1", "2"]:
+        writer.add({"file": "calc.py", "line": 3, "target_line": "x += 1", "variables": {"x": value}})
+    # the first batch is on disk before the writer is closed
+    assert [json.loads(line).get("count") for line in out.getvalue().splitlines()] == [None, 2]
+    store = ObjectStore(tmp_path / "objects.sqlite")
+    assert store.stats()["objects"] == 1
+    store.close()
+    writer.close()
+    path = tmp_path / "result.jsonl"
+    path.write_text(out.getvalue())
+    assert [record["variables"]["x"] for record in read_records(path, chunk_size=1)] == ["1", "1", "2"]
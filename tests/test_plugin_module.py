@@ -0,0 +1,155 @@
+import importlib.util
+import sys
+import threading
+
+import pytest
+
+from myplugin import plugin_module
+from myplugin.recorder import TraceRecorder, read_trace_records
+
+WORKERS_SOURCE = '''def work_a(n):
+    total_a = 0
+    for i in range(n):
+        total_a += i
+    return total_a
+
+def work_b(n):
+    total_b = 0
+    for i in range(n):
+        total_b -= i
+    return total_b
+'''
+
+
+GENERATORS_SOURCE = '''def numbers(n):
+    for i in range(n):
+        yield i * 2
+
+def consume(n):
+    total = 0
+    for value in numbers(n):
+        total += value
+    return total
+'''
+
+
+HELPERS_SOURCE = '''def scale(x):
+    doubled = x * 2
+    return doubled
+
+def total(n):
+    result = 0
+    for i in range(n):
+        result += scale(i)
+    return result
+'''
+
+
+def import_workers(tmp_path, name="workers", source=WORKERS_SOURCE):
+    path = tmp_path / f"{name}.py"
+    path.write_text(source)
+    spec = importlib.util.spec_from_file_location(name, path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def test_code_context_is_per_thread(tmp_path):
+    workers = import_workers(tmp_path)
+    recorder = TraceRecorder(tmp_path / "result.jsonl", max_samples=1000, policy="first")
+    trace_function = plugin_module.make_trace_function({"workers.py": {4, 10}}, recorder, plugin_module.VariableRepresenter())
+
+    barrier = threading.Barrier(2)
+    def run(work):
+        barrier.wait()
+        work(200)
+
+    trace_function.start()
+    try:
+        threads = [threading.Thread(target=run, args=(work,)) for work in (workers.work_a, workers.work_b)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+    finally:
+        trace_function.stop()
+    recorder.close()
+
+    file_info = read_trace_records(tmp_path / "result.jsonl")[str(tmp_path / "workers.py")]
+    assert len(file_info["4"]) == len(file_info["10"]) == 200
+    for record in file_info["4"]:
+        assert record["target_line"] == "total_a += i"
+        assert not any("total_b" in line for line in record["code_context"])
+    for record in file_info["10"]:
+        assert not any("total_a" in line for line in record["code_context"])
+    assert file_info["4"][-1]["code_context"][-2:] == ["total_a += i", "for i in range(n):"]
+
+
+def trace_module(tmp_path, trace_function_class, name, source, lines, run):
+    module = import_workers(tmp_path, name, source)
+    recorder = TraceRecorder(tmp_path / f"{name}.jsonl", max_samples=1000, policy="first")
+    trace_function = trace_function_class(recorder, interesting_lines={f"{name}.py": lines})
+    trace_function.start()
+    try:
+        run(module)
+    finally:
+        trace_function.stop()
+    recorder.close()
+    file_info = read_trace_records(tmp_path / f"{name}.jsonl")[str(tmp_path / f"{name}.py")]
+    return {line: [record["code_context"] for record in records] for line, records in file_info.items()}
+
+
+def trace_consume(tmp_path, trace_function_class, name):
+    return trace_module(tmp_path, trace_function_class, name, GENERATORS_SOURCE, {3, 8}, lambda module: module.consume(3))
+
+
+@pytest.mark.skipif(not hasattr(sys, "monitoring"), reason="sys.monitoring needs Python 3.12")
+def test_backends_build_the_same_context_across_generator_resumes(tmp_path):
+    settrace = trace_consume(tmp_path, plugin_module.TraceFunction, "generators_settrace")
+    monitoring = trace_consume(tmp_path, plugin_module.MonitoringTraceFunction, "generators_monitoring")
+    assert settrace == monitoring
+    # the yield line is hit once when it runs and once when the generator resumes there
+    assert (len(monitoring["3"]), len(monitoring["8"])) == (6, 3)
+
+
+@pytest.mark.skipif(not hasattr(sys, "monitoring"), reason="sys.monitoring needs Python 3.12")
+def test_monitoring_falls_back_to_settrace_when_tool_ids_are_taken(tmp_path):
+    taken = [tool_id for tool_id in (3, 4) if sys.monitoring.get_tool(tool_id) is None]
+    for tool_id in taken:
+        sys.monitoring.use_tool_id(tool_id, "other tool")
+    try:
+        contexts = trace_consume(tmp_path, plugin_module.MonitoringTraceFunction, "generators_fallback")
+    finally:
+        for tool_id in taken:
+            sys.monitoring.free_tool_id(tool_id)
+    assert contexts == trace_consume(tmp_path, plugin_module.TraceFunction, "generators_settrace")
+
+
+@pytest.mark.skipif(not hasattr(sys, "monitoring"), reason="sys.monitoring needs Python 3.12")
+def test_backends_include_untracked_helpers_of_a_tracked_file_in_the_context(tmp_path):
+    run = lambda module: module.total(3)
+    settrace = trace_module(tmp_path, plugin_module.TraceFunction, "helpers_settrace", HELPERS_SOURCE, {8}, run)
+    monitoring = trace_module(tmp_path, plugin_module.MonitoringTraceFunction, "helpers_monitoring", HELPERS_SOURCE, {8}, run)
+    assert settrace == monitoring
+    assert "doubled = x * 2" in monitoring["8"][-1]
+
+
+@pytest.mark.skipif(not hasattr(sys, "monitoring"), reason="sys.monitoring needs Python 3.12")
+def test_monitoring_sessions_of_one_process_reuse_tool_ids(tmp_path):
+    helpers = import_workers(tmp_path, "helpers", HELPERS_SOURCE)
+    # the first session disables the code of helpers.py, which the later sessions trace
+    results = []
+    for session, interesting_lines in enumerate([{"other.py": {1}}, {"helpers.py": {8}}, {"helpers.py": {8}}]):
+        recorder = TraceRecorder(tmp_path / f"session{session}.jsonl", max_samples=1000, policy="first")
+        trace_function = plugin_module.MonitoringTraceFunction(recorder, interesting_lines=interesting_lines)
+        trace_function.start()
+        try:
+            assert trace_function.tool_id is not None
+            helpers.total(3)
+        finally:
+            trace_function.stop()
+        recorder.close()
+        results.append(read_trace_records(tmp_path / f"session{session}.jsonl"))
+    assert results[0] == {}
+    assert results[1] == results[2]
+    assert len(results[1][str(tmp_path / "helpers.py")]["8"]) == 3
@@ -0,0 +1,38 @@
+from myplugin.recorder import TraceRecorder, read_trace_records
+
+
+def record_hits(recorder, values, lineno=3):
+    for value in values:
+        if recorder.wants_sample("src/calc.py", lineno):
+            recorder.record("src/calc.py", lineno, {"code_context": [], "target_line": "x += 1", "variables": {"x": repr(value)}})
+
+
+def test_first_policy_keeps_first_hits(tmp_path):
+    recorder = TraceRecorder(tmp_path / "result.jsonl", max_samples=3, policy="first")
+    record_hits(recorder, range(10))
+    recorder.close()
+
+    records = read_trace_records(tmp_path / "result.jsonl")["src/calc.py"]["3"]
+    assert [record["variables"]["x"] for record in records] == ["0", "1", "2"]
+    assert recorder.summary()["src/calc.py"][3] == (10, 3)
+
+
+def test_dedup_policy_skips_repeated_states(tmp_path):
+    recorder = TraceRecorder(tmp_path / "result.jsonl", max_samples=3, policy="dedup")
+    record_hits(recorder, [1, 1, 2, 1, 2, 3, 4])
+    recorder.close()
+
+    records = read_trace_records(tmp_path / "result.jsonl")["src/calc.py"]["3"]
+    assert [record["variables"]["x"] for record in records] == ["1", "2", "3"]
+
+
+def test_reservoir_policy_is_bounded(tmp_path):
+    recorder = TraceRecorder(tmp_path / "result.jsonl", max_samples=5, policy="reservoir")
+    record_hits(recorder, range(1000))
+    record_hits(recorder, range(2), lineno=4)
+    recorder.close()
+
+    file_info = read_trace_records(tmp_path / "result.jsonl")["src/calc.py"]
+    assert len(file_info["3"]) == 5
+    assert len({record["variables"]["x"] for record in file_info["3"]}) == 5
+    assert len(file_info["4"]) == 2
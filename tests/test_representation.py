@@ -0,0 +1,42 @@
+from myplugin.representation import VariableRepresenter
+
+
+class Plain:
+    pass
+
+
+class Big:
+    def __len__(self):
+        return 10 ** 6
+
+    def __repr__(self):
+        raise AssertionError("the repr of a large object must not be computed")
+
+
+def test_primitives_keep_their_repr():
+    representer = VariableRepresenter()
+    assert [representer.represent(value) for value in (1, 2.5, None, True, "abc")] == ["1", "2.5", "None", "True", "'abc'"]
+
+
+def test_reprs_are_capped():
+    representer = VariableRepresenter(max_depth=2, max_length=20, max_items=3)
+    assert representer.represent(list(range(100))) == "[0, 1, 2, ...]"
+    assert len(representer.represent("x" * 1000)) <= 20
+    assert representer.represent([[[1]]]) == "[[[...]]]"
+    assert representer.represent(Big()).endswith("Big of length 1000000>")
+
+
+def test_addresses_are_removed():
+    representer = VariableRepresenter()
+    assert representer.represent(Plain()) == f"<{__name__}.Plain object>"
+    assert representer.represent(test_addresses_are_removed) == "<function test_addresses_are_removed>"
+
+
+def test_hash_seen_values_on_the_same_line():
+    representer = VariableRepresenter(hash_seen=True)
+    first = representer.represent([1, 2], ("calc.py", 3))
+    assert first == "[1, 2]"
+    again = representer.represent([1, 2], ("calc.py", 3))
+    assert again.startswith("<list #")
+    assert representer.represent([1, 2], ("calc.py", 4)) == "[1, 2]"
+    assert representer.represent([1, 2], ("calc.py", 3)) == again
@@ -0,0 +1,30 @@
+from ..run_log import RunLog, StageTimer, read_run_log, summarize
+
+
+def test_summary_reports_throughput_and_slowest_commits(tmp_path):
+    run_log = RunLog(tmp_path / "run_log.jsonl", "demo")
+    run_log.write("plan", candidates=3, skipped={"not parent": 2, "not a bugfix": 5}, duration=0.1)
+    run_log.write("commit", parent="a", child="b", status="skipped: already exists", duration=0.0, stages={})
+    timer = StageTimer()
+    with timer("checkout"):
+        pass
+    with timer("checkout"):
+        pass
+    assert list(timer.durations) == ["checkout"]
+    run_log.write("commit", parent="c", child="d", status="done", duration=30.0, stages={"pytest_parent": 20.0, "checkout": 1.0},
+                  trace_events=100, trace_records=10, result_bytes=2000, peak_rss=3000)
+    run_log.write("commit", parent="e", child="f", status="skipped: not a bugfix", duration=6.0, stages={"discovery": 6.0},
+                  trace_events=0, trace_records=0, result_bytes=0, peak_rss=0)
+
+    records = list(read_run_log(tmp_path / "run_log.jsonl"))
+    assert {record["run"] for record in records} == {run_log.run}
+    summary = summarize(records, top=1)
+    assert summary["commits"] == 2
+    assert summary["outcomes"] == {"skipped": 2, "done": 1}
+    assert summary["skip_reasons"] == {"already exists": 1, "not a bugfix": 6, "not parent": 2}
+    assert summary["stages"] == {"pytest_parent": 20.0, "checkout": 1.0, "discovery": 6.0}
+    assert summary["trace_records"] == 10 and summary["result_bytes"] == 2000 and summary["peak_rss"] == 3000
+    assert [record["parent"] for record in summary["slowest"]] == ["c"]
+    # the first pair started 30s before it was logged
+    assert summary["wall_time"] >= 30.0
+    assert summary["commits_per_hour"] <= 2 / 30.0 * 3600
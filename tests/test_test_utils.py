@@ -0,0 +1,237 @@
+import multiprocessing
+import os
+import time
+
+import pygit2
+import pytest
+
+from .. import test_utils
+from ..test_utils import IsolatedRunError, TestDiscoveryCache, TestFootprints, run_isolated
+
+
+def commit_files(repo, workdir, files, message):
+    for name, content in files.items():
+        path = workdir / name
+        if content is None:
+            path.unlink()
+            continue
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_text(content)
+    repo.index.add_all()
+    repo.index.write()
+    tree = repo.index.write_tree()
+    signature = pygit2.Signature("test", "test@example.com")
+    parents = [] if repo.head_is_unborn else [repo.head.target]
+    return repo[repo.create_commit("HEAD", signature, signature, message, tree, parents)]
+
+
+def test_discovery_cache_only_collects_changed_files(tmp_path, monkeypatch):
+    workdir = tmp_path / "code"
+    repo = pygit2.init_repository(str(workdir))
+    first = commit_files(repo, workdir, {
+        "src/calc.py": "def add(a, b):\n    return a + b\n",
+        "tests/test_a.py": "def test_a():\n    pass\n",
+        "tests/test_b.py": "def test_b():\n    pass\n",
+    }, "first")
+
+    collected_paths = []
+    def fake_collect_test_ids(pytest_args, timeout=None):
+        paths = [arg for arg in pytest_args if arg.endswith(".py")]
+        collected_paths.append(sorted(paths))
+        return [f"{path[len(str(workdir)) + 1:]}::test" for path in paths]
+    monkeypatch.setattr(test_utils, "collect_test_ids", fake_collect_test_ids)
+
+    cache_path = tmp_path / "discovery.json"
+    tests = TestDiscoveryCache(cache_path).collect(first.tree, workdir, [])
+    assert tests == {"tests/test_a.py": ["tests/test_a.py::test"], "tests/test_b.py": ["tests/test_b.py::test"]}
+    assert len(collected_paths) == 1
+
+    # a fresh instance reads the saved cache and does not collect at all
+    assert TestDiscoveryCache(cache_path).collect(first.tree, workdir, []) == tests
+    assert len(collected_paths) == 1
+
+    second = commit_files(repo, workdir, {
+        "tests/test_a.py": "def test_a():\n    assert True\n",
+        "tests/test_b.py": None,
+        "tests/test_c.py": "def test_c():\n    pass\n",
+    }, "second")
+    tests = TestDiscoveryCache(cache_path).collect(second.tree, workdir, [])
+    assert sorted(tests) == ["tests/test_a.py", "tests/test_c.py"]
+    assert collected_paths[-1] == [str(workdir / "tests/test_a.py"), str(workdir / "tests/test_c.py")]
+
+    # a conftest.py invalidates the files below it
+    third = commit_files(repo, workdir, {"tests/conftest.py": "\n"}, "third")
+    TestDiscoveryCache(cache_path).collect(third.tree, workdir, [])
+    assert collected_paths[-1] == [str(workdir / "tests/test_a.py"), str(workdir / "tests/test_c.py")]
+
+
+def test_discovery_cache_only_passes_files_matching_python_files_to_pytest(tmp_path, monkeypatch):
+    workdir = tmp_path / "code"
+    repo = pygit2.init_repository(str(workdir))
+    first = commit_files(repo, workdir, {
+        "tests/__init__.py": "",
+        "tests/helpers.py": "raise ImportError\n",
+        "tests/test_a.py": "def test_a():\n    pass\n",
+        "tests/b_test.py": "def test_b():\n    pass\n",
+        "tests/check_c.py": "def test_c():\n    pass\n",
+    }, "first")
+
+    collected_paths = []
+    def fake_collect_test_ids(pytest_args, timeout=None):
+        paths = [arg[len(str(workdir)) + 1:] for arg in pytest_args if arg.endswith(".py")]
+        collected_paths.append(sorted(paths))
+        return [f"{path}::test" for path in paths]
+    monkeypatch.setattr(test_utils, "collect_test_ids", fake_collect_test_ids)
+
+    tests = TestDiscoveryCache(tmp_path / "discovery.json").collect(first.tree, workdir, [])
+    assert collected_paths == [["tests/b_test.py", "tests/test_a.py"]]
+    assert tests["tests/helpers.py"] == tests["tests/__init__.py"] == []
+
+    # the configuration changes the keys of every file, and the patterns
+    second = commit_files(repo, workdir, {"setup.cfg": "[tool:pytest]\npython_files = check_*.py tests/test_*.py\n"}, "second")
+    tests = TestDiscoveryCache(tmp_path / "discovery.json").collect(second.tree, workdir, [])
+    assert collected_paths[-1] == ["tests/check_c.py", "tests/test_a.py"]
+    assert tests["tests/b_test.py"] == []
+
+
+def test_python_files_patterns_follow_the_configuration_pytest_uses(tmp_path):
+    workdir = tmp_path / "code"
+    repo = pygit2.init_repository(str(workdir))
+    commit = commit_files(repo, workdir, {"setup.cfg": "[metadata]\nname = x\n"}, "first")
+    assert test_utils.python_files_patterns(commit.tree) == test_utils.DEFAULT_PYTHON_FILES
+    commit = commit_files(repo, workdir, {"pyproject.toml": "[tool.pytest.ini_options]\npython_files = ['check_*.py']\n"}, "second")
+    assert test_utils.python_files_patterns(commit.tree) == ["check_*.py"]
+    # pytest.ini wins, even without python_files
+    commit = commit_files(repo, workdir, {"pytest.ini": "[pytest]\naddopts = -q\n"}, "third")
+    assert test_utils.python_files_patterns(commit.tree) == test_utils.DEFAULT_PYTHON_FILES
+    assert test_utils.matches_python_files("src/pkg/tests/test_x.py", ["pkg/tests/*.py"])
+    assert not test_utils.matches_python_files("tests/helpers.py", test_utils.DEFAULT_PYTHON_FILES)
+
+
+def test_footprint_selection_matches_modified_lines(tmp_path):
+    footprints = TestFootprints(tmp_path / "footprints.json")
+    footprints.footprints = {
+        "tests/test_a.py::test_add": {"test_blob": "a", "files": {"src/calc.py": {"blob": "c", "lines": test_utils.to_intervals([1, 2, 3, 10])}}},
+        "tests/test_a.py::test_mul": {"test_blob": "a", "files": {"src/calc.py": {"blob": "c", "lines": [[20, 25]]}}},
+        "tests/test_b.py::test_b": {"test_blob": "b", "files": {"src/other.py": {"blob": "o", "lines": [[1, 5]]}}},
+    }
+    tests_by_file = {"tests/test_a.py": ["tests/test_a.py::test_add", "tests/test_a.py::test_mul"],
+                     "tests/test_b.py": ["tests/test_b.py::test_b"]}
+
+    assert footprints.select({"src/calc.py": [[10, 11]]}, tests_by_file) == ["tests/test_a.py::test_add"]
+    assert footprints.select({"src/calc.py": [[4, 9], [19, 19], [26, 30]]}, tests_by_file) == []
+    assert footprints.select({"src/calc.py": [[25, 25]], "src/other.py": [[5, 5]]}, tests_by_file) == ["tests/test_a.py::test_mul", "tests/test_b.py::test_b"]
+    # tests in skipped files run anyway as whole files
+    assert footprints.select({"src/other.py": [[1, 1]]}, tests_by_file, skip_files=["tests/test_b.py"]) == []
+
+
+def test_footprints_are_recorded_again_when_any_covered_file_changes(tmp_path, monkeypatch):
+    workdir = tmp_path / "code"
+    repo = pygit2.init_repository(str(workdir))
+    first = commit_files(repo, workdir, {
+        "src/a.py": "def f():\n    return 1\n",
+        "src/b.py": "def g():\n    return 2\n",
+        "tests/test_a.py": "from src.a import f\n\ndef test_f():\n    assert f()\n",
+    }, "first")
+
+    recorded = []
+    def fake_run_isolated(function, repo_path, pytest_args, timeout=None):
+        test_ids = [arg[len(str(workdir)) + 1:] for arg in pytest_args if "::" in arg]
+        recorded.append(test_ids)
+        # what the tests execute at the current commit
+        calls_b = "g()" in (workdir / "src/a.py").read_text()
+        files = {"src/a.py": {1, 2}, **({"src/b.py": {1, 2}} if calls_b else {})}
+        return 0, {test_id: files for test_id in test_ids}
+    monkeypatch.setattr(test_utils, "run_isolated", fake_run_isolated)
+
+    tests_by_file = {"tests/test_a.py": ["tests/test_a.py::test_f"]}
+    footprints = TestFootprints(tmp_path / "footprints.json")
+    footprints.update(first.tree, workdir, [], tests_by_file)
+    assert recorded == [["tests/test_a.py::test_f"]]
+
+    # a commit that isn't a mined pair makes a.py call into b.py
+    second = commit_files(repo, workdir, {"src/a.py": "from src.b import g\n\ndef f():\n    return g()\n"}, "second")
+    # the pair only modifies b.py, which the old footprint doesn't cover
+    footprints.update(second.tree, workdir, [], tests_by_file)
+    assert recorded[-1] == ["tests/test_a.py::test_f"]
+    assert footprints.select({"src/b.py": [[2, 2]]}, tests_by_file) == ["tests/test_a.py::test_f"]
+
+    footprints.update(second.tree, workdir, [], tests_by_file)
+    assert len(recorded) == 2
+
+
+def add(a, b):
+    return a + b
+
+
+def sleep_past_timeout():
+    time.sleep(30)
+
+
+def crash():
+    os._exit(1)
+
+
+def fail():
+    raise RuntimeError("boom")
+
+
+def test_run_isolated_returns_the_result_of_the_child():
+    assert run_isolated(add, 1, 2) == 3
+
+
+def test_run_isolated_kills_a_child_past_the_timeout():
+    start = time.monotonic()
+    with pytest.raises(IsolatedRunError, match="sleep_past_timeout timed out after 0.5s"):
+        run_isolated(sleep_past_timeout, timeout=0.5)
+    assert time.monotonic() - start < 10
+
+
+def test_run_isolated_reports_a_crashed_child():
+    with pytest.raises(IsolatedRunError, match="crash crashed with exit code 1"):
+        run_isolated(crash)
+
+
+def test_run_isolated_reports_an_exception_in_the_child():
+    with pytest.raises(IsolatedRunError, match="fail failed: RuntimeError\\('boom'\\)"):
+        run_isolated(fail)
+
+
+def save_entries(path, worker, count):
+    for index in range(count):
+        test_utils.save_merged_json(path, {f"{worker}-{index}": index})
+
+
+def test_concurrent_saves_keep_every_entry(tmp_path):
+    path = tmp_path / "state/discovery.json"
+    context = multiprocessing.get_context("fork")
+    processes = [context.Process(target=save_entries, args=(path, worker, 50)) for worker in range(4)]
+    for process in processes:
+        process.start()
+    for process in processes:
+        process.join()
+    assert len(test_utils.load_json(path)) == 200
+
+
+def test_to_intervals_merges_consecutive_lines():
+    assert test_utils.to_intervals([5, 1, 2, 3, 3, 7, 8]) == [[1, 3], [5, 5], [7, 8]]
+
+
+def test_recorded_footprints_select_the_tests_reaching_modified_lines(tmp_path):
+    workdir = tmp_path / "code"
+    repo = pygit2.init_repository(str(workdir))
+    commit = commit_files(repo, workdir, {
+        "conftest.py": "",
+        "calc.py": "def add(a, b):\n    return a + b\n\ndef mul(a, b):\n    return a * b\n",
+        "tests/test_calc.py": "from calc import add, mul\n\ndef test_add():\n    assert add(1, 2) == 3\n\n"
+                              "def test_mul():\n    assert mul(2, 3) == add(3, 3)\n",
+    }, "first")
+    tests_by_file = {"tests/test_calc.py": ["tests/test_calc.py::test_add", "tests/test_calc.py::test_mul"]}
+
+    footprints = TestFootprints(tmp_path / "footprints.json", timeout=60)
+    footprints.update(commit.tree, workdir, ['--rootdir', str(workdir)], tests_by_file)
+    assert footprints.footprints["tests/test_calc.py::test_add"]["files"]["calc.py"]["lines"] == [[1, 2]]
+    # add() reports its lines again for test_mul, after test_add ran them
+    assert footprints.select({"calc.py": [[2, 2]]}, tests_by_file) == tests_by_file["tests/test_calc.py"]
+    assert footprints.select({"calc.py": [[5, 5]]}, tests_by_file) == ["tests/test_calc.py::test_mul"]
+    assert footprints.select({"tests/test_calc.py": [[7, 7]]}, tests_by_file) == ["tests/test_calc.py::test_mul"]
@@ -0,0 +1,52 @@
+import re
+
+import numpy as np
+
+from ..token_cache import TokenCache, make_text, pad_and_truncate
+
+START, END = 0, 2
+
+
+class WordTokenizer:
+    """
+    One token per word, with the special tokens and offsets of a fast tokenizer.
+    """
+    def __init__(self, name):
+        self.vocabulary = {}
+
+    def __call__(self, texts, **kwargs):
+        input_ids, offset_mapping = [], []
+        for text in texts:
+            words = list(re.finditer(r"\S+", text))
+            input_ids.append([START] + [self.vocabulary.setdefault(word.group(), len(self.vocabulary) + 3) for word in words] + [END])
+            offset_mapping.append([(0, 0)] + [word.span() for word in words] + [(0, 0)])
+        return {"input_ids": input_ids, "offset_mapping": offset_mapping}
+
+
+def item(x, label=0):
+    return {"code_context": "a = 1\nb = a + x", "target_line": "b = a + x", "label": label,
+            "variable_histories": [{"code_context": [], "target_line": "b = a + x", "variables": {"x": str(x)}}]}
+
+
+def test_encodes_only_new_data_points(tmp_path):
+    cache = TokenCache(tmp_path / "cache")
+    items = [item(1), item(2), item(1, label=1)]
+    entries = cache.encode(items, "words", batch_size=1, loader=WordTokenizer)
+    # the two labels of x = 1 make the same text
+    assert len(cache) == 2 and entries[0] == entries[2]
+    ids = cache.input_ids(entries[1])
+    assert ids[0] == START and ids[-1] == END and len(ids) == len(make_text(items[1]).split()) + 2
+    # the start token, "Code Context:" and the 8 words of the context
+    assert cache.context_lengths(entries).tolist() == [11, 11, 11]
+
+    reopened = TokenCache(tmp_path / "cache")
+    more = reopened.encode([item(3), item(2)], "words", processes=2, loader=WordTokenizer)
+    assert len(reopened) == 3 and more[1] == entries[1]
+    assert (reopened.input_ids(more[1]) == ids).all()
+    # another tokenizer encodes everything again
+    assert reopened.encode([item(2)], "other", loader=WordTokenizer)[0] == 3
+
+    input_ids, attention_mask = pad_and_truncate(ids, 5, pad_token_id=1)
+    assert input_ids.tolist() == ids[:4].tolist() + [END] and attention_mask.tolist() == [1] * 5
+    input_ids, attention_mask = pad_and_truncate(ids[:3], 5, pad_token_id=1)
+    assert input_ids.tolist() == ids[:3].tolist() + [1, 1] and attention_mask.sum() == 3
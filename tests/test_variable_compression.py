@@ -0,0 +1,131 @@
+import random
+import re
+import time
+
+import pandas as pd
+
+from ..variable_compression import (compress_variables, compress_variables_batch, largest_column_group, Column,
+                                    EXACT_GROUP_COLUMNS)
+
+# the former implementation, from the notebook
+remove_address = re.compile(r" at 0x[0-9A-F]{16}(?=>|$)")
+
+
+def count_combinations(df):
+    return df.drop_duplicates().shape[0]
+
+
+def get_combinations(selected, remaining, df, threshold):
+    if len(remaining) == 0:
+        return selected
+    else:
+        res = get_combinations(selected, remaining[1:], df, threshold)
+        candidate = selected + [remaining[0]]
+        if count_combinations(df[candidate]) <= threshold:
+            option_B = get_combinations(selected + [remaining[0]], remaining[1:], df, threshold)
+            if len(option_B) > len(res):
+                res = option_B
+        return res
+
+
+def reference_compress_variables(variable_histories):
+    df = pd.DataFrame(variable_histories)
+    df = df.map(lambda x: remove_address.sub("", x) if pd.notna(x) else x)
+    df = df.loc[:, (df != df.iloc[0]).any()]
+    df = df.drop_duplicates()
+    placeholder_dict = {}
+    for col in df.columns:
+        long_values = df[col][df[col].str.len() > 12].value_counts()
+        repeating_values = long_values[long_values > 3]
+        for value in repeating_values.index:
+            placeholder = f"var#{len(placeholder_dict) + 1}"
+            placeholder_dict[placeholder] = value
+            df[col] = df[col].replace(value, placeholder)
+
+    group_columns = get_combinations([], df.columns, df, 10)
+    res = ""
+    if placeholder_dict:
+        res += "Placeholders:\n" + '\n'.join([f"{k} = {v}" for k, v in placeholder_dict.items()])
+    res += "\nVariable Histories:\n"
+    if not group_columns:
+        for i, row in df.iterrows():
+            res += ' | '.join([f"{k} = {v}" for k, v in row.items() if pd.notna(v)]) + "\n"
+        return res
+    df_sorted = df.sort_values(by=group_columns).reset_index(drop=True)
+    for group_values, group_df in df_sorted.groupby(group_columns):
+        res += ' | '.join([f"{col} = {val}" for col, val in zip(group_columns, group_values)]) + "\n"
+        for idx, row in group_df.iterrows():
+            varying_vars = {col: row[col] for col in df.columns if col not in group_columns}
+            if varying_vars:
+                res += "- " + ' | '.join([f"{k} = {v}" for k, v in varying_vars.items()]) + "\n"
+    return res
+
+
+def random_histories(rng: random.Random):
+    names = [f"v{index}" for index in range(rng.randint(1, 9))]
+    # a few values per variable, some long and repeated, some objects with addresses
+    pools = {}
+    for name in names:
+        pool = [str(rng.randint(0, 20)) for _ in range(rng.randint(1, 15))]
+        pool += ["'a long string value %d'" % rng.randint(0, 2) for _ in range(rng.randint(0, 3))]
+        pool += ["<Node object at 0x%016X>" % rng.randrange(16 ** 16) for _ in range(rng.randint(0, 3))]
+        pools[name] = pool
+    histories = []
+    for _ in range(rng.randint(1, 40)):
+        present = [name for name in names if rng.random() < 0.9]
+        histories.append({name: rng.choice(pools[name]) for name in rng.sample(present, len(present))})
+    return histories
+
+
+def test_matches_the_former_implementation():
+    rng = random.Random(0)
+    corpus = [random_histories(rng) for _ in range(120)]
+    corpus += [
+        [{"a": "1"}, {"a": "1"}, {"a": "1"}],
+        [{"a": "1", "b": "x"}, {"a": "2"}, {"b": "y"}],
+        [{"self": "<A object at 0x00007F0000000001>"}, {"self": "<A object at 0x00007F0000000002>"}],
+        [{"s": "'" + "x" * 20 + "'", "i": str(i)} for i in range(12)],
+    ]
+    for histories in corpus:
+        assert compress_variables(histories) == reference_compress_variables(histories), histories
+    assert compress_variables_batch(corpus[:50], chunk_size=7) == [reference_compress_variables(h) for h in corpus[:50]]
+
+
+def test_column_group_search_handles_wide_histories():
+    # 40 variables with 2 values each: the former search visits on the order of 2**40 sets
+    rng = random.Random(1)
+    histories = [{f"v{column}": str(rng.randint(0, 1)) for column in range(40)} for _ in range(30)]
+    columns = [Column.from_values(name, [history[name] for history in histories], {}) for name in histories[0]]
+    group = largest_column_group(columns)
+    assert 1 <= len(group) <= 4
+    assert compress_variables(histories).startswith("\nVariable Histories:\n")
+
+
+def binary_columns(rng: random.Random, width: int, rows: int):
+    histories = [{f"v{column}": str(rng.randint(0, 1)) for column in range(width)} for _ in range(rows)]
+    return [Column.from_values(name, [history[name] for history in histories], {}) for name in histories[0]]
+
+
+def test_column_group_search_is_polynomial_beyond_the_exact_search():
+    rng = random.Random(2)
+    for width, rows in [(40, 12), (50, 15), (60, 11)]:
+        columns = binary_columns(rng, width, rows)
+        start = time.perf_counter()
+        group = largest_column_group(columns)
+        assert time.perf_counter() - start < 1.0, (width, rows)
+        assert group and group == sorted(group)
+        combinations = {tuple(columns[index].codes[row] for index in group) for row in range(rows)}
+        assert len(combinations) <= 10
+
+
+def test_column_group_search_is_exact_up_to_the_column_cap():
+    rng = random.Random(3)
+    columns = binary_columns(rng, EXACT_GROUP_COLUMNS, 30)
+    frame = pd.DataFrame({column.name: column.codes for column in columns})
+    expected = get_combinations([], list(frame.columns), frame, 10)
+    assert [columns[index].name for index in largest_column_group(columns)] == expected
+
+
+def test_addresses_are_removed_in_any_case_and_length():
+    histories = [{"node": "<Node object at 0x7f3a2b4c5d6e>", "i": "1"}, {"node": "<Node object at 0x7F3A2B4C5D70>", "i": "2"}]
+    assert "0x" not in compress_variables(histories)
@@ -0,0 +1,257 @@
+"""
+Tokenized model inputs of the data points, encoded once and kept in a memory-mapped cache.
+
+Data points (as returned by the notebook's load_data) are turned into text by make_text and tokenized in batches,
+in a process pool if asked to. The token ids of every data point are stored unpadded and untruncated,
+one run per entry in tokens.bin, under a hash of the data point and the tokenizer name; the cache only
+encodes the data points it hasn't seen, so new commits only cost their own records. Padding and truncation
+are applied when the tokens are read (see pad_and_truncate). As in dataset_store, meta.json holds the
+committed lengths, so an interrupted append is ignored and truncated by the next one.
+
+    python token_cache.py stats token_cache
+"""
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+import hashlib
+import json
+import os
+from pathlib import Path
+from typing import Callable, Dict, List, Sequence, Tuple
+
+import numpy as np
+
+from variable_compression import compress_variables
+
+# one entry per encoded data point
+COLUMNS = {
+    # hash of the data point and the tokenizer, see record_key
+    "keys": np.dtype("V16"),
+    "tokens_start": np.dtype("<i8"),
+    "tokens_len": np.dtype("<i4"),
+    # tokens of the special start token and the code context, before the target line and the variables
+    "context_len": np.dtype("<i4"),
+}
+TOKENS = np.dtype("<i4")
+FORMAT_VERSION = 1
+
+
+def make_text(item: Dict, strip_cache: Dict[str, str] | None = None) -> str:
+    variables = [record["variables"] for record in item['variable_histories']]
+    compressed_variables = compress_variables(variables, strip_cache)
+
+    return (
+        f"Code Context:\n" +
+        item['code_context'] +
+        "\n\nTarget Line:\n" +
+        item['target_line'] +
+        compressed_variables
+    )
+
+
+def context_chars(item: Dict) -> int:
+    # length of the part of make_text before the target line
+    return len("Code Context:\n") + len(item['code_context'])
+
+
+def record_key(item: Dict, tokenizer_name: str) -> bytes:
+    """
+    Hash of what make_text reads from a data point, and of the tokenizer.
+    """
+    content = [tokenizer_name, item['code_context'], item['target_line'],
+               [record["variables"] for record in item['variable_histories']]]
+    return hashlib.blake2b(json.dumps(content, sort_keys=True).encode("utf-8", errors="surrogatepass"),
+                           digest_size=COLUMNS["keys"].itemsize).digest()
+
+
+def load_tokenizer(name: str):
+    from transformers import AutoTokenizer
+    return AutoTokenizer.from_pretrained(name, use_fast=True)
+
+
+def encode_texts(tokenizer, texts: List[str], boundaries: Sequence[int]) -> Tuple[List[List[int]], List[int]]:
+    """
+    Token ids of the texts with special tokens and without truncation, and the number of tokens
+    that start before each boundary (a character offset).
+    """
+    encoding = tokenizer(texts, add_special_tokens=True, truncation=False, return_attention_mask=False,
+                         return_offsets_mapping=True)
+    context_lengths = []
+    for offsets, boundary in zip(encoding["offset_mapping"], boundaries):
+        starts = np.array([start for start, _ in offsets], dtype=np.int64)
+        # special tokens have the offset (0, 0): the start token belongs to the context, the end token doesn't
+        after = np.flatnonzero(starts[1:] >= boundary)
+        context_lengths.append(int(after[0]) + 1 if len(after) else max(len(starts) - 1, 0))
+    return encoding["input_ids"], context_lengths
+
+
+_worker_tokenizer = None
+
+
+def _load_worker_tokenizer(name: str, loader: Callable):
+    global _worker_tokenizer
+    _worker_tokenizer = loader(name)
+
+
+def _encode_batch(items: List[Dict]) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    # texts of a batch share the address stripping of compress_variables
+    strip_cache = {}
+    texts = [make_text(item, strip_cache) for item in items]
+    input_ids, context_lengths = encode_texts(_worker_tokenizer, texts, [context_chars(item) for item in items])
+    lengths = np.fromiter((len(ids) for ids in input_ids), dtype=COLUMNS["tokens_len"], count=len(input_ids))
+    tokens = np.fromiter((token for ids in input_ids for token in ids), dtype=TOKENS, count=int(lengths.sum()))
+    return tokens, lengths, np.asarray(context_lengths, dtype=COLUMNS["context_len"])
+
+
+def _read_array(path: Path, dtype: np.dtype, length: int) -> np.ndarray:
+    if length == 0:
+        return np.empty(0, dtype)
+    return np.memmap(path, dtype=dtype, mode="r", shape=(length,))
+
+
+class TokenCache:
+    """
+    A cache directory, created if needed. Only one process may append to it at a time.
+    """
+    def __init__(self, path: Path):
+        self.path = Path(path)
+        self.path.mkdir(parents=True, exist_ok=True)
+        meta_path = self.path / "meta.json"
+        if meta_path.exists():
+            with open(meta_path) as f:
+                self.meta = json.load(f)
+        else:
+            self.meta = {"version": FORMAT_VERSION, "entries": 0, "tokens": 0, "tokenizers": []}
+        if self.meta["version"] != FORMAT_VERSION:
+            raise ValueError(f"{self.path} has format version {self.meta['version']}, expected {FORMAT_VERSION}: delete it to encode again")
+        self._truncate_uncommitted()
+        self._open()
+
+    def _file_lengths(self) -> Dict[str, int]:
+        lengths = {f"{name}.col": self.meta["entries"] * dtype.itemsize for name, dtype in COLUMNS.items()}
+        lengths["tokens.bin"] = self.meta["tokens"] * TOKENS.itemsize
+        return lengths
+
+    def _truncate_uncommitted(self):
+        for name, length in self._file_lengths().items():
+            path = self.path / name
+            if not path.exists():
+                path.touch()
+            if path.stat().st_size > length:
+                os.truncate(path, length)
+
+    def _open(self):
+        self.columns = {name: _read_array(self.path / f"{name}.col", dtype, self.meta["entries"])
+                        for name, dtype in COLUMNS.items()}
+        self.tokens = _read_array(self.path / "tokens.bin", TOKENS, self.meta["tokens"])
+        self.entries: Dict[bytes, int] = {key: entry for entry, key in enumerate(self.columns["keys"].tolist())}
+
+    def __len__(self) -> int:
+        return self.meta["entries"]
+
+    def lookup(self, keys: Sequence[bytes]) -> np.ndarray:
+        """
+        Entries of the keys, -1 for the ones not encoded yet.
+        """
+        return np.fromiter((self.entries.get(key, -1) for key in keys), dtype=np.int64, count=len(keys))
+
+    def input_ids(self, entry: int) -> np.ndarray:
+        start = int(self.columns["tokens_start"][entry])
+        return self.tokens[start:start + int(self.columns["tokens_len"][entry])]
+
+    def lengths(self, entries: np.ndarray) -> np.ndarray:
+        return self.columns["tokens_len"][entries]
+
+    def context_lengths(self, entries: np.ndarray) -> np.ndarray:
+        return self.columns["context_len"][entries]
+
+    def append(self, keys: List[bytes], tokens: np.ndarray, lengths: np.ndarray, context_lengths: np.ndarray,
+               tokenizer_name: str):
+        starts = self.meta["tokens"] + np.concatenate([[0], np.cumsum(lengths[:-1], dtype=np.int64)]) if len(keys) else []
+        columns = {"keys": keys, "tokens_start": starts, "tokens_len": lengths, "context_len": context_lengths}
+        for name, dtype in COLUMNS.items():
+            with open(self.path / f"{name}.col", "ab") as f:
+                np.asarray(columns[name], dtype=dtype).tofile(f)
+        with open(self.path / "tokens.bin", "ab") as f:
+            np.asarray(tokens, dtype=TOKENS).tofile(f)
+            f.flush()
+            os.fsync(f.fileno())
+
+        self.meta["entries"] += len(keys)
+        self.meta["tokens"] += int(np.sum(lengths))
+        if tokenizer_name not in self.meta["tokenizers"]:
+            self.meta["tokenizers"].append(tokenizer_name)
+        # the append becomes visible to readers only now
+        tmp_path = self.path / "meta.json.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(self.meta, f)
+        tmp_path.replace(self.path / "meta.json")
+        self._open()
+
+    def encode(self, items: Sequence[Dict], tokenizer_name: str, processes: int | None = None, batch_size: int = 512,
+               loader: Callable = load_tokenizer) -> np.ndarray:
+        """
+        The entries of the data points, encoding the ones missing from the cache in batches of `batch_size`,
+        in `processes` worker processes that each load the tokenizer with `loader(tokenizer_name)`.
+        Every batch is committed as soon as it is encoded.
+        """
+        keys = [record_key(item, tokenizer_name) for item in items]
+        missing = {}
+        for key, item in zip(keys, items):
+            if key not in self.entries and key not in missing:
+                missing[key] = item
+        missing_keys = list(missing)
+        batches = [missing_keys[start:start + batch_size] for start in range(0, len(missing_keys), batch_size)]
+        item_batches = ([missing[key] for key in batch] for batch in batches)
+
+        if processes is None or processes <= 1:
+            _load_worker_tokenizer(tokenizer_name, loader)
+            for batch, result in zip(batches, map(_encode_batch, item_batches)):
+                self.append(batch, *result, tokenizer_name)
+        elif batches:
+            with ProcessPoolExecutor(max_workers=processes, initializer=_load_worker_tokenizer,
+                                     initargs=(tokenizer_name, loader)) as executor:
+                for batch, result in zip(batches, executor.map(_encode_batch, item_batches)):
+                    self.append(batch, *result, tokenizer_name)
+        return self.lookup(keys)
+
+
+def pad_and_truncate(input_ids: np.ndarray, max_length: int, pad_token_id: int) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    The ids padded to `max_length`, or cut to it keeping the final special token like truncation=True,
+    and their attention mask.
+    """
+    if len(input_ids) > max_length:
+        input_ids = np.concatenate([input_ids[:max_length - 1], input_ids[-1:]])
+    padded = np.full(max_length, pad_token_id, dtype=np.int64)
+    padded[:len(input_ids)] = input_ids
+    attention_mask = np.zeros(max_length, dtype=np.int64)
+    attention_mask[:len(input_ids)] = 1
+    return padded, attention_mask
+
+
+def cache_stats(path: Path) -> Dict:
+    cache = TokenCache(path)
+    lengths = cache.columns["tokens_len"]
+    return {
+        "entries": len(cache),
+        "tokens": cache.meta["tokens"],
+        "tokenizers": cache.meta["tokenizers"],
+        "mean_length": float(lengths.mean()) if len(lengths) else 0.0,
+        "over_512": int((lengths > 512).sum()),
+        "bytes": sum((cache.path / name).stat().st_size for name in cache._file_lengths()),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    stats = subparsers.add_parser("stats", help="print the size of a cache")
+    stats.add_argument("cache", type=Path)
+    args = parser.parse_args()
+
+    for name, value in cache_stats(args.cache).items():
+        print(f"{name}: {value}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,274 @@
+"""
+Text summary of the variable histories of a traced line, the part of the model input made by the notebook's make_text.
+
+Each variable becomes a column of integer codes (factorized once, with -1 for a missing value), so removing
+addresses, dropping constant columns and duplicate rows, interning long repeated values as placeholders and
+grouping rows are array operations on the codes; string work is done once per distinct value. The output
+is identical to the former pandas implementation of compress_variables, as long as the grouped columns are chosen
+among at most EXACT_GROUP_COLUMNS columns (see largest_column_group).
+"""
+from concurrent.futures import ProcessPoolExecutor
+from typing import Dict, Iterable, List, Sequence, Tuple
+
+import numpy as np
+import pandas as pd
+
+from myplugin.representation import ADDRESS
+
+# maximum number of distinct combinations of the grouped columns
+GROUP_THRESHOLD = 10
+# the grouped columns are searched exactly among at most this many columns, and greedily among more
+EXACT_GROUP_COLUMNS = 12
+# values longer than this, occurring more than OCCURRENCES_THRESHOLD times in a column, become placeholders
+LONG_THRESHOLD = 12
+OCCURRENCES_THRESHOLD = 3
+
+
+class Column:
+    """
+    Codes of the values of a variable by history row, and the distinct values they stand for.
+    """
+    def __init__(self, name: str, codes: np.ndarray, values: List[str]):
+        self.name = name
+        self.codes = codes
+        self.values = values
+
+    @classmethod
+    def from_values(cls, name: str, values: Sequence, strip_cache: Dict[str, str]) -> "Column":
+        codes, uniques = pd.factorize(np.asarray(values, dtype=object), use_na_sentinel=True)
+        stripped = []
+        for value in uniques:
+            text = strip_cache.get(value)
+            if text is None:
+                text = strip_cache[value] = ADDRESS.sub("", value)
+            stripped.append(text)
+        return cls(name, codes, []).recode(codes, stripped)
+
+    def recode(self, codes: np.ndarray, values: List[str]) -> "Column":
+        # values that became equal share one code again
+        value_codes, uniques = pd.factorize(np.asarray(values, dtype=object))
+        self.codes = np.where(codes >= 0, value_codes[np.maximum(codes, 0)] if len(values) else codes, -1)
+        self.values = list(uniques)
+        return self
+
+    def decode(self) -> np.ndarray:
+        values = np.array(self.values + [np.nan], dtype=object)
+        return values[self.codes]
+
+    def take(self, rows: np.ndarray) -> "Column":
+        return Column(self.name, self.codes[rows], self.values)
+
+
+def _columns(variable_histories: Sequence[Dict[str, str]], strip_cache: Dict[str, str]) -> Tuple[int, List[Column]]:
+    names = {}
+    for history in variable_histories:
+        for name in history:
+            names.setdefault(name, None)
+    columns = []
+    for name in names:
+        values = [history.get(name) for history in variable_histories]
+        columns.append(Column.from_values(name, [None if value is None or value != value else value for value in values],
+                                          strip_cache))
+    return len(variable_histories), columns
+
+
+def _unique_rows(columns: List[Column], row_count: int) -> np.ndarray:
+    """
+    Indices of the first occurrence of every distinct row, in row order.
+    """
+    if not columns:
+        # like DataFrame.drop_duplicates, a frame without columns keeps all its rows
+        return np.arange(row_count)
+    matrix = np.stack([column.codes for column in columns], axis=1)
+    _, first = np.unique(matrix, axis=0, return_index=True)
+    return np.sort(first)
+
+
+def _intern_long_values(columns: List[Column]) -> Dict[str, str]:
+    placeholders = {}
+    for column in columns:
+        lengths = np.fromiter((len(value) for value in column.values), dtype=np.int64, count=len(column.values))
+        present = column.codes[column.codes >= 0]
+        counts = np.bincount(present, minlength=len(column.values))
+        # the distinct values in order of first appearance, then the most frequent first
+        _, first_seen = np.unique(present, return_index=True)
+        by_appearance = present[np.sort(first_seen)]
+        order = by_appearance[np.argsort(-counts[by_appearance], kind="stable")]
+        values = list(column.values)
+        for code in order:
+            if lengths[code] > LONG_THRESHOLD and counts[code] > OCCURRENCES_THRESHOLD:
+                placeholder = f"var#{len(placeholders) + 1}"
+                placeholders[placeholder] = values[code]
+                values[code] = placeholder
+        if values != column.values:
+            column.recode(column.codes, values)
+    return placeholders
+
+
+# indices of the columns that can be added to a group, and the group ids of the rows with each of them added
+Candidates = Tuple[np.ndarray, np.ndarray]
+
+
+def largest_column_group(columns: List[Column], threshold: int = GROUP_THRESHOLD) -> List[int]:
+    """
+    Indices of a large set of columns with at most `threshold` distinct value combinations.
+
+    When at most EXACT_GROUP_COLUMNS columns can be grouped at all, the set is the largest one, and among sets
+    of that size the one the former exhaustive search returned: the one that leaves out the earliest columns
+    (it tried excluding each column before including it, and only replaced its answer by a strictly larger set).
+    So the size is found first, with a branch and bound that tries the largest sets first, then the columns
+    are excluded in order as long as a set of that size remains. The search is exponential in the number of
+    columns, so with more, columns are added greedily instead, each time the one that splits the groups least,
+    which takes a number of steps quadratic in the number of columns.
+    """
+    rows = len(columns[0].codes) if columns else 0
+    codes = np.array([column.codes for column in columns], dtype=np.int64).reshape(len(columns), rows)
+    width = max((len(column.values) for column in columns), default=0) + 1
+
+    def compatible(group_ids: np.ndarray, indices: np.ndarray) -> Candidates:
+        # adding columns only splits groups, so a column too many stays one further down
+        key = group_ids * width + codes[indices] + 1
+        order = np.argsort(key, axis=1)
+        ordered = np.take_along_axis(key, order, axis=1)
+        first = np.ones(ordered.shape, dtype=bool)
+        first[:, 1:] = ordered[:, 1:] != ordered[:, :-1]
+        ranks = np.cumsum(first, axis=1) - 1
+        ids = np.empty_like(ranks)
+        np.put_along_axis(ids, order, ranks, axis=1)
+        keep = ranks[:, -1] < threshold if rows else np.ones(len(indices), dtype=bool)
+        return indices[keep], ids[keep]
+
+    def include(candidates: Candidates) -> Candidates:
+        indices, ids = candidates
+        return compatible(ids[0], indices[1:])
+
+    def rest(candidates: Candidates) -> Candidates:
+        indices, ids = candidates
+        return indices[1:], ids[1:]
+
+    def largest_size(candidates: Candidates, goal: int) -> int:
+        best = 0
+
+        def search(size: int, candidates: Candidates):
+            nonlocal best
+            if best >= goal or size + len(candidates[0]) <= best:
+                return
+            if not len(candidates[0]):
+                best = size
+                return
+            search(size + 1, include(candidates))
+            search(size, rest(candidates))
+
+        search(0, candidates)
+        return best
+
+    candidates = compatible(np.zeros(rows, dtype=np.int64), np.arange(len(columns)))
+    group = []
+    if len(candidates[0]) > EXACT_GROUP_COLUMNS:
+        while len(candidates[0]):
+            indices, ids = candidates
+            # the first of the columns leaving the fewest groups
+            best = int(np.argmin(ids.max(axis=1) if rows else np.zeros(len(indices))))
+            group.append(int(indices[best]))
+            candidates = compatible(ids[best], np.delete(indices, best))
+        return sorted(group)
+
+    missing = largest_size(candidates, len(candidates[0]))
+    while missing:
+        if largest_size(rest(candidates), missing) >= missing:
+            candidates = rest(candidates)
+        else:
+            group.append(int(candidates[0][0]))
+            candidates = include(candidates)
+            missing -= 1
+    return group
+
+
+def _format_values(columns: List[Column], row: int, skip_missing: bool) -> List[str]:
+    parts = []
+    for column in columns:
+        code = column.codes[row]
+        if code < 0:
+            if skip_missing:
+                continue
+            parts.append(f"{column.name} = nan")
+        else:
+            parts.append(f"{column.name} = {column.values[code]}")
+    return parts
+
+
+def _sort_rows(columns: List[Column]) -> np.ndarray:
+    """
+    Row order by the values of the columns, missing values last. Ties are left in the order of
+    DataFrame.sort_values, which doesn't sort a single column stably.
+    """
+    frame = pd.DataFrame({column.name: column.decode() for column in columns})
+    return frame.sort_values(by=[column.name for column in columns]).index.to_numpy()
+
+
+def compress_variables(variable_histories: Sequence[Dict[str, str]], strip_cache: Dict[str, str] | None = None) -> str:
+    """
+    Summarizes the values the variables of a line took, one dict of reprs by variable name per hit.
+    `strip_cache` maps values to their address-free form and can be shared by several calls.
+    """
+    if strip_cache is None:
+        strip_cache = {}
+    row_count, columns = _columns(variable_histories, strip_cache)
+    if row_count == 0:
+        raise IndexError("no variable histories")
+
+    # Drop columns with constant values
+    columns = [column for column in columns
+               if column.codes[0] < 0 or (column.codes != column.codes[0]).any()]
+
+    # Remove duplicate rows
+    rows = _unique_rows(columns, row_count)
+    columns = [column.take(rows) for column in columns]
+    row_count = len(rows)
+
+    placeholders = _intern_long_values(columns)
+    output = ""
+    if placeholders:
+        output += "Placeholders:\n" + '\n'.join([f"{k} = {v}" for k, v in placeholders.items()])
+    output += "\nVariable Histories:\n"
+
+    group = largest_column_group(columns)
+    if not group:
+        for row in range(row_count):
+            output += ' | '.join(_format_values(columns, row, skip_missing=True)) + "\n"
+        return output
+
+    group_columns = [columns[index] for index in group]
+    varying_columns = [column for index, column in enumerate(columns) if index not in group]
+    previous_key = None
+    for row in _sort_rows(group_columns):
+        key = tuple(column.codes[row] for column in group_columns)
+        # rows with a missing group value belong to no group
+        if min(key) < 0:
+            continue
+        if key != previous_key:
+            output += ' | '.join(_format_values(group_columns, row, skip_missing=False)) + "\n"
+            previous_key = key
+        if varying_columns:
+            output += "- " + ' | '.join(_format_values(varying_columns, row, skip_missing=False)) + "\n"
+    return output
+
+
+def _compress_chunk(histories_chunk: List[Sequence[Dict[str, str]]]) -> List[str]:
+    strip_cache = {}
+    return [compress_variables(histories, strip_cache) for histories in histories_chunk]
+
+
+def compress_variables_batch(histories: Iterable[Sequence[Dict[str, str]]], processes: int | None = None,
+                             chunk_size: int = 256) -> List[str]:
+    """
+    compress_variables for many lines. Address stripping is shared by the lines of a chunk, and
+    with `processes`, chunks are compressed in that many worker processes.
+    """
+    histories = list(histories)
+    chunks = [histories[start:start + chunk_size] for start in range(0, len(histories), chunk_size)]
+    if processes is None or processes <= 1:
+        results = map(_compress_chunk, chunks)
+        return [text for chunk in results for text in chunk]
+    with ProcessPoolExecutor(max_workers=processes) as executor:
+        return [text for chunk in executor.map(_compress_chunk, chunks) for text in chunk]